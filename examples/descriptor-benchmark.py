@@ -0,0 +1,55 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Example for TATHU - Tracking and Analysis of Thunderstorms."""
+
+import time
+
+from tathu.constants import LAT_LON_WGS84
+from tathu.satellite import goes16
+from tathu.tracking import descriptors, detectors
+from tathu.tracking.utils import area2degrees
+
+# Geographic area of regular grid
+extent = [-100.0, -56.0, -20.0, 15.0]
+
+# Grid resolution (kilometers)
+resolution = 2.0
+
+# Path to netCDF GOES-16 file (IR-window)
+path = '../data/OR_ABI-L2-CMIPF-M6C13_G16_s20221750000204_e20221750009523_c20221750010006.nc'
+
+# Number of repetitions
+repeat = 5
+
+# Remap and get regular grid
+grid = goes16.sat2grid(path, extent, resolution, LAT_LON_WGS84, 'HDF5')
+
+# Create detector
+detector = detectors.LessThan(230, area2degrees(3000))
+
+# Searching for systems
+systems = detector.detect(grid)
+
+print('Number of systems:', len(systems))
+
+def benchmark(descriptor):
+    start = time.time()
+    for i in range(repeat):
+        descriptor.describe(grid, systems)
+    return (time.time() - start)/repeat
+
+# Serial
+serial = benchmark(descriptors.StatisticalDescriptor(rasterOut=True))
+print('StatisticalDescriptor:', serial, 'seconds')
+
+# Parallel (first call includes pool creation)
+descriptor = descriptors.StatisticalDescriptorMT(rasterOut=True)
+parallel = benchmark(descriptor)
+descriptor.close()
+print('StatisticalDescriptorMT:', parallel, 'seconds', '(speedup: {:.2f}x)'.format(serial/parallel))
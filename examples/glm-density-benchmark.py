@@ -0,0 +1,98 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Example for TATHU - Tracking and Analysis of Thunderstorms."""
+
+import os
+import tempfile
+import time
+
+import numpy as np
+from netCDF4 import Dataset
+
+from tathu.constants import KM_PER_DEGREE
+from tathu.satellite.glm import LightningDensity
+from tathu.utils import getGeoT
+
+# Geographic area of regular grid
+extent = [-90.0, -60.0, -30.0, 15.0]
+
+# Grid resolution (kilometers)
+resolution = 2.0
+
+# Number of GLM files (20 seconds each) and synthetic flashes per file
+nfiles = 9
+n = 50000
+
+# Density interval (minutes)
+interval = 1
+
+def createGLMFile(path, seconds, rng):
+    '''Create a synthetic GLM file (flashes, some outside the grid).'''
+    nc = Dataset(path, 'w', format='NETCDF4')
+    nc.createDimension('number_of_flashes', n)
+    nc.createDimension('number_of_time_bounds', 1)
+    time = nc.createVariable('product_time', 'f8', ('number_of_time_bounds',))
+    time[:] = seconds
+    lat = nc.createVariable('flash_lat', 'f4', ('number_of_flashes',))
+    lat[:] = rng.uniform(extent[1] - 5.0, extent[3] + 5.0, n)
+    lon = nc.createVariable('flash_lon', 'f4', ('number_of_flashes',))
+    lon[:] = rng.uniform(extent[0] - 5.0, extent[2] + 5.0, n)
+    energy = nc.createVariable('flash_energy', 'f4', ('number_of_flashes',))
+    energy[:] = rng.uniform(1e-15, 1e-13, n)
+    nc.close()
+
+def baseline(files):
+    '''Reference: per-flash loop (previous implementation), one density for each interval.'''
+    nlines = int(((extent[3] - extent[1]) * KM_PER_DEGREE) / resolution)
+    ncols = int(((extent[2] - extent[0]) * KM_PER_DEGREE) / resolution)
+    geoT = getGeoT(extent, nlines, ncols)
+    density = np.zeros((nlines, ncols), dtype=np.uint32)
+    densities, start = [], None
+    for path in files:
+        nc = Dataset(path, mode='r')
+        current = float(nc.variables['product_time'][0])
+        start = current if start is None else start
+        lats = nc.variables['flash_lat'][:]
+        lons = nc.variables['flash_lon'][:]
+        nc.close()
+        for lat, lon in zip(lats, lons):
+            i = int((lat - geoT[3]) / geoT[5])
+            j = int((lon - geoT[0]) / geoT[1])
+            if i >= 0 and i < nlines and j >= 0 and j < ncols:
+                density[i,j] += 1
+        if (current - start) / 60.0 >= interval:
+            densities.append(np.copy(density))
+            density[:,:] = 0
+            start = current
+    return densities
+
+with tempfile.TemporaryDirectory() as directory:
+    # Synthetic GLM files
+    rng = np.random.default_rng(0)
+    files = []
+    for i in range(nfiles):
+        path = os.path.join(directory, 'glm-{:02d}.nc'.format(i))
+        createGLMFile(path, 6.9e8 + i * 20.0, rng)
+        files.append(path)
+
+    # Previous implementation
+    start = time.time()
+    reference = baseline(files)
+    t1 = time.time() - start
+    print('Loop: {:.4f} seconds ({:.0f} flashes/s)'.format(t1, nfiles * n / t1))
+
+    # LightningDensity (all fields accumulated in one pass over each file)
+    start = time.time()
+    densities = LightningDensity(files, extent, resolution, fields=['flash', 'flash_energy']).build(interval)
+    t2 = time.time() - start
+    print('LightningDensity: {:.4f} seconds ({:.0f} flashes/s)'.format(t2, nfiles * n / t2))
+
+    print('Same result:', len(reference) == len(densities) and
+          all(np.array_equal(r, d.array) for r, d in zip(reference, densities)))
+    print('Speedup: {:.1f}x'.format(t1/t2))
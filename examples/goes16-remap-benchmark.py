@@ -0,0 +1,54 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Example for TATHU - Tracking and Analysis of Thunderstorms."""
+
+import time
+
+import numpy as np
+
+from tathu.constants import LAT_LON_WGS84
+from tathu.satellite import goes16
+from tathu.satellite.remap import Remapper
+from tathu.utils import BufferPool
+
+# Geographic area of regular grid
+extent = [-100.0, -56.0, -20.0, 15.0]
+
+# Grid resolution (kilometers)
+resolution = 2.0
+
+# Path to netCDF GOES-16 file (IR-window)
+path = '../data/OR_ABI-L2-CMIPF-M6C13_G16_s20221750000204_e20221750009523_c20221750010006.nc'
+
+# Number of repetitions
+repeat = 5
+
+# Remapper (indexes are cached on disk)
+remapper = Remapper('../data/remap-cache/')
+
+def benchmark(remapper, buffers=None):
+    start = time.time()
+    for i in range(repeat):
+        grid = goes16.sat2grid(path, extent, resolution, LAT_LON_WGS84, 'HDF5', remapper=remapper, buffers=buffers)
+    return grid.ReadAsArray(), (time.time() - start)/repeat
+
+# gdal.ReprojectImage
+reference, t1 = benchmark(None)
+print('gdal.ReprojectImage:', t1, 'seconds')
+
+# Cached indexes (first call computes the indexes)
+goes16.sat2grid(path, extent, resolution, LAT_LON_WGS84, 'HDF5', remapper=remapper)
+result, t2 = benchmark(remapper)
+print('Remapper:', t2, 'seconds', '(speedup: {:.2f}x)'.format(t1/t2))
+
+# Cached indexes and preallocated grid arrays (reused across frames)
+_, t3 = benchmark(remapper, BufferPool())
+print('Remapper + BufferPool:', t3, 'seconds', '(speedup: {:.2f}x)'.format(t1/t3))
+
+print('Equal pixels: {:.4f}%'.format(np.mean(reference == result) * 100))
@@ -54,15 +54,15 @@ install_requires = [
     'geopandas',
     'netcdf4',
     'opencv',
-    'pathos',
     'psycopg2',
     'pyproj',
     'rasterstats',
     'requests',
-    'rtree',
+    'rtree>=1.1',
     's3fs',
     'scikit-image',
     'scipy',
+    'shapely>=2.0',
     'tqdm'
 ]
 
@@ -7,25 +7,112 @@
 #
 
 import gzip
+import hashlib
 import os
+import shutil
 
 import numpy as np
 
-from tathu.utils import array2raster
+from tathu.utils import applyScaleOffset, array2dataset, getBuffer, getGeoT, getWindow, getWindowGeoT
 
-def read(path, nlines, ncols, dtype=np.int16):
+def isCompressed(path):
     _, ext = os.path.splitext(path)
-    if ext.lower() == '.gz':
-        with gzip.open(path, 'rb') as f:
-            array = np.frombuffer(f.read(), dtype=dtype)
-    else:
-        array = np.fromfile(path, dtype, nlines * ncols)
-    return array.reshape((nlines, ncols))
-
-def binary2raster(path, extent, nlines, ncols, dtype, ctype=None, scale=1.0, offset=0.0):
-    array = read(path, nlines, ncols, dtype)
+    return ext.lower() == '.gz'
+
+def readGZ(path, nlines, ncols, dtype=np.int16, out=None):
+    '''
+    This function decompresses the given file (.gz) in a streaming way, i.e. directly
+    into out (preallocated array, if given), without intermediate copies.
+    '''
+    array = out if out is not None else np.empty((nlines, ncols), dtype)
+    view = memoryview(array).cast('B')
+    size = 0
+    with gzip.open(path, 'rb') as f:
+        while size < len(view):
+            n = f.readinto(view[size:])
+            if n == 0:
+                break
+            size += n
+    if size != len(view):
+        raise ValueError('Invalid file size: ' + path)
+    return array
+
+class GZipCache(object):
+    '''
+    This class keeps a local cache of decompressed files (e.g. GOES-13 .gz), i.e. each
+    file is decompressed only once, across repeated (re)processing runs. Cached files
+    are then read using memory-mapping (see read()). Cached files are named by a hash of
+    the source absolute path, i.e. files with same name on different directories do not collide.
+    '''
+    def __init__(self, directory):
+        self.directory = directory # Cache directory.
+
+    def get(self, path):
+        '''
+        This method returns the path of the decompressed file, decompressing it if necessary.
+        '''
+        path = os.path.abspath(path)
+        filename, _ = os.path.splitext(os.path.basename(path))
+        key = hashlib.sha1(path.encode()).hexdigest()[:16]
+        cached = os.path.join(self.directory, key + '-' + filename)
+
+        # Cached and up-to-date?
+        if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+            return cached
+
+        # Decompress (write to temporary file and replace, i.e. safe for concurrent processes)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = cached + '.' + str(os.getpid()) + '.tmp'
+        with gzip.open(path, 'rb') as src, open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp, cached)
+
+        return cached
+
+def read(path, nlines, ncols, dtype=np.int16, window=None, out=None, cache=None):
+    '''
+    This function reads the given binary file. If a window (first line, last line + 1,
+    first column, last column + 1) is given, only these lines and columns are returned.
+    Uncompressed files are memory-mapped (read-only array), i.e. only the window is read from disk.
+    Compressed files (.gz) are decompressed into out (preallocated array with full shape, if given)
+    or, if a GZipCache is given, decompressed once and then memory-mapped.
+    Note: a memory-mapped result (and any view of it) keeps the file open and mapped until it is
+    released. Use np.array(result) to get an in-memory (writeable) copy, if it must be kept or modified.
+    '''
+    if isCompressed(path):
+        if cache is None:
+            array = readGZ(path, nlines, ncols, dtype, out)
+            return array if window is None else array[window[0]:window[1], window[2]:window[3]]
+        path = cache.get(path)
+    array = np.memmap(path, dtype, 'r', shape=(nlines, ncols))
+    return array if window is None else array[window[0]:window[1], window[2]:window[3]]
+
+def binary2raster(path, extent, nlines, ncols, dtype, ctype=None, scale=1.0, offset=0.0, buffers=None, roi=None, cache=None):
+    '''
+    This function reads the given binary file as a GDAL Dataset. If roi (extent) is given,
+    only the lines and columns that cover it are read (see read()).
+    '''
+    geoT = getGeoT(extent, nlines, ncols)
+
+    # Window that covers the region of interest
+    window = None
+    if roi is not None:
+        window = getWindow(geoT, (nlines, ncols), roi)
+        if window is not None:
+            geoT = getWindowGeoT(geoT, window)
+
+    # Read data (decompression on preallocated buffer, if given)
+    out = None
+    if isCompressed(path) and cache is None:
+        out = getBuffer(buffers, (nlines, ncols), dtype)
+    array = read(path, nlines, ncols, dtype, window, out, cache)
+
     if ctype and ctype != dtype:
-        # Conversion requested. Transform data type and apply scale/offset
-        array = array.astype(ctype)
-        array = array * scale + offset
-    return array2raster(array, extent)
+        # Conversion requested. Apply scale/offset directly on output array (preallocated buffer, if given)
+        out = getBuffer(buffers, array.shape, ctype)
+        array = applyScaleOffset(array, scale, offset, out=out)
+    elif not array.flags.writeable:
+        array = np.array(array)
+
+    # Wrap as GDAL Dataset (no copy)
+    return array2dataset(array, geoT)
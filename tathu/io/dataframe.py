@@ -8,6 +8,7 @@
 
 import geopandas
 import pandas as pd
+import shapely
 
 from tathu.geometry.transform import ogr2shapely
 
@@ -36,6 +37,34 @@ def systems2geopandas(systems):
 
     return gdf
 
+def table2geopandas(table):
+    '''
+    This function converts a SystemTable (see tathu.tracking.system) to GeoPandas Dataframe.
+    '''
+    # Create dataframe with fixed attributes
+    df = pd.DataFrame({
+        'name': [str(name) for name in table.getNames()],
+        'timestamp': table.timestamps,
+        'event': [str(view.event) for view in table]
+    })
+    # Add dynamic attributes (note: arrays are used directly)
+    for attr, values in table.attrs.items():
+        df[attr] = values
+
+    # Add geometry (decoded in batch)
+    df['geom'] = shapely.from_wkb([bytes(table.getWKB(i)) for i in range(len(table))])
+
+    # Add relationships
+    df['relationships'] = [view.getRelationshipNamesAsString() for view in table]
+
+    # Creat geo-dataframe
+    gdf = geopandas.GeoDataFrame(df, geometry='geom')
+
+    # Adjust SRS
+    gdf = gdf.set_crs('epsg:4326')
+
+    return gdf
+
 class Outputter(object):
     """
     This class can be used to export tracking results to GeoPandas Dataframe.
@@ -6,13 +6,16 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 #
 
+import csv
 import io
+import struct
 import uuid
 from datetime import datetime
 
 import numpy as np
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 from osgeo import ogr
 
 from tathu.tracking.system import ConvectiveSystem, ConvectiveSystemFamily
@@ -32,11 +35,27 @@ def _adapt_array(text):
 
 psycopg2.extensions.register_adapter(np.ndarray, _adapt_array)
 
+def wkb2ewkb(wkb, srid=4326):
+    '''Converts OGC WKB to PostGIS EWKB (i.e. WKB with SRID).'''
+    endian = '<' if wkb[0] == 1 else '>'
+    type = struct.unpack(endian + 'I', wkb[1:5])[0]
+    return wkb[:1] + struct.pack(endian + 'II', type | 0x20000000, srid) + wkb[5:]
+
+def createPool(host, database, user, pwd, minconn=1, maxconn=4):
+    '''Creates a thread-safe pool of connections that can be shared by Outputter objects.'''
+    return psycopg2.pool.ThreadedConnectionPool(minconn, maxconn,
+        host=host, database=database, user=user, password=pwd)
+
 class Outputter(object):
     """
     This class can be used to export tracking results to Postgres/PostGIS Database.
+    If 'copy' is True, systems are buffered and loaded using COPY ... FROM STDIN
+    (CSV format, EWKB geometry and raw bytea rasters) for each 'batchSize' systems.
+    A pool of connections (see createPool()) can be shared by several outputters
+    in order to write concurrently (e.g. one outputter per tracking worker thread).
     """
-    def __init__(self, host, database, user, pwd, table, attrs, outputRaster=True, raster2int=True):
+    def __init__(self, host, database, user, pwd, table, attrs, outputRaster=True, raster2int=True,
+                 copy=False, batchSize=1000, pool=None):
         # Store parameters
         self.host = host
         self.database = database
@@ -46,29 +65,87 @@ class Outputter(object):
         self.attrs = attrs
         self.outputRaster = outputRaster
         self.raster2int = raster2int # Convert raster to int16 (disk-usage)?
+        self.copy = copy # Use COPY command to load systems?
+        self.batchSize = batchSize # Number of systems for each COPY command.
+        self.pool = pool # Pool of connections.
+
+        # Buffer of systems (COPY)
+        self.buffer = []
 
         # Prepare connection
-        self.conn = psycopg2.connect(host=host, database=database, user=user, password=pwd)
+        self.conn = None
+        if pool is None:
+            self.conn = psycopg2.connect(host=host, database=database, user=user, password=pwd)
 
         # Create table
         self.__createTable(table)
 
     def __del__(self):
-        self.conn.close()
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
 
     def output(self, systems):
         # Systems is empty?
         if not systems:
             return
 
-        cur = self.conn.cursor()
+        if self.copy:
+            for s in systems:
+                self.buffer.append(self.__system2row(s))
+            if len(self.buffer) >= self.batchSize:
+                self.flush()
+            return
+
+        conn = self.__getConnection()
+
+        try:
+            cur = conn.cursor()
+
+            for s in systems:
+                self.__insertSystem(s, cur)
+
+            cur.close()
+
+            conn.commit()
+        finally:
+            self.__releaseConnection(conn)
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        # Write buffered systems as CSV
+        data = io.StringIO()
+        writer = csv.writer(data)
+        writer.writerows(self.buffer)
+        data.seek(0)
+
+        columns = ['name', 'date_time'] + list(self.attrs) + ['event', 'relations', 'raster', 'nodata', 'geotransform', 'geom']
+        cmd = 'COPY ' + self.table + ' (' + ', '.join(columns) + ') FROM STDIN WITH (FORMAT csv)'
 
-        for s in systems:
-            self.__insertSystem(s, cur)
+        conn = self.__getConnection()
 
-        cur.close()
+        try:
+            cur = conn.cursor()
+            cur.copy_expert(cmd, data)
+            cur.close()
+            conn.commit()
+            self.buffer = []
+        except (Exception, psycopg2.DatabaseError) as error:
+            conn.rollback()
+            print(error)
+        finally:
+            self.__releaseConnection(conn)
 
-        self.conn.commit()
+    def __getConnection(self):
+        if self.pool is not None:
+            return self.pool.getconn()
+        return self.conn
+
+    def __releaseConnection(self, conn):
+        if self.pool is not None:
+            self.pool.putconn(conn)
 
     def __createTable(self, table):
 
@@ -92,15 +169,23 @@ class Outputter(object):
                 geotransform real[6],
                 geom GEOMETRY(POLYGON, 4326))'''
 
-            cur = self.conn.cursor()
-            cur.execute(cmd)
-            cur.close()
-            self.conn.commit()
+            conn = self.__getConnection()
+            try:
+                cur = conn.cursor()
+                cur.execute(cmd)
+                # Create indexes (GiST for geometries)
+                cur.execute('CREATE INDEX IF NOT EXISTS ' + table + '_geom_idx ON ' + table + ' USING GIST(geom)')
+                cur.execute('CREATE INDEX IF NOT EXISTS ' + table + '_name_idx ON ' + table + '(name)')
+                cur.execute('CREATE INDEX IF NOT EXISTS ' + table + '_date_time_idx ON ' + table + '(date_time)')
+                cur.close()
+                conn.commit()
+            finally:
+                self.__releaseConnection(conn)
 
         except (Exception, psycopg2.DatabaseError) as error:
             print(error)
 
-    def __system2tuple(self, s):
+    def __prepareRaster(self, s):
         # Prepare raster data
         if self.outputRaster:
             nodata = s.nodata
@@ -115,6 +200,11 @@ class Outputter(object):
         else:
             nodata, raster = 0, np.zeros((1,1))
 
+        return raster, nodata
+
+    def __system2tuple(self, s):
+        raster, nodata = self.__prepareRaster(s)
+
         # Build system-tuple
         tuple = (str(s.name), s.timestamp)
         for name in self.attrs:
@@ -124,6 +214,25 @@ class Outputter(object):
 
         return tuple
 
+    def __system2row(self, s):
+        raster, nodata = self.__prepareRaster(s)
+
+        # Serialize raster (same format of numpy adapter)
+        out = io.BytesIO()
+        np.save(out, raster)
+
+        # Build system-row (CSV)
+        row = [str(s.name), s.timestamp]
+        for name in self.attrs:
+            row.append(s.attrs[name])
+
+        row += [str(s.event), '{' + ','.join(s.getRelationshipNames()) + '}',
+                '\\x' + out.getvalue().hex(), nodata,
+                '{' + ','.join([str(v) for v in s.geotransform]) + '}',
+                wkb2ewkb(bytes(s.geom.ExportToWkb())).hex()]
+
+        return row
+
     def __insertSystem(self, s, cur):
         cmd = '''INSERT INTO ''' + self.table + ''' VALUES (default, %s, %s, '''
         for attr in self.attrs:
@@ -203,32 +312,7 @@ class Loader(object):
             family = ConvectiveSystemFamily()
 
             for row in cur.fetchall():
-                # Load geometry and create object
-                s = ConvectiveSystem(ogr.CreateGeometryFromWkb(bytes(row['wkb'])))
-
-                # Load numeric attributes
-                s.name = uuid.UUID(row['name'])
-                s.timestamp = datetime.strptime(str(row['date_time']), '%Y-%m-%d %H:%M:%S')
-
-                for name in attrs:
-                    s.attrs[name] = row[name]
-
-                s.event = row['event']
-
-                # Load raster data
-                raster = bytea2nparray(row['raster'])
-                nodata = row['nodata']
-
-                # Apply mask
-                raster = np.ma.masked_where(raster == nodata, raster, False)
-
-                s.raster = raster/100
-                s.nodata = nodata/100
-                s.geotransform = row['geotransform']
-
-                s.relationships = row['relations']
-
-                family.addSystem(s)
+                family.addSystem(self.__row2system(row, attrs))
 
             cur.close()
 
@@ -247,39 +331,89 @@ class Loader(object):
 
             cur.execute(query)
 
-            for row in cur.fetchall():
-                # Load geometry and create object
-                s = ConvectiveSystem(ogr.CreateGeometryFromWkb(bytes(row['wkb'])))
+            row = cur.fetchone()
 
-                # Load numeric attributes
-                s.name = uuid.UUID(row['name'])
-                s.timestamp = datetime.strptime(str(row['date_time']), '%Y-%m-%d %H:%M:%S')
+            cur.close()
 
-                for name in attrs:
-                    s.attrs[name] = row[name]
+            if row is not None:
+                return self.__row2system(row, attrs)
 
-                s.event = row['event']
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
 
-                # Load raster data
-                raster = bytea2nparray(row['raster'])
-                nodata = row['nodata']
+    def loadByExtent(self, extent, attrs, start=None, end=None):
+        '''
+        This method loads the systems that intersect the given extent [llx, lly, urx, ury],
+        optionally between start and end date/times.
+        '''
+        return self.__loadByFrame('ST_MakeEnvelope(%s, %s, %s, %s, 4326)', tuple(extent), attrs, start, end)
+
+    def loadByGeometry(self, geom, attrs, start=None, end=None):
+        '''
+        This method loads the systems that intersect the given geometry (OGR Geometry),
+        optionally between start and end date/times.
+        '''
+        wkb = psycopg2.Binary(bytes(geom.ExportToWkb()))
+        return self.__loadByFrame('ST_GeomFromWKB(%s, 4326)', (wkb,), attrs, start, end)
+
+    def __loadByFrame(self, frame, params, attrs, start, end):
+        try:
+            cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-                # Apply mask
-                raster = np.ma.masked_where(raster == nodata, raster, False)
+            # Note: && operator uses GiST index to select candidates
+            query = 'SELECT *, ST_AsBinary(geom) as wkb FROM ' + self.table
+            query += ' WHERE geom && ' + frame + ' AND ST_Intersects(geom, ' + frame + ')'
+            params = params + params
 
-                s.raster = raster/100
-                s.nodata = nodata/100
-                s.geotransform = row['geotransform']
+            if start is not None:
+                query += ' AND date_time >= %s'
+                params += (start,)
 
-                s.relationships = row['relations']
+            if end is not None:
+                query += ' AND date_time <= %s'
+                params += (end,)
 
-                cur.close()
+            query += ' ORDER BY (date_time)'
+
+            cur.execute(query, params)
+
+            systems = [self.__row2system(row, attrs) for row in cur.fetchall()]
+
+            cur.close()
 
-                return s
+            return systems
 
         except (Exception, psycopg2.DatabaseError) as error:
             print(error)
 
+    def __row2system(self, row, attrs):
+        # Load geometry and create object
+        s = ConvectiveSystem(ogr.CreateGeometryFromWkb(bytes(row['wkb'])))
+
+        # Load numeric attributes
+        s.name = uuid.UUID(row['name'])
+        s.timestamp = datetime.strptime(str(row['date_time']), '%Y-%m-%d %H:%M:%S')
+
+        for name in attrs:
+            s.attrs[name] = row[name]
+
+        s.event = row['event']
+
+        # Load raster data
+        raster = bytea2nparray(row['raster'])
+        nodata = row['nodata']
+
+        # Apply mask
+        raster = np.ma.masked_where(raster == nodata, raster, False)
+
+        s.raster = raster/100
+        s.nodata = nodata/100
+        s.geotransform = row['geotransform']
+
+        s.relationships = row['relations']
+
+        return s
+
     def query(self, query):
         try:
             cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -11,14 +11,17 @@ import io
 import os
 import pickle
 import sqlite3
+import time
 import uuid
 import zlib
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import numpy as np
 from osgeo import ogr
 
-from tathu.tracking.system import ConvectiveSystem, ConvectiveSystemFamily
+from tathu.tracking.system import (ConvectiveSystem, ConvectiveSystemFamily,
+                                   SystemTable)
 
 compressor = 'zlib'  # none, zlib, bz2
 
@@ -63,17 +66,128 @@ sqlite3.register_converter('tuple', pickle.loads)
 sqlite3.register_adapter(list, adapt_list)
 sqlite3.register_converter('list', pickle.loads)
 
+def decodeRaster(raster, nodata):
+    """
+    This function applies the no-data mask and converts int16 rasters (see Outputter.raster2int).
+    """
+    # Apply mask
+    raster = np.ma.masked_where(raster == nodata, raster, False)
+    if raster.dtype == np.int16:
+        raster = raster/100.0
+    return raster
+
+class LazyConvectiveSystem(ConvectiveSystem):
+    """
+    This class represents a convective system loaded from SQLite/SpatiaLite Database.
+    Geometry (WKB) and raster (BLOB) are decoded only on first access.
+    """
+    def __init__(self, wkb=None, blob=None):
+        self._wkb = wkb
+        self._blob = blob
+        super(LazyConvectiveSystem, self).__init__(None)
+
+    @property
+    def geom(self):
+        if self._geom is None and self._wkb is not None:
+            self._geom = ogr.CreateGeometryFromWkb(self._wkb)
+            self._wkb = None
+        return self._geom
+
+    @geom.setter
+    def geom(self, geom):
+        self._geom = geom
+
+    @property
+    def raster(self):
+        if self._raster is None and self._blob is not None:
+            self._raster = decodeRaster(convert_array(self._blob), self.nodata)
+            self._blob = None
+        return self._raster
+
+    @raster.setter
+    def raster(self, raster):
+        self._raster = raster
+
+    def hasGeom(self):
+        return self._geom is not None or self._wkb is not None
+
+def tableExists(conn, table):
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    exists = cur.fetchone()[0] == 1
+    cur.close()
+    return exists
+
+def getSummaryTable(table):
+    """
+    This function returns the name of the table that summarizes each system family
+    (i.e. name, start_time, end_time, duration (hours) and max_area).
+    """
+    return table + '_summary'
+
+# Merge rule of system families summary (see Outputter and merge())
+SUMMARY_UPSERT = '''ON CONFLICT(name) DO UPDATE SET
+    start_time = MIN(start_time, excluded.start_time),
+    end_time = MAX(end_time, excluded.end_time),
+    duration = (julianday(MAX(end_time, excluded.end_time)) - julianday(MIN(start_time, excluded.start_time))) * 24.0,
+    max_area = MAX(max_area, excluded.max_area)'''
+
+def getDateRange(format, date):
+    """
+    This function returns the interval [start, end) represented by the given date string and format.
+    e.g. ('%Y%m%d', '20180408') -> [2018-04-08 00:00:00, 2018-04-09 00:00:00).
+    Returns None if the format does not define an absolute interval.
+    """
+    if '%Y' not in format and '%y' not in format:
+        return None
+
+    start = datetime.strptime(date, format)
+
+    if '%S' in format:
+        end = start + timedelta(seconds=1)
+    elif '%M' in format:
+        end = start + timedelta(minutes=1)
+    elif '%H' in format:
+        end = start + timedelta(hours=1)
+    elif '%d' in format or '%j' in format:
+        end = start + timedelta(days=1)
+    elif '%m' in format or '%b' in format or '%B' in format:
+        end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    else:
+        end = datetime(start.year + 1, 1, 1)
+
+    return start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S')
+
 class Outputter(object):
     """
     This class can be used to export tracking results to SQLite/SpatiaLite Database.
+    Systems are inserted using a prepared command (executemany) and the commits can be
+    grouped, i.e. one transaction for each 'commitInterval' calls of output() method.
+    Optionally, rasters can be serialized/compressed by a pool of threads ('workers').
     """
-    def __init__(self, database, table, attrs, outputRaster=True, raster2int=True):
+    def __init__(self, database, table, attrs, outputRaster=True, raster2int=True,
+                 commitInterval=1, workers=0, fastWrite=False):
         # Store parameters
         self.database = database
         self.table = table
         self.attrs = attrs
         self.outputRaster = outputRaster
         self.raster2int = raster2int # Convert raster to int16 (disk-usage)?
+        self.commitInterval = commitInterval # Number of output() calls (e.g. frames) for each transaction.
+        self.workers = workers # Number of threads used to serialize rasters (0: main thread).
+        self.fastWrite = fastWrite # Use WAL journal mode and synchronous=NORMAL?
+
+        # Writer control
+        self.pending = 0
+        self.nrows = 0
+        self.elapsed = 0.0
+        self.executor = None
+        if workers:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        # Prepared insert commands
+        self.insertCmd = self.__buildInsertCommand()
+        self.summaryCmd = self.__buildSummaryCommand()
 
         try:
             # Verify if is necessary call InitSpatialMetadata() function
@@ -89,6 +203,11 @@ class Outputter(object):
             self.conn.enable_load_extension(True)
             self.conn.execute('SELECT load_extension("mod_spatialite")')
 
+            # Adjust journal, if requested
+            if fastWrite:
+                self.conn.execute('PRAGMA journal_mode=WAL')
+                self.conn.execute('PRAGMA synchronous=NORMAL')
+
             # Create spatial metadata tables, if necessary
             if initSpatialMetadata:
                 cur = self.conn.cursor()
@@ -102,6 +221,9 @@ class Outputter(object):
             print(e)
 
     def __del__(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
         self.conn.close()
 
     def output(self, systems):
@@ -110,62 +232,122 @@ class Outputter(object):
             if not systems:
                 return
 
-            cur = self.conn.cursor()
+            start = time.time()
 
-            for s in systems:
-                self.__insertSystem(s, cur)
+            # Build rows (serialize rasters)
+            if self.executor is not None:
+                rows = list(self.executor.map(self.__system2tuple, systems))
+            else:
+                rows = [self.__system2tuple(s) for s in systems]
 
+            cur = self.conn.cursor()
+            cur.executemany(self.insertCmd, rows)
+            cur.executemany(self.summaryCmd, [(str(s.name), s.timestamp, s.timestamp, s.getArea()) for s in systems])
             cur.close()
 
-            self.conn.commit()
+            # Commit, if necessary
+            self.pending += 1
+            if self.pending >= self.commitInterval:
+                self.conn.commit()
+                self.pending = 0
+
+            self.nrows += len(rows)
+            self.elapsed += time.time() - start
 
         except sqlite3.Error as e:
             print(e)
 
-    def __tableExists(self, table):
-        cur = self.conn.cursor()
-        cmd = "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='" + table + "'"
-        cur.execute(cmd)
-        exists = False
-        if cur.fetchone()[0] == 1:
-            exists = True
-        cur.close()
-        return exists
+    def flush(self):
+        try:
+            if self.pending:
+                self.conn.commit()
+                self.pending = 0
+        except sqlite3.Error as e:
+            print(e)
 
-    def __createTable(self, table):
-        if self.__tableExists(table):
-            return
+    def getRowsPerSecond(self):
+        if self.elapsed == 0.0:
+            return 0.0
+        return self.nrows / self.elapsed
 
+    def __createTable(self, table):
         try:
-            # Build numeric attributes creation command
-            # For while, using REAL for all
-            # TODO: create a map that relates attrs <-> data type on ConvectiveSystem class
-            # Can use Numpy types, like np.int16, np.float, etc.?
-            dynAttributes = ''
-            for attr in self.attrs:
-                dynAttributes += attr + ' REAL, '
-
-            cmd = '''CREATE TABLE IF NOT EXISTS ''' + table + '''(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                date_time TIMESTAMP, ''' + dynAttributes + '''
-                event VARCHAR(64),
-                relationships TEXT,
-                raster array,
-                nodata INTEGER,
-                geotransform tuple)'''
+            if not tableExists(self.conn, table):
+                # Build numeric attributes creation command
+                # For while, using REAL for all
+                # TODO: create a map that relates attrs <-> data type on ConvectiveSystem class
+                # Can use Numpy types, like np.int16, np.float, etc.?
+                dynAttributes = ''
+                for attr in self.attrs:
+                    dynAttributes += attr + ' REAL, '
+
+                cmd = '''CREATE TABLE IF NOT EXISTS ''' + table + '''(
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT,
+                    date_time TIMESTAMP, ''' + dynAttributes + '''
+                    event VARCHAR(64),
+                    relationships TEXT,
+                    raster array,
+                    nodata INTEGER,
+                    geotransform tuple)'''
 
-            cur = self.conn.cursor()
-            r = cur.execute(cmd)
+                cur = self.conn.cursor()
+                r = cur.execute(cmd)
 
-            # Add geometry field
-            cmd = "SELECT AddGeometryColumn('" + table + "'" + ''', 'geom', 4326, 'POLYGON', 'XY')'''
-            cur.execute(cmd)
+                # Add geometry field
+                cmd = "SELECT AddGeometryColumn('" + table + "'" + ''', 'geom', 4326, 'POLYGON', 'XY')'''
+                cur.execute(cmd)
+
+                cur.close()
 
+            # Create spatial index (R*Tree), if necessary
+            cur = self.conn.cursor()
+            cur.execute("SELECT spatial_index_enabled FROM geometry_columns "
+                        "WHERE f_table_name = lower(?) AND f_geometry_column = 'geom'", (table,))
+            row = cur.fetchone()
+            if row is not None and row[0] == 0:
+                cur.execute("SELECT CreateSpatialIndex('" + table + "', 'geom')")
+            cur.close()
+
+            # Create indexes
+            cur = self.conn.cursor()
+            cur.execute('CREATE INDEX IF NOT EXISTS ' + table + '_name_idx ON ' + table + '(name)')
+            cur.execute('CREATE INDEX IF NOT EXISTS ' + table + '_date_time_idx ON ' + table + '(date_time)')
             cur.close()
+
+            # Create summary of system families
+            self.__createSummaryTable(table)
+
+            self.conn.commit()
+
         except sqlite3.Error as e:
             print(e)
 
+    def __createSummaryTable(self, table):
+        summary = getSummaryTable(table)
+        if tableExists(self.conn, summary):
+            return
+
+        cur = self.conn.cursor()
+
+        cmd = '''CREATE TABLE IF NOT EXISTS ''' + summary + '''(
+            name TEXT PRIMARY KEY,
+            start_time TIMESTAMP,
+            end_time TIMESTAMP,
+            duration REAL,
+            max_area REAL)'''
+        cur.execute(cmd)
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + summary + '_duration_idx ON ' + summary + '(duration)')
+
+        # Summarize previous systems (i.e. table created by old versions), if any
+        cmd = '''INSERT INTO ''' + summary + '''
+            SELECT name, MIN(date_time), MAX(date_time),
+            (julianday(MAX(date_time)) - julianday(MIN(date_time))) * 24.0, MAX(ST_Area(geom))
+            FROM ''' + table + ''' GROUP BY name'''
+        cur.execute(cmd)
+
+        cur.close()
+
     def __system2tuple(self, s):
         # Prepare raster data
         if self.outputRaster:
@@ -186,16 +368,20 @@ class Outputter(object):
         for name in self.attrs:
             tuple += (s.attrs[name],)
 
-        tuple += (str(s.event), s.getRelationshipNamesAsString(), raster, nodata, s.geotransform, s.getGeomWKT())
+        tuple += (str(s.event), s.getRelationshipNamesAsString(), adapt_array(raster), nodata, s.geotransform, bytes(s.geom.ExportToWkb()))
 
         return tuple
 
-    def __insertSystem(self, s, cur):
+    def __buildSummaryCommand(self):
+        # Incremental update of system families summary (upsert)
+        return '''INSERT INTO ''' + getSummaryTable(self.table) + ''' VALUES (?, ?, ?, 0.0, ?) ''' + SUMMARY_UPSERT
+
+    def __buildInsertCommand(self):
         cmd = '''INSERT INTO ''' + self.table + ''' VALUES (?, ?, ?, '''
         for attr in self.attrs:
             cmd += '?, '
-        cmd += '''?, ?, ?, ?, ?, ST_GeomFromText(?, 4326))'''
-        cur.execute(cmd, self.__system2tuple(s))
+        cmd += '''?, ?, ?, ?, ?, ST_GeomFromWKB(?, 4326))'''
+        return cmd
 
 class Loader(object):
     """
@@ -236,46 +422,17 @@ class Loader(object):
             print(e)
 
     def loadByDuration(self, hours, operator='>='):
-        try:
-            sql = '''SELECT DISTINCT name FROM
-                    (SELECT name, cast((strftime('%s', max(date_time)) - strftime('%s', min(date_time))) as real)/60/60 AS elapsed_time
-                    FROM ''' + self.table + ''' GROUP BY name) AS duration WHERE elapsed_time ''' + operator + str(hours) + ''' ORDER BY elapsed_time DESC'''
-
-            cur = self.conn.cursor()
-            cur.execute(sql)
-
-            names = [row['name'] for row in cur.fetchall()]
-
-            cur.close()
-
-            return names
-
-        except sqlite3.Error as e:
-            print(e)
+        if operator not in ('>', '>=', '<', '<=', '=', '!=', '<>'):
+            raise ValueError('Invalid operator: ' + operator)
+        return self.__loadNamesByDuration('duration ' + operator + ' ?', (hours,))
 
     def loadByInterval(self, start, end):
-        try:
-            sql = '''SELECT DISTINCT name FROM
-                    (SELECT name, cast((strftime('%s', max(date_time)) - strftime('%s', min(date_time))) as real)/60/60 AS elapsed_time
-                    FROM ''' + self.table + ''' GROUP BY name) AS duration WHERE elapsed_time >=''' + str(start) + '''
-                    AND elapsed_time <=''' + str(end) + ''' ORDER BY elapsed_time DESC'''
-
-            cur = self.conn.cursor()
-            cur.execute(sql)
-
-            names = [row['name'] for row in cur.fetchall()]
-
-            cur.close()
-
-            return names
-
-        except sqlite3.Error as e:
-            print(e)
+        return self.__loadNamesByDuration('duration >= ? AND duration <= ?', (start, end))
 
     def getLastDate(self, format='%Y%m%d'):
         try:
             cur = self.conn.cursor()
-            cur.execute('SELECT strftime(\'' + format + '\', MAX(date_time)) FROM ' + self.table)
+            cur.execute('SELECT strftime(?, MAX(date_time)) FROM ' + self.table, (format,))
 
             date = None
             for row in cur.fetchall():
@@ -290,37 +447,152 @@ class Loader(object):
 
     def loadLastSystems(self, attrs):
         try:
-            date = self.getLastDate('%Y-%m-%d %H:%M:00')
             cur = self.conn.cursor()
-            cur.execute('SELECT *, ST_AsBinary(geom) as wkb FROM ' + self.table + ' WHERE date_time=\'' + date + '\'')
+            cur.execute('SELECT *, ST_AsBinary(geom) as wkb FROM ' + self.table +
+                        ' WHERE date_time=(SELECT MAX(date_time) FROM ' + self.table + ')')
             return self.__fetchSystems(cur, attrs)
         except sqlite3.Error as e:
             print(e)
 
     def loadByDay(self, day, attrs):
+        return self.loadByDate('%Y%m%d', day, attrs)
+
+    def loadByDate(self, format, date, attrs):
         try:
             cur = self.conn.cursor()
-            cur.execute('SELECT *, strftime(\'%Y%m%d\', date_time) as day, ST_AsBinary(geom) as wkb FROM ' + self.table + ' WHERE day=\'' + day + '\'')
+            where, params = self.__getDateFilter(format, date)
+            cur.execute('SELECT *, ST_AsBinary(geom) as wkb FROM ' + self.table + ' WHERE ' + where, params)
             return self.__fetchSystems(cur, attrs)
         except sqlite3.Error as e:
             print(e)
 
-    def loadByDate(self, format, date, attrs):
+    def load(self, name, attrs):
         try:
             cur = self.conn.cursor()
-            cur.execute('SELECT *, strftime(\'' + format + '\', date_time) as date, ST_AsBinary(geom) as wkb FROM ' + self.table + ' WHERE date=\'' + date + '\'')
+            cur.execute('SELECT *, ST_AsBinary(geom) as wkb FROM ' + self.table + ' WHERE name=?', (str(name),))
+            return self.__fetchFamily(cur, attrs)
+        except sqlite3.Error as e:
+            print(e)
+
+    def loadByExtent(self, extent, attrs, start=None, end=None):
+        """
+        This method loads the systems that intersect the given extent [llx, lly, urx, ury],
+        optionally between start and end date/times.
+        """
+        llx, lly, urx, ury = extent
+        wkt = 'POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(llx, lly, urx, ury)
+        return self.loadByGeometry(ogr.CreateGeometryFromWkt(wkt), attrs, start, end)
+
+    def loadByGeometry(self, geom, attrs, start=None, end=None):
+        """
+        This method loads the systems that intersect the given geometry (OGR Geometry),
+        optionally between start and end date/times. The candidates are selected using
+        the spatial index (R*Tree) and refined using ST_Intersects.
+        """
+        try:
+            wkb = bytes(geom.ExportToWkb())
+
+            sql = '''SELECT *, ST_AsBinary(geom) as wkb FROM ''' + self.table + '''
+                WHERE ROWID IN (SELECT ROWID FROM SpatialIndex
+                    WHERE f_table_name = ? AND f_geometry_column = 'geom' AND search_frame = GeomFromWKB(?, 4326))
+                AND ST_Intersects(geom, GeomFromWKB(?, 4326))'''
+            params = (self.table, wkb, wkb)
+
+            if start is not None:
+                sql += ' AND date_time >= ?'
+                params += (start.strftime('%Y-%m-%d %H:%M:%S'),)
+
+            if end is not None:
+                sql += ' AND date_time <= ?'
+                params += (end.strftime('%Y-%m-%d %H:%M:%S'),)
+
+            cur = self.conn.cursor()
+            cur.execute(sql + ' ORDER BY date_time', params)
             return self.__fetchSystems(cur, attrs)
+
         except sqlite3.Error as e:
             print(e)
 
-    def load(self, name, attrs):
+    def iterate(self, attrs, where=None, params=(), raster=True, geom=True, chunksize=1000):
+        """
+        This method yields lists of systems (chunks of 'chunksize' systems) from a cursor,
+        i.e. without load all results in memory. Only the requested columns are selected
+        ('attrs', raster and geometry) and geometry/raster are decoded on first access.
+        The optional 'where' filter can use '?' placeholders, filled by 'params'.
+        """
+        columns = ['name', 'date_time', 'event', 'relationships', 'nodata', 'geotransform'] + list(attrs)
+        if raster:
+            # Note: cast to avoid the array converter (i.e. decode later)
+            columns.append('CAST(raster AS BLOB) AS blob')
+        if geom:
+            columns.append('ST_AsBinary(geom) AS wkb')
+
+        sql = 'SELECT ' + ', '.join(columns) + ' FROM ' + self.table
+        if where:
+            sql += ' WHERE ' + where
+
         try:
             cur = self.conn.cursor()
-            cur.execute('SELECT *, ST_AsBinary(geom) as wkb FROM ' + self.table + ' WHERE name=\'' + name + '\'')
-            return self.__fetchFamily(cur, attrs)
+            cur.execute(sql, params)
+
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield [self.__row2LazySystem(row, attrs, raster, geom) for row in rows]
+
+            cur.close()
+
+        except sqlite3.Error as e:
+            print(e)
+
+    def loadTable(self, attrs, where=None, params=(), chunksize=10000):
+        """
+        This method loads systems to a columnar SystemTable (see tathu.tracking.system),
+        i.e. without create one Python object (and OGR geometry) for each system.
+        Rasters are not loaded. The optional 'where' filter can use '?' placeholders.
+        """
+        columns = ['name', 'date_time', 'event', 'relationships', 'ST_AsBinary(geom) AS wkb'] + list(attrs)
+
+        sql = 'SELECT ' + ', '.join(columns) + ' FROM ' + self.table
+        if where:
+            sql += ' WHERE ' + where
+
+        names, timestamps, events, geoms, relationships = [], [], [], [], []
+        values = {name : [] for name in attrs}
+
+        try:
+            cur = self.conn.cursor()
+            cur.execute(sql, params)
+
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if not rows:
+                    break
+                for row in rows:
+                    names.append(row['name'])
+                    timestamps.append(str(row['date_time']))
+                    events.append(row['event'])
+                    geoms.append(bytes(row['wkb']))
+                    relationships.append(row['relationships'].split(' ') if row['relationships'] else [])
+                    for name in attrs:
+                        values[name].append(row[name])
+
+            cur.close()
+
+            return SystemTable.fromRecords(names, timestamps, events, values, geoms, relationships)
+
         except sqlite3.Error as e:
             print(e)
 
+    def loadTableByDay(self, day, attrs, chunksize=10000):
+        where, params = self.__getDateFilter('%Y%m%d', day)
+        return self.loadTable(attrs, where, params, chunksize)
+
+    def iterateByDay(self, day, attrs, raster=True, geom=True, chunksize=1000):
+        where, params = self.__getDateFilter('%Y%m%d', day)
+        return self.iterate(attrs, where, params, raster, geom, chunksize)
+
     def execute(self, cmd):
         try:
             cur = self.conn.cursor()
@@ -340,6 +612,58 @@ class Loader(object):
         except sqlite3.Error as e:
             print(e)
 
+    def __getDateFilter(self, format, date):
+        # Use range predicate (i.e. date_time index), if possible
+        interval = getDateRange(format, date)
+        if interval is not None:
+            return 'date_time >= ? AND date_time < ?', interval
+        return 'strftime(?, date_time) = ?', (format, date)
+
+    def __loadNamesByDuration(self, where, params):
+        try:
+            summary = getSummaryTable(self.table)
+            if tableExists(self.conn, summary):
+                sql = 'SELECT name FROM ' + summary + ' WHERE ' + where + ' ORDER BY duration DESC'
+            else:
+                sql = '''SELECT name FROM
+                    (SELECT name, cast((strftime('%s', max(date_time)) - strftime('%s', min(date_time))) as real)/60/60 AS duration
+                    FROM ''' + self.table + ''' GROUP BY name) AS summary WHERE ''' + where + ''' ORDER BY duration DESC'''
+
+            cur = self.conn.cursor()
+            cur.execute(sql, params)
+
+            names = [row['name'] for row in cur.fetchall()]
+
+            cur.close()
+
+            return names
+
+        except sqlite3.Error as e:
+            print(e)
+
+    def __row2LazySystem(self, row, attrs, raster, geom):
+        s = LazyConvectiveSystem(bytes(row['wkb']) if geom else None,
+                                 row['blob'] if raster else None)
+
+        # Load numeric attributes
+        s.name = uuid.UUID(row['name'])
+        s.timestamp = datetime.strptime(str(row['date_time']), '%Y-%m-%d %H:%M:%S')
+
+        for name in attrs:
+            s.attrs[name] = row[name]
+
+        # Load relationships
+        if row['relationships'] != '':
+            relations = row['relationships'].split(' ')
+            for name in relations:
+                s.relationships.append(uuid.UUID(name))
+
+        s.event = row['event']
+        s.nodata = row['nodata']
+        s.geotransform = row['geotransform']
+
+        return s
+
     def __fetchFamily(self, cur, attrs):
         systems = self.__fetchSystems(cur, attrs)
         family = ConvectiveSystemFamily()
@@ -370,17 +694,8 @@ class Loader(object):
             s.event = row['event']
 
             # Load raster data
-            raster = row['raster']
-            nodata = row['nodata']
-
-            # Apply mask
-            raster = np.ma.masked_where(raster == nodata, raster, False)
-            
-            s.raster = raster
-            if raster.dtype == np.int16:
-                s.raster = raster/100.0
-
-            s.nodata = nodata
+            s.nodata = row['nodata']
+            s.raster = decodeRaster(row['raster'], s.nodata)
             s.geotransform = row['geotransform']
 
             systems.append(s)
@@ -388,3 +703,55 @@ class Loader(object):
         cur.close()
 
         return systems
+
+def merge(database, table, shards):
+    """
+    This function merges tracking results stored on shard databases (e.g. one for each
+    independent period, see tathu.tracking.pipeline.PeriodScheduler) into the given table.
+    Rows are copied directly (ATTACH + INSERT ... SELECT), i.e. system names (UUIDs),
+    rasters and geometries are kept as is. The table must exist (see Outputter).
+    Returns False if an error occurs.
+    """
+    conn, attached = None, False
+    try:
+        conn = sqlite3.connect(database)
+
+        # Load spatial extension (SpatiaLite), used by geometry triggers
+        conn.enable_load_extension(True)
+        conn.execute('SELECT load_extension("mod_spatialite")')
+
+        # Columns, except primary key
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(' + table + ')') if row[1] != 'id']
+        columns = ', '.join(columns)
+
+        summary = getSummaryTable(table)
+
+        for shard in shards:
+            conn.execute('ATTACH DATABASE ? AS shard', (shard,))
+            attached = True
+
+            # Copy systems
+            conn.execute('INSERT INTO main.' + table + '(' + columns + ') SELECT ' + columns +
+                         ' FROM shard.' + table + ' ORDER BY id')
+
+            # Merge system families summary (note: WHERE is required by upsert syntax)
+            conn.execute('INSERT INTO main.' + summary + ' SELECT * FROM shard.' + summary +
+                         ' WHERE true ' + SUMMARY_UPSERT)
+
+            conn.commit()
+            conn.execute('DETACH DATABASE shard')
+            attached = False
+
+        return True
+
+    except sqlite3.Error as e:
+        print(e)
+        return False
+
+    finally:
+        if conn is not None:
+            # Discard partial copy of shard and detach it
+            if attached:
+                conn.rollback()
+                conn.execute('DETACH DATABASE shard')
+            conn.close()
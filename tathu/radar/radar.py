@@ -14,7 +14,7 @@ import tathu.binary
 from tathu.utils import getGeoT
 
 def read(path, extent, nlines, ncols):
-    # Read data
+    # Read data (memory-mapped, read-only; WriteArray() copies it, i.e. the file is released on return)
     data = tathu.binary.read(path, nlines, ncols, dtype=np.float32)
     data = np.flipud(data)
     
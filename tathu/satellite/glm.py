@@ -20,13 +20,21 @@ from tathu.utils import array2raster, geo2grid, getGeoT
 basedate = datetime(2000, 1, 1, 12, 0, 0)
 
 # Define Density type
-Density = namedtuple('Density', ['timestamp', 'array'])
+# Note: fields is a dict (field name -> array) with all accumulated fields. array is the first field.
+Density = namedtuple('Density', ['timestamp', 'array', 'fields'], defaults=(None,))
 
 class LightningDensity(object):
-    def __init__(self, files, extent, resolution, proj=None):
+    '''
+    This class accumulates GLM products on a regular grid.
+    Each field is defined as <product> (count) or <product>_<variable> (sum of variable),
+    where product is one of event, group or flash. e.g. ['flash', 'group', 'flash_energy', 'group_area'].
+    All fields are accumulated in one pass over each GLM file.
+    '''
+    def __init__(self, files, extent, resolution, proj=None, fields=['flash']):
         self.files = files
         self.e = extent
         self.res = resolution
+        self.fields = fields
 
         self.proj = proj
         if proj is None:
@@ -43,8 +51,12 @@ class LightningDensity(object):
         self.geoT = getGeoT(self.e, self.nlines, self.ncols)
 
     def build(self, interval):
-        # Create grid
-        density = np.zeros((self.nlines, self.ncols), dtype=np.uint32)
+        # Create grids
+        grids = {}
+        for field in self.fields:
+            product, variable = self.__parseField(field)
+            dtype = np.uint32 if variable is None else np.float64
+            grids[field] = np.zeros((self.nlines, self.ncols), dtype=dtype)
 
         # All densities
         self.densities = []
@@ -65,11 +77,24 @@ class LightningDensity(object):
             # Get current product date
             currentdate = self.__extractFileTime(nc)
 
-            # Extract positions
-            lats = nc.variables['flash_lat']
-            lons = nc.variables['flash_lon']
+            # Extract positions (once per product)
+            positions = {}
 
-            self.__remap2grid(density, lats[:], lons[:])
+            for field in self.fields:
+                product, variable = self.__parseField(field)
+
+                if product not in positions:
+                    lats = nc.variables[product + '_lat'][:]
+                    lons = nc.variables[product + '_lon'][:]
+                    positions[product] = self.__flatIndex(lats, lons)
+
+                index, valid = positions[product]
+
+                weights = None
+                if variable is not None:
+                    weights = np.ma.filled(nc.variables[product + '_' + variable][:], 0.0)[valid]
+
+                self.__remap2grid(grids[field], index, weights)
 
             nc.close()
 
@@ -80,22 +105,35 @@ class LightningDensity(object):
             if delta.total_seconds() / 60.0 >= interval:
                 print('Processed', basedate)
                 # Store current density
-                self.densities.append(Density(timestamp=basedate, array=np.copy(density)))
+                fields = {field: np.copy(grids[field]) for field in self.fields}
+                self.densities.append(Density(timestamp=basedate, array=fields[self.fields[0]], fields=fields))
                 # Update to next iteration
                 basedate = currentdate
-                density[:,:] = 0
+                for grid in grids.values():
+                    grid[:,:] = 0
 
         return self.densities
 
-    def __remap2grid(self, density, lats, lons):
-        # Get grid bounds
-        nlines = density.shape[0]
-        ncols = density.shape[1]
+    def __parseField(self, field):
+        tokens = field.split('_', 1)
+        if tokens[0] not in ('event', 'group', 'flash'):
+            raise ValueError('Invalid GLM field: ' + field)
+        return tokens[0], tokens[1] if len(tokens) == 2 else None
+
+    def __flatIndex(self, lats, lons):
         # Remap
-        lines, cols = self.__geo2grid(lons, lats)
-        for i,j in zip(lines, cols):
-            if i >= 0 and i < self.nlines and j >= 0 and j < self.ncols:
-                density[i,j] += 1
+        lines, cols = self.__geo2grid(np.ma.getdata(lons), np.ma.getdata(lats))
+        # Verify grid bounds and invalid positions
+        valid = (lines >= 0) & (lines < self.nlines) & (cols >= 0) & (cols < self.ncols)
+        valid &= ~(np.ma.getmaskarray(lats) | np.ma.getmaskarray(lons))
+        return lines[valid] * self.ncols + cols[valid], valid
+
+    def __remap2grid(self, density, index, weights=None):
+        # Accumulate (note: np.add.at handles repeated indexes)
+        if weights is None:
+            np.add.at(density.reshape(-1), index, 1)
+        else:
+            np.add.at(density.reshape(-1), index, weights)
 
     def __geo2grid(self, x, y):
         lin = (y - self.geoT[3]) / self.geoT[5]
@@ -115,8 +153,13 @@ class LightningDensity(object):
             nc = Dataset(fname, 'w', format='NETCDF4')
             x = nc.createDimension('x', den.array.shape[0])
             y = nc.createDimension('y', den.array.shape[1])
-            density = nc.createVariable('density', np.uint32, ('x', 'y'))
+            density = nc.createVariable('density', den.array.dtype, ('x', 'y'))
             density[:] = den.array
+            # Additional fields, if any
+            if den.fields:
+                for field in self.fields[1:]:
+                    var = nc.createVariable(field, den.fields[field].dtype, ('x', 'y'))
+                    var[:] = den.fields[field]
             nc.close()
 
 class NowcastingGLMDensity(object):
@@ -24,12 +24,18 @@ RES = 0.04
 EXTENT = [-100, -56.04, -100 + (NCOLS * RES), -56.05 + (NLINES * RES)]
 DATA_TYPE = np.int16
 
-def sat2grid(path, extent=None, resolution=4, autoscale=True, progress=None):
+def sat2grid(path, extent=None, resolution=4, autoscale=True, progress=None, buffers=None, cache=None):
+    '''
+    Read GOES-13 file and remap to regular grid. If extent is given, only the lines and columns
+    that cover it are read and scaled. If a cache is given (see tathu.binary.GZipCache), compressed
+    files are decompressed only once, e.g. across repeated reprocessing runs.
+    '''
     if autoscale is False:
-        grid = binary2raster(path, EXTENT, NLINES, NCOLS, DATA_TYPE)
+        grid = binary2raster(path, EXTENT, NLINES, NCOLS, DATA_TYPE,
+            buffers=buffers, roi=extent, cache=cache)
     else:
         grid = binary2raster(path, EXTENT, NLINES, NCOLS,
-            DATA_TYPE, np.float32, scale=1/100.0)
+            DATA_TYPE, np.float32, scale=1/100.0, buffers=buffers, roi=extent, cache=cache)
 
     if extent is None:
         return grid
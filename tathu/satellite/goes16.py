@@ -10,147 +10,219 @@ import datetime
 
 import numpy as np
 from netCDF4 import Dataset
-from osgeo import gdal, osr
+from osgeo import gdal, gdal_array, osr
 
 from tathu.constants import KM_PER_DEGREE
-from tathu.utils import getGeoT
+from tathu.satellite.remap import computeSourceWindow
+from tathu.utils import applyScaleOffset, array2dataset, getBuffer, getGeoT, getWindowGeoT
 
 # Date format (from ABI File Naming Conventions)
 DATE_REGEX = '\d{14}'
 DATE_FORMAT = '%Y%j%H%M%S%f'
 
+class GOES16File(object):
+    '''
+    This class opens a GOES-16 netCDF file only once and gives access to its
+    metadata (projection, scale/offset, fill value, bounds, coverage time) and data.
+    It can be used as a context manager.
+    '''
+    def __init__(self, path, var='CMI'):
+        self.path = path
+        self.var = var
+        self.nc = Dataset(path, mode='r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.nc is not None:
+            self.nc.close()
+            self.nc = None
+
+    def getScaleOffset(self):
+        variable = self.nc.variables[self.var]
+        return variable.scale_factor, variable.add_offset
+
+    def getFillValue(self):
+        return self.nc.variables[self.var]._FillValue
+
+    def getProj(self):
+        # Get GOES-R ABI fixed grid projection
+        proj = self.nc['goes_imager_projection']
+        # Extract parameters
+        h = proj.perspective_point_height
+        a = proj.semi_major_axis
+        b = proj.semi_minor_axis
+        inv = 1.0 / proj.inverse_flattening
+        lat0 = proj.latitude_of_projection_origin
+        lon0 = proj.longitude_of_projection_origin
+        sweep = proj.sweep_angle_axis
+        # Build proj4 string
+        proj4 = ('+proj=geos +h={} +a={} +b={} +f={} +lat_0={} +lon_0={} +sweep={} +no_defs').format(h, a, b, inv, lat0, lon0, sweep)
+        # Create projection object
+        proj = osr.SpatialReference()
+        proj.ImportFromProj4(proj4)
+        return proj
+
+    def getProjExtent(self):
+        H = self.nc['goes_imager_projection'].perspective_point_height
+        llx = self.nc.variables['x_image_bounds'][0] * H
+        lly = self.nc.variables['y_image_bounds'][1] * H
+        urx = self.nc.variables['x_image_bounds'][1] * H
+        ury = self.nc.variables['y_image_bounds'][0] * H
+        return [llx, lly, urx, ury]
+
+    def getGeoExtent(self):
+        extent = self.nc.variables['geospatial_lat_lon_extent']
+        llx = extent.geospatial_westbound_longitude
+        lly = extent.geospatial_southbound_latitude
+        urx = extent.geospatial_eastbound_longitude
+        ury = extent.geospatial_northbound_latitude
+        return [llx, lly, urx, ury]
+
+    def getCoverageTime(self):
+        start = datetime.datetime.strptime(self.nc.time_coverage_start, '%Y-%m-%dT%H:%M:%S.%fZ')
+        end = datetime.datetime.strptime(self.nc.time_coverage_end, '%Y-%m-%dT%H:%M:%S.%fZ')
+        return start, end
+
+    def getShape(self):
+        return self.nc.variables[self.var].shape
+
+    def read(self, window=None):
+        '''
+        This method reads the data (packed values, i.e. without scale/offset) to a NumPy array.
+        If a window (first line, last line + 1, first column, last column + 1) is given,
+        only this hyperslab is read from file.
+        '''
+        variable = self.nc.variables[self.var]
+        variable.set_auto_maskandscale(False)
+        if window is None:
+            return variable[:]
+        line0, line1, col0, col1 = window
+        return variable[line0:line1, col0:col1]
+
 def getScaleOffset(path, var='CMI'):
-    nc = Dataset(path, mode='r')
-    scale = nc.variables[var].scale_factor
-    offset = nc.variables[var].add_offset
-    nc.close()
-    return scale, offset
+    with GOES16File(path, var) as f:
+        return f.getScaleOffset()
 
 def getFillValue(path, var='CMI'):
-    nc = Dataset(path, mode='r')
-    value = nc.variables[var]._FillValue
-    nc.close()
-    return value
+    with GOES16File(path, var) as f:
+        return f.getFillValue()
 
 def getProj(path):
-    # Open GOES-16 netCDF file
-    nc = Dataset(path, mode='r')
-    # Get GOES-R ABI fixed grid projection
-    proj = nc['goes_imager_projection']
-    # Extract parameters
-    h = proj.perspective_point_height
-    a = proj.semi_major_axis
-    b = proj.semi_minor_axis
-    inv = 1.0 / proj.inverse_flattening
-    lat0 = proj.latitude_of_projection_origin
-    lon0 = proj.longitude_of_projection_origin
-    sweep = proj.sweep_angle_axis
-    # Build proj4 string
-    proj4 = ('+proj=geos +h={} +a={} +b={} +f={} +lat_0={} +lon_0={} +sweep={} +no_defs').format(h, a, b, inv, lat0, lon0, sweep)
-    # Create projection object
-    proj = osr.SpatialReference()
-    proj.ImportFromProj4(proj4)
-    # Close GOES-16 netCDF file
-    nc.close()
-    return proj
+    with GOES16File(path) as f:
+        return f.getProj()
 
 def getProjExtent(path):
-    nc = Dataset(path, mode='r')
-    H = nc['goes_imager_projection'].perspective_point_height
-    llx = nc.variables['x_image_bounds'][0] * H
-    lly = nc.variables['y_image_bounds'][1] * H
-    urx = nc.variables['x_image_bounds'][1] * H
-    ury = nc.variables['y_image_bounds'][0] * H
-    nc.close()
-    return [llx, lly, urx, ury]
+    with GOES16File(path) as f:
+        return f.getProjExtent()
 
 def getGeoExtent(path):
-    nc = Dataset(path, mode='r')
-    extent = nc.variables['geospatial_lat_lon_extent']
-    llx = extent.geospatial_westbound_longitude
-    lly = extent.geospatial_southbound_latitude
-    urx = extent.geospatial_eastbound_longitude
-    ury = extent.geospatial_northbound_latitude
-    nc.close()
-    return [llx, lly, urx, ury]
+    with GOES16File(path) as f:
+        return f.getGeoExtent()
 
 def getCoverageTime(path):
-    nc = Dataset(path, mode='r')
-    start = datetime.datetime.strptime(nc.time_coverage_start, '%Y-%m-%dT%H:%M:%S.%fZ')
-    end = datetime.datetime.strptime(nc.time_coverage_end, '%Y-%m-%dT%H:%M:%S.%fZ')
-    nc.close()
-    return start, end
-
-def sat2grid(path, extent, resolution, targetPrj, driver='NETCDF', autoscale=True, progress=None, var='CMI'):
-    # Read scale/offset from file
-    scale, offset = getScaleOffset(path, var)
-
-    # Extract GOES projection extent
-    goesProjExtent = getProjExtent(path)
-
-    # GOES spatial reference system
-    sourcePrj = getProj(path)
-
-    # Fill value
-    fillValue = getFillValue(path, var)
-
-    # Get total extent, if necessary
-    if extent is None:
-        extent = getGeoExtent(path)
-
-    # Build connection info based on given driver name
-    if driver == 'NETCDF':
-        connectionInfo = 'NETCDF:\"' + path + '\":' + var
-    elif driver == 'HDF5':
-        connectionInfo = 'HDF5:\"' + path + '\"://' + var
+    with GOES16File(path) as f:
+        return f.getCoverageTime()
+
+def sat2grid(path, extent, resolution, targetPrj, driver='NETCDF', autoscale=True, progress=None, var='CMI', remapper=None, roi=True, buffers=None):
+    '''
+    Remap GOES-16 file to regular grid. If a remapper is given (see tathu.satellite.remap.Remapper),
+    the nearest neighbour indexes are cached and reused. Otherwise, gdal.ReprojectImage is used.
+    The file is opened only once. If driver is None (or a remapper is given), data is read
+    using netCDF4 directly, i.e. GDAL does not open the file. If roi is True and an extent is given,
+    only the source window (hyperslab) that covers the extent is read, using netCDF4.
+    The grid is written on a preallocated array, if buffers is given (see tathu.utils.BufferPool),
+    and scale/offset are applied in-place.
+    '''
+    with GOES16File(path, var) as f:
+        # Read scale/offset from file
+        scale, offset = f.getScaleOffset()
+
+        # Extract GOES projection extent
+        goesProjExtent = f.getProjExtent()
+
+        # GOES spatial reference system
+        sourcePrj = f.getProj()
+
+        # Fill value
+        fillValue = f.getFillValue()
+
+        # Source geo-transformation (full disk)
+        sourceShape = f.getShape()
+        sourceGeoT = getGeoT(goesProjExtent, sourceShape[0], sourceShape[1])
+
+        # Use region of interest only if extent is given
+        roi = roi and extent is not None
+
+        # Get total extent, if necessary
+        if extent is None:
+            extent = f.getGeoExtent()
+
+        # Compute grid dimension and geo-transformation
+        sizex = int(((extent[2] - extent[0]) * KM_PER_DEGREE)/resolution)
+        sizey = int(((extent[3] - extent[1]) * KM_PER_DEGREE)/resolution)
+        targetGeoT = getGeoT(extent, sizey, sizex)
+
+        # Compute source window that covers the grid (region of interest)
+        window = None
+        if roi:
+            window = computeSourceWindow(sourcePrj, sourceGeoT, sourceShape, targetPrj, targetGeoT, (sizey, sizex))
+
+        # Read data, if GDAL is not used
+        data = None
+        if window is not None or driver is None or remapper is not None:
+            data = f.read(window)
+            if window is not None:
+                sourceGeoT = getWindowGeoT(sourceGeoT, window)
+
+    if data is not None:
+        # Wrap data as GDAL Dataset (no copy)
+        raw = gdal_array.OpenArray(data)
     else:
-        raise ValueError('Invalid driver name. Options: NETCDF or HDF5')
+        # Build connection info based on given driver name
+        if driver == 'NETCDF':
+            connectionInfo = 'NETCDF:\"' + path + '\":' + var
+        elif driver == 'HDF5':
+            connectionInfo = 'HDF5:\"' + path + '\"://' + var
+        else:
+            raise ValueError('Invalid driver name. Options: NETCDF, HDF5 or None')
 
-    # Open NetCDF file (GOES data) using GDAL
-    raw = gdal.Open(connectionInfo, gdal.GA_ReadOnly)
+        # Open NetCDF file (GOES data) using GDAL
+        raw = gdal.Open(connectionInfo, gdal.GA_ReadOnly)
 
     # Setup projection and geo-transformation
     raw.SetProjection(sourcePrj.ExportToWkt())
-    raw.SetGeoTransform(getGeoT(goesProjExtent, raw.RasterYSize, raw.RasterXSize))
+    raw.SetGeoTransform(sourceGeoT)
     raw.GetRasterBand(1).SetNoDataValue(float(fillValue))
 
-    # Compute grid dimension
-    sizex = int(((extent[2] - extent[0]) * KM_PER_DEGREE)/resolution)
-    sizey = int(((extent[3] - extent[1]) * KM_PER_DEGREE)/resolution)
-
-    # Get memory driver
-    memDriver = gdal.GetDriverByName('MEM')
-
     # Output data type and fill-value
-    type = gdal.GDT_Float32
+    dtype = np.float32
     if autoscale is False:
-        type, fillValue = gdal.GDT_UInt16, 65535
+        dtype, fillValue = np.uint16, 65535
 
-    # Create grid
-    grid = memDriver.Create('grid', sizex, sizey, 1, type)
-    grid.GetRasterBand(1).SetNoDataValue(float(fillValue))
-    grid.GetRasterBand(1).Fill(float(fillValue))
-
-    # Setup projection and geo-transformation
-    grid.SetProjection(targetPrj.ExportToWkt())
-    grid.SetGeoTransform(getGeoT(extent, grid.RasterYSize, grid.RasterXSize))
+    # Create grid (preallocated buffer, if given), wrapped as GDAL Dataset (no copy)
+    array = getBuffer(buffers, (sizey, sizex), dtype)
+    array.fill(fillValue)
+    grid = array2dataset(array, targetGeoT, targetPrj, fillValue)
 
     # Perform the projection/resampling
-    gdal.ReprojectImage(raw, grid, sourcePrj.ExportToWkt(), targetPrj.ExportToWkt(), \
-                        gdal.GRA_NearestNeighbour, options=['NUM_THREADS=ALL_CPUS'], \
-                        callback=progress)
+    if remapper is not None:
+        remapper.remap(data, sourcePrj, sourceGeoT, targetPrj, targetGeoT,
+                       (sizey, sizex), fillValue, raw.GetRasterBand(1).GetNoDataValue(), out=array)
+    else:
+        gdal.ReprojectImage(raw, grid, sourcePrj.ExportToWkt(), targetPrj.ExportToWkt(), \
+                            gdal.GRA_NearestNeighbour, options=['NUM_THREADS=ALL_CPUS'], \
+                            callback=progress)
     # Close file
     raw = None
 
+    # Apply scale and offset (in-place)
     if autoscale:
-        # Read grid data
-        array = grid.ReadAsArray()
-        # Apply scale and offset
-        array = np.ma.masked_equal(array, fillValue)
-        array = array * scale + offset
-        array = np.ma.filled(array, fillValue)
-        # Back to raster
-        grid.GetRasterBand(1).WriteArray(array)
+        applyScaleOffset(array, scale, offset, fillValue)
 
     # Adjust metadata, if necessary
     if autoscale is False:
@@ -24,7 +24,7 @@ from netCDF4 import Dataset
 from osgeo import gdal
 
 from tathu.constants import KM_PER_DEGREE, LAT_LON_WGS84
-from tathu.utils import array2raster, file2timestamp, fill, getGeoT
+from tathu.utils import array2dataset, file2timestamp, fill, getBuffer, getGeoT
 
 # Date format
 DATE_REGEX = '\d{10}'
@@ -50,24 +50,28 @@ def getExtent(path):
     urx, ury = np.max(lon), np.max(lat)
     return [llx, lly, urx, ury]
 
-def sat2grid(path, time=CompositionTime.ON_THE_HOUR, extent=None, resolution=4, progress=None, fillNoDataValues=False):
+def sat2grid(path, time=CompositionTime.ON_THE_HOUR, extent=None, resolution=4, progress=None, fillNoDataValues=False, buffers=None):
     # Get full-extent
     full_extent = getExtent(path)
 
     # Read data
     nc = Dataset(path)
-    data = np.flipud(nc.variables['Tb'][time.value,:,:])
+    nodata = nc.variables['Tb']._FillValue
+    data = nc.variables['Tb'][time.value,:,:]
+    nc.close()
 
-    # Create grid object using GDAL
-    grid = array2raster(data, full_extent, nodata=nc.variables['Tb']._FillValue)
+    # Flip and fill masked values, in a single copy (preallocated buffer, if given)
+    array = getBuffer(buffers, data.shape, data.dtype)
+    np.copyto(array, np.ma.getdata(data)[::-1])
+    np.copyto(array, nodata, where=np.ma.getmaskarray(data)[::-1])
 
     # Fill no-data values if requested. i.e. fill missing values with nearest neighbour
     if fillNoDataValues:
-        nodata = grid.GetRasterBand(1).GetNoDataValue()
-        array = grid.ReadAsArray()
         array[array == nodata] = np.nan
         array = fill(array)
-        grid.GetRasterBand(1).WriteArray(array)
+
+    # Create grid object using GDAL (no copy)
+    grid = array2dataset(array, getGeoT(full_extent, array.shape[0], array.shape[1]), nodata=nodata)
 
     # Need remap?
     if extent is None:
@@ -8,10 +8,11 @@
 
 import numpy as np
 from netCDF4 import Dataset
-from osgeo import gdal, osr
+from osgeo import gdal, gdal_array, osr
 
 from tathu.constants import KM_PER_DEGREE
-from tathu.utils import getGeoT
+from tathu.satellite.remap import computeSourceWindow
+from tathu.utils import applyScaleOffset, array2dataset, getBuffer, getGeoT, getWindowGeoT
 
 # MSG Spatial Reference System (proj4 string format)
 MSGProj4 = '+proj=geos +h=35785831.0 +a=6378137.0 +b=6378169.0 +f=0.00338423143 +lat_0=0.0 +lon_0=0.0 +sweep=y +no_defs'
@@ -38,7 +39,38 @@ def getFillValue(path):
     nc.close()
     return float(value)
 
-def sat2grid(path, extent, resolution, targetPrj, driver, scale=None, offset=None, progress=None, options=['NUM_THREADS=ALL_CPUS']):
+def getShape(path):
+    nc = Dataset(path, mode='r')
+    shape = nc.variables['z'].shape
+    nc.close()
+    return shape
+
+def read(path, window=None):
+    '''
+    This function reads the data (packed values, i.e. without scale) to a NumPy array,
+    north-up (i.e. same orientation of GDAL NetCDF driver). If a window (first line,
+    last line + 1, first column, last column + 1) is given, only this hyperslab is read from file.
+    '''
+    nc = Dataset(path, mode='r')
+    variable = nc.variables['z']
+    variable.set_auto_maskandscale(False)
+    nlines, ncols = variable.shape
+    line0, line1, col0, col1 = window if window is not None else (0, nlines, 0, ncols)
+    # South-up file (y ascending): flip lines
+    y = nc.variables['y']
+    if y[0] < y[-1]:
+        data = variable[nlines - line1:nlines - line0, col0:col1][::-1]
+    else:
+        data = variable[line0:line1, col0:col1]
+    nc.close()
+    return np.ascontiguousarray(data)
+
+def sat2grid(path, extent, resolution, targetPrj, driver, scale=None, offset=None, progress=None, options=['NUM_THREADS=ALL_CPUS'], roi=True, buffers=None):
+    '''
+    Remap MSG file to regular grid. If roi is True, only the source window (hyperslab)
+    that covers the extent is read, using netCDF4. The grid is written on a preallocated
+    array, if buffers is given (see tathu.utils.BufferPool), and scale/offset are applied in-place.
+    '''
     # Read scale/offset from file, if necessary
     if scale is None or offset is None:
         scale, offset = getScaleOffset(path)
@@ -46,15 +78,6 @@ def sat2grid(path, extent, resolution, targetPrj, driver, scale=None, offset=Non
     # Extract MSG projection extent
     msgProjExtent = getProjExtent(path)
 
-    # Build connection info based on given driver name
-    if driver == 'NETCDF':
-        connectionInfo = 'NETCDF:\"' + path + '\":z'
-    else: # HDF5
-        connectionInfo = 'HDF5:\"' + path + '\"://z'
-
-    # Open NetCDF file (MSG data)
-    raw = gdal.Open(connectionInfo, gdal.GA_ReadOnly)
-
     # MSG spatial reference system
     sourcePrj = osr.SpatialReference()
     sourcePrj.ImportFromProj4(MSGProj4)
@@ -62,26 +85,44 @@ def sat2grid(path, extent, resolution, targetPrj, driver, scale=None, offset=Non
     # get fill-value
     FillValue = getFillValue(path)
 
-    # Setup projection and geo-transformation
-    raw.SetProjection(sourcePrj.ExportToWkt())
-    raw.SetGeoTransform(getGeoT(msgProjExtent, raw.RasterYSize, raw.RasterXSize))
-    raw.GetRasterBand(1).SetNoDataValue(FillValue)
+    # Source geo-transformation (full disk)
+    sourceShape = getShape(path)
+    sourceGeoT = getGeoT(msgProjExtent, sourceShape[0], sourceShape[1])
 
-    # Compute grid dimension
+    # Compute grid dimension and geo-transformation
     sizex = int(((extent[2] - extent[0]) * KM_PER_DEGREE) / resolution)
     sizey = int(((extent[3] - extent[1]) * KM_PER_DEGREE) / resolution)
-
-    # Get memory driver
-    memDriver = gdal.GetDriverByName('MEM')
-
-    # Create grid
-    grid = memDriver.Create('grid', sizex, sizey, 1, gdal.GDT_Float32)
-    grid.GetRasterBand(1).SetNoDataValue(FillValue)
-    grid.GetRasterBand(1).Fill(FillValue)
+    targetGeoT = getGeoT(extent, sizey, sizex)
+
+    # Compute source window that covers the grid (region of interest)
+    window = None
+    if roi:
+        window = computeSourceWindow(sourcePrj, sourceGeoT, sourceShape, targetPrj, targetGeoT, (sizey, sizex))
+
+    if window is not None:
+        # Read only the window (hyperslab) and wrap as GDAL Dataset (no copy)
+        data = read(path, window)
+        sourceGeoT = getWindowGeoT(sourceGeoT, window)
+        raw = gdal_array.OpenArray(data)
+    else:
+        # Build connection info based on given driver name
+        if driver == 'NETCDF':
+            connectionInfo = 'NETCDF:\"' + path + '\":z'
+        else: # HDF5
+            connectionInfo = 'HDF5:\"' + path + '\"://z'
+
+        # Open NetCDF file (MSG data)
+        raw = gdal.Open(connectionInfo, gdal.GA_ReadOnly)
 
     # Setup projection and geo-transformation
-    grid.SetProjection(targetPrj.ExportToWkt())
-    grid.SetGeoTransform(getGeoT(extent, grid.RasterYSize, grid.RasterXSize))
+    raw.SetProjection(sourcePrj.ExportToWkt())
+    raw.SetGeoTransform(sourceGeoT)
+    raw.GetRasterBand(1).SetNoDataValue(FillValue)
+
+    # Create grid (preallocated buffer, if given), wrapped as GDAL Dataset (no copy)
+    array = getBuffer(buffers, (sizey, sizex), np.float32)
+    array.fill(FillValue)
+    grid = array2dataset(array, targetGeoT, targetPrj, FillValue)
 
     # Perform the projection/resampling
     gdal.ReprojectImage(raw, grid, sourcePrj.ExportToWkt(), targetPrj.ExportToWkt(), \
@@ -90,19 +131,7 @@ def sat2grid(path, extent, resolution, targetPrj, driver, scale=None, offset=Non
     # Close file
     raw = None
 
-    # Read grid data
-    array = grid.ReadAsArray()
-
-    # Mask fill values (i.e. invalid values)
-    array = np.ma.masked_equal(array, FillValue)
-
-    # Apply scale and offset
-    array = array * scale + offset
-
-    # Fill-value
-    array = np.ma.filled(array, FillValue)
-
-    grid.GetRasterBand(1).SetNoDataValue(FillValue)
-    grid.GetRasterBand(1).WriteArray(array)
+    # Apply scale and offset (in-place), except on fill values
+    applyScaleOffset(array, scale, offset, FillValue)
 
     return grid
@@ -0,0 +1,171 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+import hashlib
+import os
+
+import numpy as np
+from pyproj import CRS, Transformer
+
+def getRemapKey(sourcePrj, sourceGeoT, sourceShape, targetPrj, targetGeoT, targetShape):
+    '''
+    This function returns a key (hash) that identifies a remapping, i.e. source
+    and target grids (spatial reference system, geo-transform and shape).
+    '''
+    geoT = lambda gt: ','.join(['{:.9g}'.format(v) for v in gt])
+    key = '|'.join([sourcePrj.ExportToProj4(), geoT(sourceGeoT), str(tuple(sourceShape)),
+                    targetPrj.ExportToProj4(), geoT(targetGeoT), str(tuple(targetShape))])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def computeRemapIndexes(sourcePrj, sourceGeoT, sourceShape, targetPrj, targetGeoT, targetShape):
+    '''
+    This function computes the nearest neighbour remapping between the given grids.
+    It returns an array with target shape that contains the flat index of source pixel
+    for each target pixel (-1 = outside of source grid).
+    '''
+    nlines, ncols = targetShape
+
+    # Target pixels centers
+    cols, lines = np.meshgrid(np.arange(ncols) + 0.5, np.arange(nlines) + 0.5)
+    x = targetGeoT[0] + cols * targetGeoT[1] + lines * targetGeoT[2]
+    y = targetGeoT[3] + cols * targetGeoT[4] + lines * targetGeoT[5]
+
+    # Transform to source projection
+    transformer = Transformer.from_crs(CRS.from_proj4(targetPrj.ExportToProj4()),
+                                       CRS.from_proj4(sourcePrj.ExportToProj4()), always_xy=True)
+    sx, sy = transformer.transform(x, y, errcheck=False)
+
+    # Source pixels (note: non-rotated source grid)
+    with np.errstate(invalid='ignore'):
+        scols = np.floor((sx - sourceGeoT[0]) / sourceGeoT[1])
+        slines = np.floor((sy - sourceGeoT[3]) / sourceGeoT[5])
+
+    # Valid positions
+    valid = np.isfinite(scols) & np.isfinite(slines)
+    valid &= (scols >= 0) & (scols < sourceShape[1]) & (slines >= 0) & (slines < sourceShape[0])
+
+    indexes = np.full(targetShape, -1, dtype=np.int32)
+    indexes[valid] = slines[valid].astype(np.int32) * sourceShape[1] + scols[valid].astype(np.int32)
+
+    return indexes
+
+def computeSourceWindow(sourcePrj, sourceGeoT, sourceShape, targetPrj, targetGeoT, targetShape, margin=2, step=16):
+    '''
+    This function computes the source window (region of interest) that covers the target grid,
+    i.e. the source lines/columns that are used by the remapping. The target grid border (all pixels)
+    and interior (each step pixels) are transformed to source projection. It returns
+    (first line, last line + 1, first column, last column + 1), including the given margin (pixels),
+    or None if the target grid does not intersect the source grid.
+    '''
+    nlines, ncols = targetShape
+
+    # Sampled target pixels: border and interior
+    lines = np.unique(np.concatenate((np.arange(0, nlines, step), [nlines - 1])))
+    cols = np.unique(np.concatenate((np.arange(0, ncols, step), [ncols - 1])))
+    border = np.concatenate((
+        np.column_stack((np.zeros(ncols), np.arange(ncols))),
+        np.column_stack((np.full(ncols, nlines - 1), np.arange(ncols))),
+        np.column_stack((np.arange(nlines), np.zeros(nlines))),
+        np.column_stack((np.arange(nlines), np.full(nlines, ncols - 1)))))
+    cols, lines = np.meshgrid(cols, lines)
+    lines = np.concatenate((lines.ravel(), border[:,0])) + 0.5
+    cols = np.concatenate((cols.ravel(), border[:,1])) + 0.5
+
+    # Target coordinates
+    x = targetGeoT[0] + cols * targetGeoT[1] + lines * targetGeoT[2]
+    y = targetGeoT[3] + cols * targetGeoT[4] + lines * targetGeoT[5]
+
+    # Transform to source projection
+    transformer = Transformer.from_crs(CRS.from_proj4(targetPrj.ExportToProj4()),
+                                       CRS.from_proj4(sourcePrj.ExportToProj4()), always_xy=True)
+    sx, sy = transformer.transform(x, y, errcheck=False)
+
+    # Source pixels (note: non-rotated source grid)
+    with np.errstate(invalid='ignore'):
+        scols = np.floor((sx - sourceGeoT[0]) / sourceGeoT[1])
+        slines = np.floor((sy - sourceGeoT[3]) / sourceGeoT[5])
+
+    valid = np.isfinite(scols) & np.isfinite(slines)
+    valid &= (scols >= 0) & (scols < sourceShape[1]) & (slines >= 0) & (slines < sourceShape[0])
+    if not valid.any():
+        return None
+
+    # Bounding window, with margin and clipped to source grid
+    line0 = max(int(slines[valid].min()) - margin, 0)
+    line1 = min(int(slines[valid].max()) + margin + 1, sourceShape[0])
+    col0 = max(int(scols[valid].min()) - margin, 0)
+    col1 = min(int(scols[valid].max()) + margin + 1, sourceShape[1])
+
+    return line0, line1, col0, col1
+
+class Remapper(object):
+    '''
+    This class implements a nearest neighbour remapper that computes the source indexes
+    only once for each (source grid, target grid) and caches them in memory and,
+    optionally, on disk (.npy files, loaded as memory-mapped arrays). Each remap is
+    a single gather operation (NumPy fancy-indexing).
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory # Cache directory (None = memory only).
+        self.indexes = {}          # Key -> remap indexes.
+
+    def __getstate__(self):
+        # Do not pickle cached indexes (e.g. remapper sent to other processes)
+        state = self.__dict__.copy()
+        state['indexes'] = {}
+        return state
+
+    def getIndexes(self, sourcePrj, sourceGeoT, sourceShape, targetPrj, targetGeoT, targetShape):
+        key = getRemapKey(sourcePrj, sourceGeoT, sourceShape, targetPrj, targetGeoT, targetShape)
+
+        # Memory
+        if key in self.indexes:
+            return self.indexes[key]
+
+        # Disk
+        path = None
+        if self.directory is not None:
+            path = os.path.join(self.directory, 'remap-' + key + '.npy')
+            if os.path.exists(path):
+                self.indexes[key] = np.load(path, mmap_mode='r')
+                return self.indexes[key]
+
+        # Compute
+        indexes = computeRemapIndexes(sourcePrj, sourceGeoT, sourceShape, targetPrj, targetGeoT, targetShape)
+
+        # Store on disk (write to temporary file and replace, i.e. safe for concurrent processes)
+        if path is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = path + '.' + str(os.getpid()) + '.tmp.npy'
+            np.save(tmp, indexes)
+            os.replace(tmp, path)
+
+        self.indexes[key] = indexes
+
+        return indexes
+
+    def remap(self, array, sourcePrj, sourceGeoT, targetPrj, targetGeoT, targetShape, nodata, sourceNodata=None, out=None):
+        '''
+        This method remaps the given array (source grid) to target grid.
+        Target pixels outside of source grid (or source no-data) are filled with nodata.
+        If out is given (array with target shape), the result is written on it.
+        '''
+        indexes = self.getIndexes(sourcePrj, sourceGeoT, array.shape, targetPrj, targetGeoT, targetShape)
+
+        # Gather
+        valid = indexes >= 0
+        if out is None:
+            out = np.empty(targetShape, dtype=np.result_type(array.dtype, np.min_scalar_type(nodata)))
+        out.fill(nodata)
+        out[valid] = array.ravel()[indexes[valid]]
+
+        # Source no-data
+        if sourceNodata is not None and sourceNodata != nodata:
+            out[valid & (out == sourceNodata)] = nodata
+
+        return out
@@ -6,19 +6,146 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 #
 
-import itertools
+import heapq
 import multiprocessing
+import os
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
 
 import cv2
 import numpy as np
 from affine import Affine
-from pathos.multiprocessing import ProcessingPool
 from rasterstats import zonal_stats
+from scipy import ndimage
 
-from tathu.tracking.detectors import ThresholdDetector, ThresholdOp
-from tathu.tracking.system import ConvectiveSystemManager
+from tathu.tracking.detectors import ThresholdDetector, ThresholdOp, threshold
+from tathu.tracking.system import (ConvectiveSystemManager,
+                                   LabeledConvectiveSystem)
 from tathu.utils import array2raster, getExtent
 
+def getLabeledImage(image, systems):
+    '''
+    This function returns the labeled image shared by the given systems,
+    if it was built on the same grid of the given image. Otherwise, returns None.
+    '''
+    if not systems:
+        return None
+
+    labels = None
+    for sys in systems:
+        if not isinstance(sys, LabeledConvectiveSystem):
+            return None
+        if labels is None:
+            labels = sys.image
+        elif sys.image is not labels:
+            return None
+
+    # Verify grid
+    if labels.labels.shape != (image.RasterYSize, image.RasterXSize):
+        return None
+    if not np.allclose(labels.geotransform, image.GetGeoTransform()):
+        return None
+
+    return labels
+
+def _majority(a):
+    values, counts = np.unique(a, return_counts=True)
+    return values[np.argmax(counts)]
+
+def _minority(a):
+    values, counts = np.unique(a, return_counts=True)
+    return values[np.argmin(counts)]
+
+def _unique(a):
+    return len(np.unique(a))
+
+def labeled_zonal_stats(labels, index, values, stats, nodata=None, raster_out=False, prefix=''):
+    '''
+    This function computes zonal statistics for all given labels at once, using the labeled image
+    produced on detection step. It is equivalent to rasterstats.zonal_stats for polygons built from
+    the labels (i.e. same stats names and same output format), without rasterize each polygon.
+    '''
+    if isinstance(stats, str):
+        stats = stats.split()
+
+    index = np.asarray(index)
+    n = labels.nobjects + 1
+
+    # Define zones: labeled pixels that have valid values
+    inside = labels.labels > 0
+    valid = inside.copy()
+    if nodata is not None:
+        valid &= values != nodata
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    zones = np.where(valid, labels.labels, 0)
+
+    # Number of valid pixels for each zone
+    count = np.bincount(zones.ravel(), minlength=n)[index]
+
+    # Compute each requested stat for all zones
+    results = {}
+    for stat in stats:
+        if stat == 'count':
+            results[stat] = count
+        elif stat == 'sum':
+            results[stat] = np.bincount(zones.ravel(), weights=values.ravel(), minlength=n)[index]
+        elif stat == 'mean':
+            sums = np.bincount(zones.ravel(), weights=values.ravel(), minlength=n)[index]
+            results[stat] = sums / np.maximum(count, 1)
+        elif stat == 'min':
+            results[stat] = ndimage.minimum(values, zones, index)
+        elif stat == 'max':
+            results[stat] = ndimage.maximum(values, zones, index)
+        elif stat == 'range':
+            results[stat] = ndimage.maximum(values, zones, index) - ndimage.minimum(values, zones, index)
+        elif stat == 'std':
+            results[stat] = ndimage.standard_deviation(values, zones, index)
+        elif stat == 'median':
+            results[stat] = ndimage.median(values, zones, index)
+        elif stat == 'nodata':
+            invalid = inside & (values == nodata) if nodata is not None else np.zeros_like(inside)
+            results[stat] = np.bincount(labels.labels[invalid], minlength=n)[index]
+        elif stat == 'nan':
+            invalid = inside & np.isnan(values) if np.issubdtype(values.dtype, np.floating) else np.zeros_like(inside)
+            results[stat] = np.bincount(labels.labels[invalid], minlength=n)[index]
+        elif stat.startswith('percentile_'):
+            q = float(stat.replace('percentile_', ''))
+            results[stat] = ndimage.labeled_comprehension(values, zones, index,
+                lambda a: np.percentile(a, q), np.float64, np.nan)
+        elif stat in ('majority', 'minority', 'unique'):
+            func = {'majority': _majority, 'minority': _minority, 'unique': _unique}[stat]
+            results[stat] = ndimage.labeled_comprehension(values, zones, index,
+                func, np.float64, np.nan)
+        else:
+            raise ValueError('Stat {} not supported'.format(stat))
+
+    # Build one dictionary for each zone (same format of rasterstats)
+    output = []
+    for i, label in enumerate(index):
+        stat = {}
+        for name in stats:
+            value = results[name][i]
+            if count[i] == 0 and name not in ('count', 'nodata', 'nan', 'sum'):
+                value = None
+            elif name in ('count', 'nodata', 'nan', 'unique'):
+                value = int(value)
+            else:
+                value = float(value)
+            stat[prefix + name] = value
+
+        if raster_out:
+            # Mini-raster based on label bounding box
+            window = labels.getSlice(label)
+            mask = (labels.labels[window] != label) | ~valid[window]
+            stat[prefix + 'mini_raster_array'] = np.ma.masked_array(values[window].copy(), mask=mask)
+            stat[prefix + 'mini_raster_affine'] = Affine.from_gdal(*labels.getGeoTransform(label))
+            stat[prefix + 'mini_raster_nodata'] = nodata
+
+        output.append(stat)
+
+    return output
+
 class StatisticalDescriptor(object):
     '''
     This class implements a convective system descriptor that
@@ -42,15 +169,23 @@ class StatisticalDescriptor(object):
         # Get no-data value
         nodata = image.GetRasterBand(1).GetNoDataValue()
 
-        #  Create WKT representation for each polygon
-        wkts = []
-        for sys in systems:
-            wkts.append(sys.geom.ExportToWkt())
+        # Get labeled image from detection, if available
+        labels = getLabeledImage(image, systems)
 
-        # Compute stats for each polygon
-        stats = zonal_stats(wkts, values, stats=self.stats,
-                            affine=aff, nodata=nodata,
-                            raster_out=self.rasterOut, prefix=self.prefix)
+        if labels is not None:
+            # Compute stats for all systems at once, using labels
+            stats = labeled_zonal_stats(labels, [sys.label for sys in systems], values,
+                                        self.stats, nodata, self.rasterOut, self.prefix)
+        else:
+            #  Create WKT representation for each polygon
+            wkts = []
+            for sys in systems:
+                wkts.append(sys.geom.ExportToWkt())
+
+            # Compute stats for each polygon
+            stats = zonal_stats(wkts, values, stats=self.stats,
+                                affine=aff, nodata=nodata,
+                                raster_out=self.rasterOut, prefix=self.prefix)
         if self.is_radar:
             for stat in stats:
                 for k in ["max", "mean", "std"]:
@@ -91,16 +226,24 @@ class DBZStatisticalDescriptor(object):
         
         # Get no-data value
         nodata = image.GetRasterBand(1).GetNoDataValue()
-        
-        #  Create WKT representation for each polygon
-        wkts = []
-        for sys in systems:
-            wkts.append(sys.geom.ExportToWkt())
 
-        # Compute stats for each polygon
-        stats = zonal_stats(wkts, values, stats=self.stats,
-                            affine=aff, nodata=nodata,
-                            raster_out=self.rasterOut, prefix=self.prefix)
+        # Get labeled image from detection, if available
+        labels = getLabeledImage(image, systems)
+
+        if labels is not None:
+            # Compute stats for all systems at once, using labels
+            stats = labeled_zonal_stats(labels, [sys.label for sys in systems], values,
+                                        self.stats, nodata, self.rasterOut, self.prefix)
+        else:
+            #  Create WKT representation for each polygon
+            wkts = []
+            for sys in systems:
+                wkts.append(sys.geom.ExportToWkt())
+
+            # Compute stats for each polygon
+            stats = zonal_stats(wkts, values, stats=self.stats,
+                                affine=aff, nodata=nodata,
+                                raster_out=self.rasterOut, prefix=self.prefix)
 
         for stat in stats:
             for k in ['max', 'mean', 'std']:
@@ -124,48 +267,129 @@ def chunks(data, n):
     for i in range(0, len(data), n):
         yield data[i:i+n]
 
+def balanced_chunks(weights, n):
+    """Split the indexes of weights in (at most) n groups with similar total weight."""
+    heap = [(0.0, i) for i in range(n)]
+    groups = [[] for i in range(n)]
+    # Greedy: heaviest first, always to the lightest group
+    for i in np.argsort(weights)[::-1]:
+        load, g = heapq.heappop(heap)
+        groups[g].append(int(i))
+        heapq.heappush(heap, (load + weights[i], g))
+    return [g for g in groups if g]
+
+def _attach_shared_memory(name):
+    """Attach an existing shared memory block without tracking it (the creator unlinks it)."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # Python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # Python <= 3.12 registers the block again on attach: undo it, i.e. avoid leak warnings at shutdown
+        if os.name == 'posix':
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def _shared_zonal_stats(args):
+    # Worker: attach the image from shared memory and compute stats for the given polygons
+    name, shape, dtype, geotransform, nodata, wkbs, stats, rasterOut, prefix = args
+    shm = _attach_shared_memory(name)
+    try:
+        values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = zonal_stats(wkbs, values, stats=stats,
+                             affine=Affine.from_gdal(*geotransform), nodata=nodata,
+                             raster_out=rasterOut, prefix=prefix)
+        # Detach mini-rasters from shared memory
+        if rasterOut:
+            for stat in result:
+                stat[prefix + 'mini_raster_array'] = stat[prefix + 'mini_raster_array'].copy()
+        del values
+    finally:
+        shm.close()
+    return result
+
 class StatisticalDescriptorMT(object):
     '''
-    *** Note: Experimental multithread version. ***
     This class implements a convective system descriptor that
-    defines a set of statistical attributes for each system.
+    defines a set of statistical attributes for each system,
+    using a persistent pool of processes. The image is shared with
+    the workers through shared memory (i.e. it is not pickled) and the
+    systems are distributed in chunks balanced by their extent area.
+    Note: call close() to terminate the pool of processes.
     '''
-    def __init__(self, stats=['min', 'mean', 'std', 'count'], prefix='', rasterOut=False):
+    def __init__(self, stats=['min', 'mean', 'std', 'count'], prefix='', rasterOut=False, processes=None):
         self.stats = stats
         self.prefix = prefix
         self.rasterOut = rasterOut
-        self.values = None
-        self.nodata = None
-        self.affine = None
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = None
+
+    def __del__(self):
+        if self.pool is not None:
+            self.pool.terminate()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
     def describe(self, image, systems):
-        # Get Affine object in order to run zonal_stats
-        self.aff = Affine.from_gdal(*image.GetGeoTransform())
+        if not systems:
+            return systems
 
         # Extract values
-        self.values = image.ReadAsArray()
+        values = image.ReadAsArray()
 
         # Get no-data value
-        self.nodata = image.GetRasterBand(1).GetNoDataValue()
-
-        #  Create WKB representation for each polygon
-        wkbs = []
-        for sys in systems:
-            wkbs.append(sys.geom.ExportToWkb())
-
-        # Create a process pool using all cores
-        cores = multiprocessing.cpu_count()
-        p = ProcessingPool(cores)
-
-        # Compute chunksize
-        #chunksize = max(1, int(len(systems)/cores))
-
-        # Parallel map
-        stats_list = p.map(self.__getstats, chunks(wkbs, cores))
+        nodata = image.GetRasterBand(1).GetNoDataValue()
 
-        # Flatten to a single list
-        stats = list(itertools.chain(*stats_list))
+        # Labeled image from detection is available? Compute at once (no need of processes)
+        labels = getLabeledImage(image, systems)
+        if labels is not None:
+            stats = labeled_zonal_stats(labels, [sys.label for sys in systems], values,
+                                        self.stats, nodata, self.rasterOut, self.prefix)
+            return self.__update(systems, stats)
 
+        # Balance chunks by extent area
+        weights = []
+        for sys in systems:
+            e = sys.getMBR()
+            weights.append((e[2] - e[0]) * (e[3] - e[1]))
+        groups = balanced_chunks(np.array(weights), self.processes)
+
+        # Create the pool of processes, if necessary
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+
+        # Share image
+        shm = shared_memory.SharedMemory(create=True, size=values.nbytes)
+        try:
+            shared = np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)
+            shared[:] = values
+            del shared
+
+            # Build tasks
+            tasks = []
+            for g in groups:
+                wkbs = [bytes(systems[i].geom.ExportToWkb()) for i in g]
+                tasks.append((shm.name, values.shape, values.dtype, image.GetGeoTransform(), nodata,
+                              wkbs, self.stats, self.rasterOut, self.prefix))
+
+            # Parallel map
+            results = self.pool.map(_shared_zonal_stats, tasks)
+        finally:
+            shm.close()
+            shm.unlink()
+
+        # Back to systems order
+        stats = [None] * len(systems)
+        for g, result in zip(groups, results):
+            for i, stat in zip(g, result):
+                stats[i] = stat
+
+        return self.__update(systems, stats)
+
+    def __update(self, systems, stats):
         # Each stat for each system
         for sys, stat in zip(systems, stats):
             sys.attrs.update(stat)
@@ -179,13 +403,6 @@ class StatisticalDescriptorMT(object):
 
         return systems
 
-    def __getstats(self, wkbs):
-        # Compute stats for each polygon
-        stats = zonal_stats(wkbs, self.values, stats=self.stats,
-                            affine=self.aff, nodata=self.nodata,
-                            raster_out=self.rasterOut, prefix=self.prefix)
-        return stats
-
 class ConvectiveCellsDescriptor():
     '''
     This class implements a convective system descriptor
@@ -196,6 +413,11 @@ class ConvectiveCellsDescriptor():
         self.minarea = minarea   # The minimum area used to define a convective cell.
 
     def describe(self, image, systems):
+        # Labeled image from detection is available? Count cells on pixel domain
+        labels = getLabeledImage(image, systems)
+        if labels is not None:
+            return self.__describeLabeled(image, labels, systems)
+
         # Create detector for cells
         detector = ThresholdDetector(self.cellTemp, ThresholdOp.LESS_THAN, self.minarea)
 
@@ -214,6 +436,27 @@ class ConvectiveCellsDescriptor():
             # Add atribute to system
             sys.attrs.update(ncells)
 
+    def __describeLabeled(self, image, labels, systems):
+        # Searching for cells (same criteria of ThresholdDetector)
+        data = image.ReadAsArray()
+        mask = threshold(data, self.cellTemp, ThresholdOp.LESS_THAN, image.GetRasterBand(1).GetNoDataValue())
+        cells, nCells = ndimage.label(mask)
+
+        # Verify minimum area
+        valid = np.ones(nCells + 1, dtype=bool)
+        valid[0] = False
+        if self.minarea is not None:
+            valid &= np.bincount(cells.ravel(), minlength=nCells + 1) * labels.getPixelArea() > self.minarea
+
+        # Unique pairs of (system label, cell label)
+        overlap = (labels.labels > 0) & valid[cells]
+        pairs = np.unique(labels.labels[overlap].astype(np.int64) * (nCells + 1) + cells[overlap])
+
+        # For each system, count the number of convective cells
+        counts = np.bincount(pairs // (nCells + 1), minlength=labels.nobjects + 1)
+        for sys in systems:
+            sys.attrs.update({'ncells' : int(counts[sys.label])})
+
 class NormalizedAreaExpansionDescriptor():
     '''
     This class implements a convective system descriptor
@@ -245,18 +488,97 @@ class NormalizedAreaExpansionDescriptor():
             except ValueError:
                 pass
 
+# Farneback parameters: pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags
+FARNEBACK_PARAMS = (0.5, 3, 15, 3, 5, 1.2, 0)
+
+def computeOpticalFlow(previousImage, image, params=FARNEBACK_PARAMS):
+    '''
+    This function computes the dense optical flow (Farneback) between the given
+    images (GDAL Datasets). The result (lines x columns x 2) is in pixel units.
+    '''
+    return cv2.calcOpticalFlowFarneback(previousImage.ReadAsArray(),
+        image.ReadAsArray(), None, *params)
+
+class OpticalFlowCache(object):
+    '''
+    This class implements a cache of optical flow fields, keyed by frame pair.
+    The least recently used fields are discarded when maxsize is reached.
+    '''
+    def __init__(self, maxsize=2, params=FARNEBACK_PARAMS):
+        self.maxsize = maxsize # Maximum number of flow fields kept.
+        self.params = params   # Farneback parameters.
+        self.fields = OrderedDict()
+
+    def get(self, previousImage, image, key=None):
+        # Note: images are kept with the flow, so the default key (ids) stays valid
+        if key is None:
+            key = (id(previousImage), id(image))
+
+        # Cache hit
+        if key in self.fields:
+            self.fields.move_to_end(key)
+            return self.fields[key][2]
+
+        # Compute and store
+        flow = computeOpticalFlow(previousImage, image, self.params)
+        self.fields[key] = (previousImage, image, flow)
+        if len(self.fields) > self.maxsize:
+            self.fields.popitem(last=False)
+
+        return flow
+
+    def clear(self):
+        self.fields.clear()
+
+def computeMedianFlow(flow, geotransform, systems):
+    '''
+    This function computes the median optical flow (u, v) of each system, in pixel
+    units. It uses the labeled image of systems, if available. Otherwise, zonal stats.
+    '''
+    result = np.zeros((len(systems), 2))
+    if not systems:
+        return result
+
+    # Verify labeled image
+    labels = systems[0].image if isinstance(systems[0], LabeledConvectiveSystem) else None
+    for sys in systems:
+        if not isinstance(sys, LabeledConvectiveSystem) or sys.image is not labels:
+            labels = None
+            break
+    if labels is not None:
+        if labels.labels.shape != flow.shape[:2] or not np.allclose(labels.geotransform, geotransform):
+            labels = None
+
+    if labels is not None:
+        index = [sys.label for sys in systems]
+        for k in range(2):
+            result[:,k] = ndimage.median(flow[:,:,k], labels.labels, index)
+        return result
+
+    # Polygon-based
+    geoms = [sys.geom.ExportToWkt() for sys in systems]
+    affine = Affine.from_gdal(*geotransform)
+    for k in range(2):
+        stats = zonal_stats(geoms, flow[:,:,k], affine=affine, stats=['median'])
+        result[:,k] = [0.0 if s['median'] is None else s['median'] for s in stats]
+
+    return result
+
 class OpticalFlowDescriptor():
     '''
     This class implements a descriptor that computes the median optical flow for each system.
     '''
-    def __init__(self, previousImage):
+    def __init__(self, previousImage, cache=None, params=FARNEBACK_PARAMS):
         self.previousImage = previousImage # The previous image used to detect the systems.
+        self.cache = cache                 # Optional flow cache (see OpticalFlowCache).
+        self.params = params               # Farneback parameters (when cache is not used).
 
     def describe(self, image, systems):
         # Compute optical flow
-        # TODO: add calcOpticalFlowFarneback parameters to OpticalFlowDescriptor constructor as option.
-        flow = cv2.calcOpticalFlowFarneback(self.previousImage.ReadAsArray(),
-            image.ReadAsArray(), None, 0.5, 3, 15, 3, 5, 1.2, 0)
+        if self.cache is not None:
+            flow = self.cache.get(self.previousImage, image)
+        else:
+            flow = computeOpticalFlow(self.previousImage, image, self.params)
 
         # Get image extent
         extent = getExtent(image.GetGeoTransform(), (image.RasterYSize, image.RasterXSize))
@@ -272,4 +594,3 @@ class OpticalFlowDescriptor():
         # v component
         descriptor = StatisticalDescriptor(stats=['mean'], prefix='v_')
         descriptor.describe(v, systems)
-        
\ No newline at end of file
@@ -9,13 +9,12 @@
 from enum import Enum
 
 import numpy as np
-from osgeo import ogr
 from scipy import ndimage
 from skimage.feature import peak_local_max
 from skimage.segmentation import watershed
 
-from tathu.tracking.system import ConvectiveSystem, ConvectiveSystemManager
-from tathu.tracking.utils import copyImage, polygonize
+from tathu.tracking.system import ConvectiveSystem, LabeledConvectiveSystem
+from tathu.tracking.utils import LabeledImage, copyImage, polygonize
 
 class ThresholdOp(Enum):
     '''
@@ -26,137 +25,188 @@ class ThresholdOp(Enum):
     GREATER_THAN = 2,             # Greater than operator (>).
     GREATER_THAN_OR_EQUAL_TO  = 3 # Greater than or equal to operator (>=).
 
+def threshold(data, value, op, nodata=None):
+    '''
+    This function returns the boolean mask of values that obey the threshold restriction.
+    Zero and no-data values are always excluded.
+    '''
+    if op is ThresholdOp.LESS_THAN:
+        mask = data < value
+    elif op is ThresholdOp.LESS_THAN_OR_EQUAL_TO:
+        mask = data <= value
+    elif op is ThresholdOp.GREATER_THAN:
+        mask = data > value
+    elif op is ThresholdOp.GREATER_THAN_OR_EQUAL_TO:
+        mask = data >= value
+
+    mask &= data != 0
+
+    # Verify no-data
+    if nodata:
+        mask &= data != nodata
+
+    return mask
+
+def labels2systems(image, labeled, nObjects, minarea=None, lazy=True):
+    '''
+    This function creates convective systems from a labeled array.
+    If lazy is True, systems are not polygonized and the area
+    filter is applied using the number of pixels of each label.
+    '''
+    if not lazy:
+        # Create Gdal dataset with labeled result in order to apply polygonize operation
+        objects = copyImage(image)
+        objects.GetRasterBand(1).SetNoDataValue(0)
+        objects.GetRasterBand(1).WriteArray(labeled)
+        objects.FlushCache()
+
+        # Polygonize objects
+        polygons = polygonize(objects, minarea)
+
+        # Create list of convective systems from polygons
+        return [ConvectiveSystem(p) for p in polygons]
+
+    labels = LabeledImage(labeled, nObjects, image.GetGeoTransform(), image.GetProjection())
+
+    # Verify minimum area
+    areas = labels.counts[1:] * labels.getPixelArea()
+    if minarea is None:
+        valid = np.nonzero(areas)[0] + 1
+    else:
+        valid = np.nonzero(areas > minarea)[0] + 1
+
+    return [LabeledConvectiveSystem(labels, int(label)) for label in valid]
+
 class ThresholdDetector(object):
     '''
     This class implements a convective system detector that uses thresholding operation.
     '''
-    def __init__(self, value, op, minarea=None):
+    def __init__(self, value, op, minarea=None, lazy=False):
         self.value = value     # Threshold value used by the detector.
         self.op = op           # Threshold operator used by the detector.
         self.minarea = minarea # Minimum area used to define a convective system.
+        self.lazy = lazy       # Keep systems as labels and build polygons only on demand?
 
     def detect(self, image):
         # Get image data
         data = image.ReadAsArray()
 
-        # Thresholding values
-        # Note: by exclusion. i.e. keep values that obey the threshold restriction
-        if self.op is ThresholdOp.LESS_THAN:
-            data[data >= self.value] = 0
-        elif self.op is ThresholdOp.LESS_THAN_OR_EQUAL_TO:
-            data[data > self.value] = 0
-        elif self.op is ThresholdOp.GREATER_THAN:
-            data[data <= self.value] = 0
-        elif self.op is ThresholdOp.GREATER_THAN_OR_EQUAL_TO:
-            data[data < self.value] = 0
-            
-        # Verify no-data
+        # Get no-data value
         nodata = image.GetRasterBand(1).GetNoDataValue()
 
-        if nodata:
-            data[data == nodata] = 0
+        # Thresholding values
+        mask = threshold(data, self.value, self.op, nodata)
 
         # Find connected components
-        labeled, nObjects = ndimage.label(data)
+        labeled, nObjects = ndimage.label(mask)
 
-        # Create Gdal dataset with labeled result in order to apply polygonize operation
-        objects = copyImage(image)
-        objects.GetRasterBand(1).SetNoDataValue(0)
-        objects.GetRasterBand(1).WriteArray(labeled)
-        objects.FlushCache()
-
-        # Polygonize objects
-        polygons = polygonize(objects, self.minarea)
-
-        # Create list of convective systems from polygons
-        systems = []
-        for p in polygons:
-            systems.append(ConvectiveSystem(p))
-
-        return systems
+        # Create list of convective systems
+        return labels2systems(image, labeled, nObjects, self.minarea, self.lazy)
 
 class LessThan(ThresholdDetector):
     """
     Auxiliary class that can be used to detect system LessThan operator.
     """
-    def __init__(self, value, minarea=None):
-        super(LessThan, self).__init__(value, ThresholdOp.LESS_THAN, minarea)
+    def __init__(self, value, minarea=None, lazy=False):
+        super(LessThan, self).__init__(value, ThresholdOp.LESS_THAN, minarea, lazy)
 
 class LessThanOrEqualTo(ThresholdDetector):
     """
     Auxiliary class that can be used to detect system LessThanOrEqualTo (<=) operator.
     """
-    def __init__(self, value, minarea=None):
-        super(LessThanOrEqualTo, self).__init__(value, ThresholdOp.LESS_THAN_OR_EQUAL_TO, minarea)
+    def __init__(self, value, minarea=None, lazy=False):
+        super(LessThanOrEqualTo, self).__init__(value, ThresholdOp.LESS_THAN_OR_EQUAL_TO, minarea, lazy)
 
 class GreaterThan(ThresholdDetector):
     """
     Auxiliary class that can be used to detect system GreaterThan (>) operator.
     """
-    def __init__(self, value, minarea=None):
-        super(GreaterThan, self).__init__(value, ThresholdOp.GREATER_THAN, minarea)
+    def __init__(self, value, minarea=None, lazy=False):
+        super(GreaterThan, self).__init__(value, ThresholdOp.GREATER_THAN, minarea, lazy)
 
 class GreaterThanOrEqualTo(ThresholdDetector):
     """
     Auxiliary class that can be used to detect system GreaterThanOrEqualTo (>=) operator.
     """
-    def __init__(self, value, minarea=None):
-        super(GreaterThanOrEqualTo, self).__init__(value, ThresholdOp.GREATER_THAN_OR_EQUAL_TO, minarea)
+    def __init__(self, value, minarea=None, lazy=False):
+        super(GreaterThanOrEqualTo, self).__init__(value, ThresholdOp.GREATER_THAN_OR_EQUAL_TO, minarea, lazy)
 
 class MultiThresholdDetector(object):
     '''
     This class implements a convective system detector that uses multi-thresholding operations.
+    The thresholds must be nested (e.g. 235, 220, 210, 200 for LessThan operator). The image
+    is read and thresholded only once and each layer is associated to its parent system
+    using the labels, i.e. without geometric intersection operations.
     '''
-    def __init__(self, thresholds, op, minareas=None):
+    def __init__(self, thresholds, op, minareas=None, lazy=False):
         self.thresholds = thresholds   # Threshold values used by the detector.
         self.op = op                   # Threshold operator used by the detector.
         self.minareas = minareas       # Minimum areas used to define a convective system and layers.
+        self.lazy = lazy               # Keep systems as labels and build polygons only on demand?
 
     def detect(self, image):
-        # Use first threshold as system base (e.g. 235k)
-        baseT = self.thresholds[0]
+        # Get image data (only once)
+        data = image.ReadAsArray()
+
+        # Get no-data value
+        nodata = image.GetRasterBand(1).GetNoDataValue()
+
+        # Minimum areas
+        minareas = self.minareas
+        if minareas is None:
+            minareas = [None] * len(self.thresholds)
 
-        # Use threshold detector to define first systems
-        detector = ThresholdDetector(baseT, self.op, self.minareas[0])
+        # Use first threshold as system base (e.g. 235k)
+        base = threshold(data, self.thresholds[0], self.op, nodata)
 
         # Detect base systems (e.g. 235k)
-        systems = detector.detect(image)
+        labeled, nObjects = ndimage.label(base)
+        systems = labels2systems(image, labeled, nObjects, minareas[0])
 
         # For each threshold layer
         for i in range(1, len(self.thresholds)):
             # Get current threshold
             layerT = self.thresholds[i]
 
-            # Use threshold detector to define layer
-            detector = ThresholdDetector(layerT, self.op, self.minareas[i])
+            # Detect systems layers (e.g. 220k, 210k, 200k). Note: layers are nested on base
+            mask = threshold(data, layerT, self.op, nodata) & base
+            layerLabeled, nLayers = ndimage.label(mask)
+            if nLayers == 0:
+                continue
 
-            # Detect systems layers (e.g. 220k, 210k, 200k)
-            layers = detector.detect(image)
+            layers = LabeledImage(layerLabeled, nLayers, image.GetGeoTransform(), image.GetProjection())
 
-            # Indexing layers
-            manager = ConvectiveSystemManager(layers)
+            # Find the parent system (base label) of each layer
+            parents = np.zeros(nLayers + 1, dtype=labeled.dtype)
+            parents[layerLabeled[mask]] = labeled[mask]
 
-            # For each system, associate the layer
-            for sys in systems:
-                # Get overlap cells
-                overlapLayers = manager.getSystemsFromSystem(sys)
+            # Verify minimum area
+            valid = np.nonzero(layers.counts[1:])[0] + 1
+            if minareas[i] is not None:
+                valid = valid[layers.counts[valid] * layers.getPixelArea() > minareas[i]]
 
-                if not overlapLayers:
-                    continue
+            # Group layers by parent system
+            groups = {}
+            for l in valid:
+                groups.setdefault(int(parents[l]), []).append(int(l))
 
-                # Build multi-polygon layers
-                mgeom = ogr.Geometry(ogr.wkbMultiPolygon)
-
-                for l in overlapLayers:
-                    mgeom.AddGeometry(l.geom.Clone())
+            # For each system, associate the layer with threshold used.
+            # Note: multi-polygon layers are built only when requested (see LabeledConvectiveSystem.layers)
+            for sys in systems:
+                if sys.label in groups:
+                    sys.addLabeledLayer(str(layerT), layers, groups[sys.label])
 
-                # Associate layer with threshold used
-                lmap = {str(layerT) : mgeom}
+        if self.lazy:
+            return systems
 
-                # Add atribute to system
-                sys.layers.update(lmap)
+        # Build geometries
+        polygons = []
+        for sys in systems:
+            p = ConvectiveSystem(sys.geom)
+            p.layers = sys.layers
+            polygons.append(p)
 
-        return systems
+        return polygons
 
 class WatershedDetector(object):
     '''
@@ -6,13 +6,16 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 #
 
-import copy
 import math
+from datetime import timedelta
 
-from osgeo import ogr
+import cv2
+import numpy as np
+import shapely
+from osgeo import gdal, ogr
 
-from tathu.geometry import transform
-from tathu.tracking.system import LifeCycleEvent
+from tathu.tracking.system import ConvectiveSystem, LifeCycleEvent
+from tathu.utils import fill
 
 def compute_distance(p1, p2):
     x = p1.GetX() - p2.GetX()
@@ -57,9 +60,53 @@ def compute_scale_factor(sys, elapsed_time=1.0):
 
     return ((current_area - previous_area)/previous_area)/elapsed_time
 
+def ogr2shapely(geoms):
+    '''
+    This function converts a list of OGR geometries to a shapely geometry array.
+    '''
+    return shapely.from_wkb([bytes(g.ExportToWkb()) for g in geoms])
+
+class ForecastSystem(ConvectiveSystem):
+    '''
+    This class represents a forecast of a convective system. It is a lightweight
+    record: only the forecast geometry is stored and all other attributes (name,
+    attrs, raster, etc.) are shared with (i.e. read from) the source system.
+    The OGR geometry is built lazily from the shapely geometry.
+    '''
+    def __init__(self, source, shape, interval):
+        self.source = source     # Source system.
+        self.shape = shape       # Forecast geometry (shapely).
+        self.interval = interval # Forecast interval (minutes).
+        self._geom = None
+
+    def __getattr__(self, name):
+        # Note: called only for attributes not found on forecast record
+        if name == 'source':
+            raise AttributeError(name)
+        return getattr(self.source, name)
+
+    @property
+    def geom(self):
+        if self._geom is None:
+            self._geom = ogr.CreateGeometryFromWkb(shapely.to_wkb(self.shape))
+        return self._geom
+
+    @geom.setter
+    def geom(self, geom):
+        self._geom = geom
+        self.shape = None if geom is None else shapely.from_wkb(bytes(geom.ExportToWkb()))
+
+    def getArea(self):
+        return shapely.area(self.shape)
+
+    def hasGeom(self):
+        return self.shape is not None
+
 class Conservative(object):
     '''
-    This class implements a conservative forecaster.
+    This class implements a conservative forecaster. Translation and scale
+    factors are computed for all systems at once and the transforms are
+    applied in batch to the coordinate arrays (see ForecastSystem).
     '''
     def __init__(self, previous, intervals, applyScale=False):
         self.previous = previous # Set of previous systems at time.
@@ -72,7 +119,8 @@ class Conservative(object):
         for t in self.intervals:
             forecasts[t] = []
 
-        # Perform forecasting
+        # Select systems
+        systems, elapsedtimes = [], []
         for sys in current:
             if sys.event == LifeCycleEvent.SPONTANEOUS_GENERATION or sys.event == LifeCycleEvent.SPLIT:
                 continue # no forecast, for while
@@ -81,21 +129,140 @@ class Conservative(object):
             if elapsedtime == 0.0:
                 continue
 
-            ### Compute translation factor ###
-            # Define last centroid (i.e.: at past)
-            base = compute_last_centroid(sys)
-            # Compute factor
-            dx, dy = delta(sys.geom.Centroid(), base, elapsedtime)
+            systems.append(sys)
+            elapsedtimes.append(elapsedtime)
+
+        if not systems:
+            return forecasts
+
+        elapsedtimes = np.array(elapsedtimes)
+
+        # Convert geometries (once)
+        shapes = ogr2shapely([sys.geom for sys in systems])
+        relationships = {}
+        for sys in systems:
+            for r in sys.relationships:
+                relationships.setdefault(id(r), (len(relationships), r))
+        relshapes = ogr2shapely([r.geom for _, r in relationships.values()])
+
+        # Compute centroids and areas
+        centroids = shapely.get_coordinates(shapely.centroid(shapes))
+        relcentroids = shapely.get_coordinates(shapely.centroid(relshapes))
+        areas = shapely.area(shapes)
+        relareas = shapely.area(relshapes)
+
+        ### Compute translation and scale factors ###
+        base = np.empty_like(centroids)
+        previousareas = np.zeros(len(systems))
+        for k, sys in enumerate(systems):
+            indexes = [relationships[id(r)][0] for r in sys.relationships]
+            previousareas[k] = relareas[indexes].sum()
+            # Define last centroid (i.e.: at past). See compute_last_centroid()
+            if len(indexes) == 1:
+                base[k] = relcentroids[indexes[0]]
+                continue
+            base[k] = centroids[k]
+            for i in indexes:
+                base[k] = (base[k] + relcentroids[i]) * 0.5
+
+        velocity = (centroids - base) / elapsedtimes[:,np.newaxis]
+        scale = ((areas - previousareas) / previousareas) / elapsedtimes
 
-            ### Compute scale factor ###
-            scale = compute_scale_factor(sys, elapsedtime)
+        # Coordinates of all systems (index: system of each coordinate)
+        coords, index = shapely.get_coordinates(shapes, return_index=True)
 
-            # Apply transform (for each interval)
-            for t in self.intervals:
-                prevision = copy.deepcopy(sys)
-                prevision.geom = transform.translate(sys.geom, dx * t, dy * t)
-                if self.applyScale:
-                    prevision.geom = transform.scale(prevision.geom, 1 + scale * t, 1 + scale * t)
-                forecasts[t].append(prevision)
+        # Scale origin: center of bounding box (see shapely.affinity.scale)
+        bounds = shapely.bounds(shapes)
+        centers = np.column_stack(((bounds[:,0] + bounds[:,2]) * 0.5, (bounds[:,1] + bounds[:,3]) * 0.5))
+
+        # Apply transform (for each interval)
+        for t in self.intervals:
+            translation = velocity * t
+            factor = 1.0 + scale * t if self.applyScale else np.ones(len(systems))
+
+            # Translate and scale (around translated center) all coordinates at once
+            result = (coords - centers[index]) * factor[index,np.newaxis] + centers[index] + translation[index]
+            previsions = shapely.transform(shapes, lambda c: result)
+
+            forecasts[t] = [ForecastSystem(sys, shape, t) for sys, shape in zip(systems, previsions)]
 
         return forecasts
+
+class Extrapolation(object):
+    '''
+    This class implements a full-field extrapolation forecaster (nowcasting).
+    The latest grid (e.g. Tb or dBZ) is advected by the optical flow field (see
+    tathu.tracking.descriptors.computeOpticalFlow) using semi-Lagrangian steps
+    (cv2.remap), i.e. field(t + dt, x) = field(t, x - v(x) * dt). Lead times are
+    computed incrementally, each step from the previous one, and the results are
+    yielded one at a time (i.e. only the last field is kept in memory).
+    '''
+    def __init__(self, flow, interval, timestep=None):
+        self.flow = flow         # Optical flow (pixels) between two images separated by interval.
+        self.interval = interval # Time interval (minutes) of the optical flow.
+        self.timestep = timestep if timestep is not None else interval # Advection time step (minutes).
+        self.__buildMaps()
+
+    def forecast(self, image, leadtimes):
+        '''
+        This method yields (lead time, GDAL Dataset) for each given lead time (minutes).
+        Lead times are rounded to multiples of time step.
+        '''
+        # Extract values and validity mask
+        nodata = image.GetRasterBand(1).GetNoDataValue()
+        field = image.ReadAsArray().astype(np.float32)
+        valid = np.ones(field.shape, dtype=np.uint8)
+        if nodata is not None:
+            valid[field == nodata] = 0
+
+        # Replace no-data by nearest valid values (i.e. finite values are interpolated)
+        if 0 < valid.sum() < valid.size:
+            field = fill(field, valid == 0)
+
+        step = 0
+        for leadtime in sorted(leadtimes):
+            # Advect until lead time (incremental). Note: validity mask is advected separately
+            nsteps = int(round(leadtime / self.timestep))
+            while step < nsteps:
+                field = cv2.remap(field, self.mapx, self.mapy, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+                valid = cv2.remap(valid, self.mapx, self.mapy, cv2.INTER_NEAREST, borderMode=cv2.BORDER_REPLICATE)
+                step += 1
+
+            yield leadtime, self.__field2raster(field, valid, image, nodata)
+
+    def detect(self, image, leadtimes, detector, timestamp=None):
+        '''
+        This method runs the given detector on each forecast field and
+        yields (lead time, systems). Systems timestamp is the forecast time.
+        '''
+        for leadtime, forecast in self.forecast(image, leadtimes):
+            systems = detector.detect(forecast)
+            if timestamp is not None:
+                for s in systems:
+                    s.timestamp = timestamp + timedelta(minutes=leadtime)
+            yield leadtime, systems
+
+    def __buildMaps(self):
+        # Displacement of one time step
+        factor = self.timestep / self.interval
+        nlines, ncols = self.flow.shape[:2]
+        x, y = np.meshgrid(np.arange(ncols, dtype=np.float32), np.arange(nlines, dtype=np.float32))
+
+        # Backward (semi-Lagrangian) sampling positions
+        self.mapx = x - self.flow[:,:,0].astype(np.float32) * factor
+        self.mapy = y - self.flow[:,:,1].astype(np.float32) * factor
+
+    def __field2raster(self, field, valid, image, nodata):
+        nlines, ncols = field.shape
+        raster = gdal.GetDriverByName('MEM').Create('', ncols, nlines, 1, gdal.GDT_Float32)
+        raster.SetGeoTransform(image.GetGeoTransform())
+        raster.SetProjection(image.GetProjection())
+
+        # No-data (including values advected from no-data areas)
+        band = raster.GetRasterBand(1)
+        if nodata is None:
+            nodata = -9999.0
+        band.SetNoDataValue(float(nodata))
+        band.WriteArray(np.where(valid == 0, nodata, field))
+
+        return raster
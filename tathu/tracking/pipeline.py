@@ -0,0 +1,342 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+
+from tathu.io import spatialite
+from tathu.tracking.system import LabeledConvectiveSystem
+from tathu.utils import file2timestamp
+
+class Timings(object):
+    '''
+    This class accumulates the elapsed time of each pipeline stage.
+    '''
+    def __init__(self):
+        self.stages = {} # Stage name -> [total seconds, number of calls].
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def add(self, stage, seconds, count=1):
+        total = self.stages.setdefault(stage, [0.0, 0])
+        total[0] += seconds
+        total[1] += count
+
+    def merge(self, stages):
+        for stage, (seconds, count) in stages.items():
+            self.add(stage, seconds, count)
+
+    def report(self):
+        print('== Stage timings ==')
+        for stage, (seconds, count) in self.stages.items():
+            print(':: {}: {:.2f} seconds ({} calls, {:.3f} seconds/call)'.format(stage, seconds, count, seconds/max(count, 1)))
+
+class FrameProcessor(object):
+    '''
+    This class implements the per-frame stages of the tracking pipeline:
+    reader -> detector -> descriptors. It does not depend on previous frames,
+    so it can be executed in parallel. Note: it must be picklable, i.e. the
+    reader, detector and descriptors must be module-level objects.
+    '''
+    def __init__(self, reader, detector, descriptors=[], regex=r'\d{12}', format='%Y%m%d%H%M'):
+        self.reader = reader           # Callable: path -> GDAL Dataset (regular grid).
+        self.detector = detector       # Detector (see tathu.tracking.detectors).
+        self.descriptors = descriptors # List of descriptors: describe(image, systems).
+        self.regex = regex             # File date regex.
+        self.format = format           # File date format.
+
+    def getTimestamp(self, path):
+        return file2timestamp(path, self.regex, self.format)
+
+    def __call__(self, path):
+        '''
+        This method processes the given file. It returns the frame timestamp,
+        the detected and described systems and the timings of each stage.
+        '''
+        timings = Timings()
+
+        # Extract file timestamp
+        timestamp = self.getTimestamp(path)
+
+        # Read
+        with timings.measure('read'):
+            image = self.reader(path)
+
+        # Detect
+        with timings.measure('detect'):
+            systems = self.detector.detect(image)
+
+        # Adjust timestamp
+        for s in systems:
+            s.timestamp = timestamp
+
+        # Describe
+        with timings.measure('describe'):
+            for descriptor in self.descriptors:
+                result = descriptor.describe(image, systems)
+                if result is not None:
+                    systems = result
+
+        return timestamp, systems, timings.stages
+
+class Checkpoint(object):
+    '''
+    This class stores the state of a tracking run (last processed
+    timestamp and file) on a JSON file, written atomically.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        state['timestamp'] = datetime.fromisoformat(state['timestamp'])
+        return state
+
+    def save(self, timestamp, path, nsystems):
+        state = {'timestamp' : timestamp.isoformat(), 'path' : path, 'nsystems' : nsystems}
+        # Write to temporary file and replace (atomic)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+class TrackingPipeline(object):
+    '''
+    This class implements a streaming and resumable tracking pipeline:
+    (reader -> detector -> descriptors) -> tracker -> tracking descriptors -> outputter.
+    After each frame, the outputter is flushed and a checkpoint is saved. When a run is
+    restarted, frames that were already processed are skipped and the tracking continues
+    from the last systems stored on the output (loader.loadLastSystems). If the output is
+    behind the checkpoint (e.g. output failed after checkpoint), frames are re-processed from it.
+    If workers > 0, the per-frame stages of the next frames are executed in a process
+    pool (at most prefetch frames ahead), while tracking is kept sequential.
+    '''
+    def __init__(self, processor, tracker, outputter, descriptors=[], loader=None, attrs=[], checkpoint=None,
+        workers=0, prefetch=None):
+        self.processor = processor     # FrameProcessor (or compatible callable).
+        self.tracker = tracker         # Tracker factory: previous -> tracker object, e.g. partial(OverlapAreaTracker, strategy=s).
+        self.outputter = outputter     # Outputter (see tathu.io).
+        self.descriptors = descriptors # List of tracking descriptors: describe(previous, current).
+        self.loader = loader           # Loader used to resume (see tathu.io.spatialite.Loader).
+        self.attrs = attrs             # Attributes loaded on resume.
+        self.checkpoint = checkpoint   # Checkpoint object.
+        self.workers = workers         # Number of processes used by per-frame stages (0 = main process).
+        self.prefetch = prefetch if prefetch is not None else 2 * workers # Maximum number of frames in flight.
+        self.timings = Timings()
+
+    def run(self, periods):
+        '''
+        This method runs the pipeline for the given periods (lists of files).
+        Each period starts a new tracking sequence.
+        '''
+        # Get resume state
+        resumeTimestamp, resumed = self.__resume()
+        if resumeTimestamp is not None:
+            print(':: Resuming after', resumeTimestamp)
+
+        # Build tasks: (path, initial previous systems or None to keep the current sequence)
+        tasks = []
+        for period in periods:
+            initial, skipped = [], None
+            for path in period:
+                # Skip processed frames
+                if resumeTimestamp is not None:
+                    timestamp = self.processor.getTimestamp(path)
+                    if timestamp <= resumeTimestamp:
+                        # The next frame of this period continues from resumed systems
+                        initial, skipped = resumed or [], timestamp
+                        continue
+                    if skipped is not None and skipped != resumeTimestamp:
+                        print('* Warning: no file at resume timestamp {}. Resumed systems are tracked on {}.'.format(resumeTimestamp, path))
+                tasks.append((path, initial))
+                initial, skipped = None, None
+
+        frames = self.__process(tasks)
+        try:
+            previous = None
+            for (path, initial), result in frames:
+                if initial is not None:
+                    previous = initial
+                previous = self.__step(path, result, previous)
+        finally:
+            frames.close()
+            self.__flush()
+            self.timings.report()
+
+    def __process(self, tasks):
+        # Sequential
+        if self.workers <= 0:
+            for task in tasks:
+                yield task, self.processor(task[0])
+            return
+
+        # Parallel (bounded number of frames in flight)
+        executor = ProcessPoolExecutor(self.workers)
+        try:
+            pending = deque()
+            for task in tasks:
+                pending.append((task, executor.submit(self.processor, task[0])))
+                if len(pending) > self.prefetch:
+                    yield self.__wait(pending)
+            while pending:
+                yield self.__wait(pending)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def __wait(self, pending):
+        task, future = pending.popleft()
+        with self.timings.measure('wait'):
+            result = future.result()
+        return task, result
+
+    def __step(self, path, result, previous):
+        # Result of read, detect and describe
+        timestamp, current, stages = result
+        self.timings.merge(stages)
+
+        print('Tracking systems at:', timestamp, '-', len(current), 'systems')
+
+        if previous:
+            # Let's track!
+            with self.timings.measure('track'):
+                self.tracker(previous).track(current)
+
+            # Tracking descriptors
+            with self.timings.measure('describe-tracking'):
+                for descriptor in self.descriptors:
+                    descriptor.describe(previous, current)
+
+            # Previous systems are now kept only as relationships of current systems.
+            # Release their frame labels and their own relationships (i.e. keep only names).
+            for sys in previous:
+                sys.relationships = [getattr(r, 'name', r) for r in sys.relationships]
+                if isinstance(sys, LabeledConvectiveSystem):
+                    sys.release()
+
+        # Save to output
+        with self.timings.measure('output'):
+            self.outputter.output(current)
+            self.__flush()
+
+        # Save state
+        if self.checkpoint is not None:
+            self.checkpoint.save(timestamp, path, len(current))
+
+        return current
+
+    def __flush(self):
+        if hasattr(self.outputter, 'flush'):
+            self.outputter.flush()
+
+    def __resume(self):
+        # Checkpoint
+        state = None
+        if self.checkpoint is not None:
+            state = self.checkpoint.load()
+        timestamp = state['timestamp'] if state is not None else None
+        nsystems = state.get('nsystems', 0) if state is not None else 0
+
+        # Output (it is the reference, since the checkpoint is saved after output)
+        if self.loader is not None:
+            systems = self.loader.loadLastSystems(self.attrs)
+            last = systems[0].timestamp if systems else None
+            if last is not None and (timestamp is None or last >= timestamp):
+                return last, systems
+            if timestamp is not None and nsystems > 0:
+                # Inconsistent state (e.g. output failed after checkpoint): re-process from output
+                print('* Warning: output is behind checkpoint ({} systems at {}). Resuming after {}.'.format(nsystems, timestamp, last))
+                return last, systems or None
+
+        # Last frame had no systems: a new tracking sequence starts
+        if timestamp is not None and nsystems > 0:
+            print('* Warning: no loader to resume the systems at {}. A new tracking sequence starts.'.format(timestamp))
+
+        return timestamp, []
+
+def runPeriod(factory, shard, period):
+    '''
+    This function runs the tracking pipeline of one period. It is executed by the
+    PeriodScheduler workers (i.e. factory must be picklable).
+    '''
+    factory(shard).run([period])
+    # Mark shard as finished (see PeriodScheduler.merge)
+    open(shard + '.done', 'w').close()
+    return shard
+
+class PeriodScheduler(object):
+    '''
+    This class runs independent periods (see tathu.utils.extractPeriods) concurrently.
+    Each period is tracked by its own pipeline, built by factory (callable: shard -> TrackingPipeline),
+    and written to its own output shard. Periods can also be distributed across nodes,
+    i.e. node k of n processes the periods i where i % n == k. Finally, the shards
+    are merged, in period order, into the final output (see merge()).
+    '''
+    def __init__(self, factory, directory, workers=1):
+        self.factory = factory     # Pipeline factory: shard -> TrackingPipeline.
+        self.directory = directory # Directory of output shards.
+        self.workers = workers     # Number of periods processed concurrently.
+
+    def getShard(self, i):
+        return os.path.join(self.directory, 'period-{:06d}.sqlite'.format(i))
+
+    def run(self, periods, node=0, nnodes=1):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Periods of this node
+        indexes = [i for i, period in enumerate(periods) if period and i % nnodes == node]
+
+        with ProcessPoolExecutor(self.workers) as executor:
+            futures = [executor.submit(runPeriod, self.factory, self.getShard(i), periods[i]) for i in indexes]
+            for future in as_completed(futures):
+                print(':: Period finished:', future.result())
+
+    def merge(self, periods, merger):
+        '''
+        This method merges the shards of the given periods using merger
+        (callable: list of shards -> False on error, e.g. partial(spatialite.merge, database, table)).
+        Merged shards are marked (.merged file), so merge can be called again safely.
+        Merge stops at the first shard that is missing or unfinished (e.g. another node
+        is still running), i.e. shards are always merged in period order.
+        '''
+        for i, period in enumerate(periods):
+            shard = self.getShard(i)
+            if not period or os.path.exists(shard + '.merged'):
+                continue
+            if not os.path.exists(shard + '.done'):
+                print('* Merge stopped: shard not finished:', shard)
+                return False
+            if merger([shard]) is False:
+                raise RuntimeError('Merge of shard failed: ' + shard)
+            open(shard + '.merged', 'w').close()
+        return True
+
+def mergeShards(shards, table, outputter, attrs, chunksize=1000):
+    '''
+    This function copies the systems stored on the given SpatiaLite shards to the given
+    outputter (e.g. tathu.io.pgis.Outputter), keeping the system names (UUIDs).
+    '''
+    for shard in shards:
+        loader = spatialite.Loader(shard, table)
+        for systems in loader.iterate(attrs, chunksize=chunksize):
+            outputter.output(systems)
+        if hasattr(outputter, 'flush'):
+            outputter.flush()
@@ -8,8 +8,12 @@
 
 import sys
 import uuid
+from collections import deque
+from datetime import datetime
 from enum import Enum
 
+import numpy as np
+from osgeo import ogr
 from rtree import index
 
 from tathu.geometry.utils import convert2interleaved, fitEllipse
@@ -43,6 +47,20 @@ class ConvectiveSystem(object):
         self.nodata = None
         self.geotransform = None
 
+    def __getstate__(self):
+        # OGR geometries can not be pickled. Use WKB representation.
+        state = self.__dict__.copy()
+        for key in ('geom', '_geom'):
+            if state.get(key) is not None:
+                state[key] = bytes(state[key].ExportToWkb())
+        return state
+
+    def __setstate__(self, state):
+        for key in ('geom', '_geom'):
+            if state.get(key) is not None:
+                state[key] = ogr.CreateGeometryFromWkb(state[key])
+        self.__dict__.update(state)
+
     def getGeomWKT(self):
         return self.geom.ExportToWkt()
 
@@ -57,24 +75,23 @@ class ConvectiveSystem(object):
         '''
         return convert2interleaved(self.geom.GetEnvelope())
 
+    def getArea(self):
+        return self.geom.GetArea()
+
     def hasGeom(self):
         return self.geom != None
 
     def getRelationshipNames(self):
         names = []
         for r in self.relationships:
-            if r.name != self.name:
-                names.append(str(r.name))
+            # Note: loaded systems (see tathu.io) store only the names
+            name = getattr(r, 'name', r)
+            if name != self.name:
+                names.append(str(name))
         return names
 
     def getRelationshipNamesAsString(self, separator=' '):
-        names = ''
-        for r in self.relationships:
-            if r.name != self.name:
-                names += str(r.name) + separator
-        if names != '':
-            names = names[:-1] # remove last separator
-        return names
+        return separator.join(self.getRelationshipNames())
 
     def getAttrNames(self):
         return list(self.attrs.keys())
@@ -85,6 +102,87 @@ class ConvectiveSystem(object):
     def fitEllipse(self):
         return fitEllipse(self.geom)
 
+class LabeledConvectiveSystem(ConvectiveSystem):
+    '''
+    This class represents a convective system that is kept as a label
+    of a labeled image (see tathu.tracking.utils.LabeledImage).
+    The geometry (polygon) and the layers are built lazily, only when they are requested.
+    Area, extent and centroid are computed directly from the pixels.
+    '''
+    def __init__(self, image, label):
+        self.image = image # Labeled image that contains the system.
+        self.label = label # Label value of the system.
+        super(LabeledConvectiveSystem, self).__init__(None)
+
+    @property
+    def layers(self):
+        # Build pending layers, if any
+        for key, (image, labels) in self._pending.items():
+            self._layers[key] = image.polygonizeLabels(labels)
+        self._pending.clear()
+        return self._layers
+
+    @layers.setter
+    def layers(self, layers):
+        self._layers = layers
+        self._pending = {} # Layers not polygonized yet: key -> (labeled image, labels).
+
+    def addLabeledLayer(self, key, image, labels):
+        '''
+        This method associates a layer, given by labels of a labeled image
+        (see tathu.tracking.utils.LabeledImage). Its geometry is built lazily.
+        '''
+        self._pending[key] = (image, labels)
+
+    def release(self):
+        '''
+        This method releases the labeled image of the whole frame, keeping only
+        the bounding box of the system (and of its pending layers). It should be
+        called when the system is no longer tracked on the frame grid, e.g. it is
+        only kept as a relationship of the next frame systems.
+        '''
+        self.image = self.image.crop([self.label])
+        self.label = 1
+        for key, (image, labels) in self._pending.items():
+            self._pending[key] = (image.crop(labels), list(range(1, len(labels) + 1)))
+
+    @property
+    def geom(self):
+        if self._geom is None:
+            self._geom = self.image.polygonize(self.label)
+        return self._geom
+
+    @geom.setter
+    def geom(self, geom):
+        self._geom = geom
+
+    def getCentroid(self):
+        if self._geom is not None:
+            return super(LabeledConvectiveSystem, self).getCentroid()
+        return self.image.getCentroid(self.label)
+
+    def getMBR(self):
+        if self._geom is not None:
+            return super(LabeledConvectiveSystem, self).getMBR()
+        return self.image.getEnvelope(self.label)
+
+    def getArea(self):
+        if self._geom is not None:
+            return super(LabeledConvectiveSystem, self).getArea()
+        return self.image.getArea(self.label)
+
+    def getPixelCount(self):
+        return self.image.getCount(self.label)
+
+    def getSlice(self):
+        return self.image.getSlice(self.label)
+
+    def getMask(self):
+        return self.image.getMask(self.label)
+
+    def hasGeom(self):
+        return True
+
 class ConvectiveSystemFamily(object):
     '''
     This class represents a convective system family,
@@ -156,23 +254,33 @@ class ConvectiveSystemFamily(object):
         # Update ury
         self.__extent[3] = max(self.__extent[3], e[3])
 
+def getEnvelopes(systems):
+    '''
+    This function returns a NumPy array (N x 4) with the interleaved
+    extent (llx, lly, urx, ury) of each given system.
+    '''
+    envelopes = np.empty((len(systems), 4), dtype=np.float64)
+    for i, s in enumerate(systems):
+        envelopes[i] = s.getMBR()
+    return envelopes
+
 class ConvectiveSystemManager(object):
     '''
     This class implements a manager for convective systems objects.
     '''
     def __init__(self, systems):
         self.systems = systems
-        self.rtree = index.Index()
+        self.rtree = None
         self.__build()
 
-    def getSystemsFromSystem(self, system):
-        return self.getSystemsFromGeom(system.geom)
+    def getSystemsFromSystem(self, system, frame=None):
+        return self.getSystemsFromGeom(system.geom, frame)
 
-    def getSystemsFromGeom(self, geom):
+    def getSystemsFromGeom(self, geom, frame=None):
         # Get geometry extent
         e = convert2interleaved(geom.GetEnvelope())
         # Retrieve candidates (using geometry MBR)
-        candidates = self.getSystemsFromExtent(e)
+        candidates = self.getSystemsFromExtent(e, frame)
         # Final result: i.e. refine candidates (using intersector operator)
         result = []
         for c in candidates:
@@ -181,9 +289,10 @@ class ConvectiveSystemManager(object):
 
         return result
 
-    def getSystemsFromExtent(self, e):
+    def getSystemsFromExtent(self, e, frame=None):
+        # Note: frame is only used by RollingConvectiveSystemManager
         # Search r-tree index
-        hits = list(self.rtree.intersection(e, objects='raw'))
+        hits = list(self.rtree.intersection(e))
         # Retrieve found systems
         result = []
         for i in hits:
@@ -192,8 +301,276 @@ class ConvectiveSystemManager(object):
         return result
 
     def __build(self):
-        i = 0
-        # Indexing convective systems using r-tree
-        for s in self.systems:
-            self.rtree.insert(i, s.getMBR(), obj=i)
-            i += 1
+        # Empty stream is not allowed by rtree
+        if len(self.systems) == 0:
+            self.rtree = index.Index()
+            return
+
+        # Indexing convective systems using r-tree (bulk loading)
+        envelopes = getEnvelopes(self.systems)
+        ids = np.arange(len(self.systems), dtype=np.int64)
+        self.rtree = index.Index((ids, envelopes[:,:2], envelopes[:,2:]))
+
+class RollingConvectiveSystemManager(ConvectiveSystemManager):
+    '''
+    This class implements a manager that keeps the systems of the last N
+    frames (time steps) indexed. When a new frame is pushed, the systems of
+    the expired frame are deleted from the index and the new ones are inserted,
+    i.e. the index is not rebuilt at each time step.
+    '''
+    def __init__(self, size=1, systems=None):
+        self.size = size     # Number of frames kept on the index.
+        self.frames = deque() # Identifiers of the systems of each frame.
+        self.systems = {}     # Identifier -> system.
+        self.envelopes = {}   # Identifier -> interleaved extent.
+        self.rtree = index.Index()
+        self.__nextId = 0
+        if systems is not None:
+            self.push(systems)
+
+    def push(self, systems):
+        '''
+        This method adds the given systems as the latest frame.
+        The oldest frame is expired, if necessary.
+        '''
+        # Expire oldest frames
+        while len(self.frames) >= self.size:
+            self.__expire(self.frames.popleft())
+
+        # Insert new frame
+        envelopes = getEnvelopes(systems)
+        ids = []
+        for s, e in zip(systems, envelopes):
+            key = self.__nextId
+            self.__nextId += 1
+            e = tuple(e)
+            self.rtree.insert(key, e)
+            self.systems[key] = s
+            self.envelopes[key] = e
+            ids.append(key)
+        self.frames.append(ids)
+
+    def getFrame(self, frame=-1):
+        '''
+        This method returns the systems of the given frame (-1 = latest).
+        '''
+        return [self.systems[key] for key in self.frames[frame]]
+
+    def getSystemsFromExtent(self, e, frame=None):
+        # Search r-tree index
+        hits = self.rtree.intersection(e)
+
+        # Restrict to the given frame, if requested
+        if frame is not None:
+            hits = set(hits).intersection(self.frames[frame])
+
+        return [self.systems[i] for i in sorted(hits)]
+
+    def __expire(self, ids):
+        for key in ids:
+            self.rtree.delete(key, self.envelopes.pop(key))
+            del self.systems[key]
+
+def uuid2ints(names):
+    '''
+    This function converts a list of UUIDs (or strings) to an array (N x 2) of
+    unsigned 64-bit integers (high, low), i.e. the 128-bit representation.
+    '''
+    result = np.empty((len(names), 2), dtype=np.uint64)
+    for i, name in enumerate(names):
+        value = name.int if isinstance(name, uuid.UUID) else uuid.UUID(str(name)).int
+        result[i] = (value >> 64, value & 0xFFFFFFFFFFFFFFFF)
+    return result
+
+def ints2uuid(value):
+    return uuid.UUID(int=(int(value[0]) << 64) | int(value[1]))
+
+class SystemView(object):
+    '''
+    This class represents a (read-only) view of a system stored on a SystemTable.
+    It behaves like ConvectiveSystem (duck typing), but data is read from the table columns.
+    Note: it does not extend ConvectiveSystem, i.e. views have no instance dict (only slots).
+    '''
+    __slots__ = ('table', 'index')
+
+    # Methods shared with ConvectiveSystem (based on the properties below)
+    getGeomWKT = ConvectiveSystem.getGeomWKT
+    getCentroid = ConvectiveSystem.getCentroid
+    getMBR = ConvectiveSystem.getMBR
+    getArea = ConvectiveSystem.getArea
+    getRelationshipNames = ConvectiveSystem.getRelationshipNames
+    getRelationshipNamesAsString = ConvectiveSystem.getRelationshipNamesAsString
+    getAttrNames = ConvectiveSystem.getAttrNames
+    getConvexHull = ConvectiveSystem.getConvexHull
+    fitEllipse = ConvectiveSystem.fitEllipse
+
+    def __init__(self, table, index):
+        self.table = table # Columnar table.
+        self.index = index # Row index.
+
+    @property
+    def name(self):
+        return ints2uuid(self.table.names[self.index])
+
+    @property
+    def timestamp(self):
+        return self.table.timestamps[self.index].astype(datetime)
+
+    @property
+    def event(self):
+        return LifeCycleEvent(int(self.table.events[self.index]))
+
+    @property
+    def attrs(self):
+        return {name : float(values[self.index]) for name, values in self.table.attrs.items()}
+
+    @property
+    def relationships(self):
+        start, end = self.table.reloffsets[self.index], self.table.reloffsets[self.index + 1]
+        return [ints2uuid(value) for value in self.table.relnames[start:end]]
+
+    @property
+    def wkb(self):
+        # Zero-copy view of geometry (WKB)
+        return self.table.getWKB(self.index)
+
+    @property
+    def geom(self):
+        return ogr.CreateGeometryFromWkb(bytes(self.wkb))
+
+    @property
+    def layers(self):
+        return {}
+
+    @property
+    def raster(self):
+        return None
+
+    @property
+    def nodata(self):
+        return None
+
+    @property
+    def geotransform(self):
+        return None
+
+    def hasGeom(self):
+        return len(self.wkb) > 0
+
+class SystemTable(object):
+    '''
+    This class implements a columnar (struct-of-arrays) representation of
+    a set of convective systems, useful to handle a large number of systems
+    (e.g. climatology). Names are stored as 128-bit integers (two uint64 columns),
+    timestamps as datetime64, events as int8 codes, attributes as float arrays and
+    geometries as a WKB buffer with offsets. Rasters are not stored.
+    Rows can be accessed using views (see SystemView).
+    '''
+    def __init__(self, names, timestamps, events, attrs, wkb, offsets, relnames, reloffsets):
+        self.names = names           # Array (N x 2) of uint64.
+        self.timestamps = timestamps # Array (N) of datetime64[s].
+        self.events = events         # Array (N) of int8 (LifeCycleEvent value).
+        self.attrs = attrs           # Dict: attribute name -> array (N) of float64.
+        self.wkb = wkb               # Buffer (uint8) with the WKB of all geometries.
+        self.offsets = offsets       # Array (N + 1) of int64, i.e. WKB of row i is wkb[offsets[i]:offsets[i + 1]].
+        self.relnames = relnames     # Array (M x 2) of uint64 with the relationships names.
+        self.reloffsets = reloffsets # Array (N + 1) of int64 (relationships of each row).
+
+    @classmethod
+    def fromRecords(cls, names, timestamps, events, attrs, geoms, relationships):
+        '''
+        This method builds a table from column lists: names (UUID or str), timestamps (datetime),
+        events (LifeCycleEvent or str), attrs (dict of lists), geoms (WKB bytes) and
+        relationships (list of names for each row).
+        '''
+        # Events
+        codes = np.array([(e if isinstance(e, LifeCycleEvent) else LifeCycleEvent[str(e)]).value for e in events], dtype=np.int8)
+
+        # Geometries
+        lengths = np.array([len(g) for g in geoms], dtype=np.int64)
+        offsets = np.zeros(len(geoms) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        wkb = np.frombuffer(b''.join(geoms), dtype=np.uint8)
+
+        # Relationships
+        reloffsets = np.zeros(len(relationships) + 1, dtype=np.int64)
+        np.cumsum([len(r) for r in relationships], out=reloffsets[1:])
+        relnames = uuid2ints([name for r in relationships for name in r])
+
+        return cls(uuid2ints(names), np.array(timestamps, dtype='datetime64[s]'), codes,
+                   {name : np.asarray(values, dtype=np.float64) for name, values in attrs.items()},
+                   wkb, offsets, relnames, reloffsets)
+
+    @classmethod
+    def fromSystems(cls, systems, attrs):
+        '''
+        This method builds a table from ConvectiveSystem objects.
+        '''
+        return cls.fromRecords([s.name for s in systems],
+                               [s.timestamp for s in systems],
+                               [s.event for s in systems],
+                               {name : [s.attrs[name] for s in systems] for name in attrs},
+                               [bytes(s.geom.ExportToWkb()) for s in systems],
+                               [s.getRelationshipNames() for s in systems])
+
+    def toSystems(self):
+        '''
+        This method converts the table to ConvectiveSystem objects.
+        Note: relationships are represented by names (UUID).
+        '''
+        systems = []
+        for view in self:
+            s = ConvectiveSystem(view.geom)
+            s.name = view.name
+            s.timestamp = view.timestamp
+            s.event = view.event
+            s.attrs = view.attrs
+            s.relationships = view.relationships
+            systems.append(s)
+        return systems
+
+    def toGeoPandas(self):
+        from tathu.io.dataframe import table2geopandas
+        return table2geopandas(self)
+
+    def getWKB(self, i):
+        return memoryview(self.wkb[self.offsets[i]:self.offsets[i + 1]])
+
+    def getNames(self):
+        return [ints2uuid(value) for value in self.names]
+
+    def select(self, rows):
+        '''
+        This method returns a new table with the given rows (indexes or boolean mask).
+        '''
+        rows = np.arange(len(self))[rows]
+
+        # Geometries
+        lengths = self.offsets[rows + 1] - self.offsets[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        wkb = np.concatenate([self.wkb[self.offsets[i]:self.offsets[i + 1]] for i in rows]) if len(rows) else self.wkb[:0]
+
+        # Relationships
+        rellengths = self.reloffsets[rows + 1] - self.reloffsets[rows]
+        reloffsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(rellengths, out=reloffsets[1:])
+        relnames = np.concatenate([self.relnames[self.reloffsets[i]:self.reloffsets[i + 1]] for i in rows]) if len(rows) else self.relnames[:0]
+
+        return SystemTable(self.names[rows], self.timestamps[rows], self.events[rows],
+                           {name : values[rows] for name, values in self.attrs.items()},
+                           wkb, offsets, relnames, reloffsets)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return SystemView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield SystemView(self, i)
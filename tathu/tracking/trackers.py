@@ -6,7 +6,16 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 #
 
-from tathu.tracking.system import ConvectiveSystemManager, LifeCycleEvent
+import numpy as np
+from scipy import sparse
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse.csgraph import connected_components
+
+from tathu.geometry import transform
+from tathu.tracking.descriptors import computeMedianFlow
+from tathu.tracking.system import (ConvectiveSystem, ConvectiveSystemManager,
+                                   LabeledConvectiveSystem, LifeCycleEvent)
+from tathu.tracking.utils import LabeledImage
 
 ### @begin-Overlap area strategies. ###
 
@@ -21,6 +30,14 @@ class OverlapAreaStrategy:
     def hasRelationship(self, current_system, previous_system):
         raise NotImplementedError
 
+    def evaluate(self, intersection, currentArea, previousArea):
+        '''
+        Vectorized version of hasRelationship(). It receives arrays with the
+        intersection areas and the areas of current and previous systems of
+        each overlapping pair and returns a boolean array.
+        '''
+        raise NotImplementedError
+
 class AbsoluteOverlapAreaStrategy(OverlapAreaStrategy):
     '''Absolute value strategy: it computes the intersection area
        and compares with the given area threshold.'''
@@ -42,6 +59,9 @@ class AbsoluteOverlapAreaStrategy(OverlapAreaStrategy):
 
         return False
 
+    def evaluate(self, intersection, currentArea, previousArea):
+        return intersection > self.threshold
+
 class RelativeOverlapAreaStrategy(OverlapAreaStrategy):
     ''''Relative value strategy: it computes the intersection area and
         compares with the area of current system using percent relation.'''
@@ -69,6 +89,9 @@ class RelativeOverlapAreaStrategy(OverlapAreaStrategy):
 
         return False
 
+    def evaluate(self, intersection, currentArea, previousArea):
+        return (intersection / currentArea) > self.threshold
+
 class TitanStrategy(OverlapAreaStrategy):
     ''' TITAN Strategy: Thunderstorm Identification, Tracking, Analysis and Nowcasting.
         More info: http://www.rap.ucar.edu/projects/titan/home/storm_tracking.php'''
@@ -101,6 +124,9 @@ class TitanStrategy(OverlapAreaStrategy):
 
         return False
 
+    def evaluate(self, intersection, currentArea, previousArea):
+        return (intersection / previousArea + intersection / currentArea) >= self.threshold
+
 class IntersectsStrategy(OverlapAreaStrategy):
     def __init__(self):
         pass
@@ -108,6 +134,9 @@ class IntersectsStrategy(OverlapAreaStrategy):
     def hasRelationship(self, current_system, previous_system):
         return True
 
+    def evaluate(self, intersection, currentArea, previousArea):
+        return intersection > 0
+
 ### @end-Overlap area strategies. ###
 
 ### @begin-System picker strategies. ###
@@ -115,7 +144,7 @@ class IntersectsStrategy(OverlapAreaStrategy):
 def pick_system_by_max_area(systems):
     choosen, maxarea = None, 0.0
     for system in systems:
-        area = system.geom.GetArea()
+        area = system.getArea()
         if area > maxarea:
             choosen, maxarea = system, area
     return choosen
@@ -133,30 +162,37 @@ def pick_system_by_max_intensity(systems):
 class OverlapAreaTracker(object):
     '''
     This class implements a convective system tracker that uses the overlap area criterion.
+    Optionally, it can use a persistent manager (e.g. RollingConvectiveSystemManager)
+    that already indexes the previous systems as its latest frame.
     '''
-    def __init__(self, previous, strategy, picker=pick_system_by_max_area):
+    def __init__(self, previous, strategy, picker=pick_system_by_max_area, manager=None):
         self.previous = previous # Set of previous systems at time.
         self.strategy = strategy # The overlap area strategy that will be used.
         self.picker = picker     # System picker strategy that will be used.
+        self.manager = manager   # Manager that indexes the previous systems.
 
     def track(self, current):
-        # Indexing previous convective cells
-        manager = ConvectiveSystemManager(self.previous)
+        # Find previous systems related to each current system
+        self.findRelationships(current)
 
-        # Candidates to SPLIT (previous system name -> current system)
-        splits = {}
-
-        # Merge (current system name -> previous system)
-        merges = {}
+        # Classify life-cycle events and assign identifiers
+        self.classify(current)
 
-        # Merged systems
-        merged = {}
+    def findRelationships(self, current):
+        '''
+        This method fills the relationships attribute of each current system,
+        i.e. the list of previous systems that satisfy the overlap strategy.
+        '''
+        # Indexing previous convective cells
+        manager = self.manager
+        if manager is None:
+            manager = ConvectiveSystemManager(self.previous)
 
         # For each current system
         for sys in current:
 
-            # Get previous systems that overlaps the current system
-            overlaps = manager.getSystemsFromSystem(sys)
+            # Get previous systems that overlaps the current system (latest frame)
+            overlaps = manager.getSystemsFromSystem(sys, -1)
 
             # Used to store the relationships for each system
             relationships = []
@@ -169,6 +205,24 @@ class OverlapAreaTracker(object):
             # Store relationships for current system
             sys.relationships = relationships
 
+    def classify(self, current):
+        '''
+        This method classifies the life-cycle event of each current system
+        based on its relationships and assigns the systems identifiers.
+        '''
+        # Candidates to SPLIT (previous system name -> current system)
+        splits = {}
+
+        # Merge (current system name -> previous system)
+        merges = {}
+
+        # Merged systems
+        merged = {}
+
+        # For each current system
+        for sys in current:
+            relationships = sys.relationships
+
             ### Classify life-cycle event ###
 
             # case len(relationships) == 0 -> It is SPONTANEOUS_GENERATION
@@ -236,7 +290,7 @@ class OverlapAreaTracker(object):
                 choosen = 0
                 maxarea = 0.0
                 for i in range(0, len(systems)):
-                    area = systems[i].geom.GetArea()
+                    area = systems[i].getArea()
                     if area > maxarea:
                         choosen = i
                         maxarea = area
@@ -254,3 +308,356 @@ class OverlapAreaTracker(object):
     def __getIdentifier(self, relations):
         choosen = self.picker(relations)
         return choosen.name
+
+def getLabeledImage(systems):
+    '''
+    This function returns the labeled image shared by the given systems
+    (see tathu.tracking.system.LabeledConvectiveSystem) or None, if the
+    systems are not labeled or do not share the same labeled image.
+    '''
+    labels = None
+    for sys in systems:
+        if not isinstance(sys, LabeledConvectiveSystem):
+            return None
+        if labels is None:
+            labels = sys.image
+        elif sys.image is not labels:
+            return None
+    return labels
+
+class LabelOverlapTracker(OverlapAreaTracker):
+    '''
+    This class implements the overlap area tracker on pixel domain. Previous
+    and current systems must be labeled systems (e.g. detected using lazy=True)
+    on the same grid. All pairwise overlap areas are computed at once, using
+    a sparse co-occurrence matrix of (current label, previous label), and the
+    overlap area strategy is evaluated as a vectorized predicate on it.
+    If the systems are not labeled, it falls back to the polygon-based tracker.
+    '''
+    def __init__(self, previous, strategy, picker=pick_system_by_max_area, manager=None):
+        super(LabelOverlapTracker, self).__init__(previous, strategy, picker, manager)
+        self.cooccurrence = None # Co-occurrence matrix of the last tracking.
+        self.pixelArea = None    # Pixel area of the labeled images.
+
+    def findRelationships(self, current):
+        # Get labeled images
+        previousImage = getLabeledImage(self.previous)
+        currentImage = getLabeledImage(current)
+
+        # Verify grid
+        if not self.__isCompatible(previousImage, currentImage):
+            self.cooccurrence, self.pixelArea = None, None
+            return super(LabelOverlapTracker, self).findRelationships(current)
+
+        # Build co-occurrence matrix
+        cooccurrence = self.__buildCooccurrence(previousImage, currentImage)
+        self.cooccurrence, self.pixelArea = cooccurrence, currentImage.getPixelArea()
+
+        # Expand row (current label) and column (previous label) of each non-zero entry
+        rows = np.repeat(np.arange(cooccurrence.shape[0]), np.diff(cooccurrence.indptr))
+        cols = cooccurrence.indices
+
+        # Compute areas
+        pixelArea = currentImage.getPixelArea()
+        intersection = cooccurrence.data * pixelArea
+        currentArea = currentImage.counts[rows] * pixelArea
+        previousArea = previousImage.counts[cols] * pixelArea
+
+        # Previous label -> index of previous system (-1 = not available)
+        lookup = np.full(previousImage.nobjects + 1, -1, dtype=np.int64)
+        for i, sys in enumerate(self.previous):
+            lookup[sys.label] = i
+
+        # Evaluate strategy
+        related = self.strategy.evaluate(intersection, currentArea, previousArea)
+        related &= lookup[cols] >= 0
+
+        # For each current system
+        for sys in current:
+            start, end = cooccurrence.indptr[sys.label], cooccurrence.indptr[sys.label + 1]
+            labels = cols[start:end][related[start:end]]
+            sys.relationships = [self.previous[i] for i in lookup[labels]]
+
+    def getOverlapArea(self, current_system, previous_system):
+        '''
+        This method returns the overlap area between the given systems. It uses
+        the co-occurrence matrix, if available. Otherwise, polygon intersection.
+        '''
+        if self.cooccurrence is not None:
+            return self.cooccurrence[current_system.label, previous_system.label] * self.pixelArea
+        intersection = self.strategy.hasIntersection(current_system, previous_system)
+        if intersection is False:
+            return 0.0
+        return intersection.GetArea()
+
+    def __isCompatible(self, previousImage, currentImage):
+        if previousImage is None or currentImage is None:
+            return False
+        if previousImage.labels.shape != currentImage.labels.shape:
+            return False
+        return np.allclose(previousImage.geotransform, currentImage.geotransform)
+
+    def __buildCooccurrence(self, previousImage, currentImage):
+        # Pixels that belong to systems on both times
+        mask = (previousImage.labels > 0) & (currentImage.labels > 0)
+
+        # Sparse matrix of overlap pixel counts (duplicated entries are summed)
+        values = np.ones(np.count_nonzero(mask), dtype=np.int64)
+        shape = (currentImage.nobjects + 1, previousImage.nobjects + 1)
+        cooccurrence = sparse.csr_matrix((values, (currentImage.labels[mask], previousImage.labels[mask])), shape=shape)
+        cooccurrence.sum_duplicates()
+
+        return cooccurrence
+
+class AssignmentTracker(LabelOverlapTracker):
+    '''
+    This class implements a convective system tracker that solves the
+    previous-current association globally, instead of greedily. The candidate
+    pairs are given by the overlap area strategy. Each pair has a cost computed
+    from the overlap, the centroid distance and the area ratio, and the optimal
+    assignment is solved (scipy.optimize.linear_sum_assignment) independently
+    for each connected component of the candidate graph.
+    Current systems that are not assigned start a new life cycle
+    (event SPLIT or MERGE), i.e. no system is discarded.
+    '''
+    def __init__(self, previous, strategy, weights=(1.0, 1.0, 1.0), manager=None):
+        super(AssignmentTracker, self).__init__(previous, strategy, manager=manager)
+        self.weights = weights # Weights of overlap, distance and area ratio costs.
+
+    def classify(self, current):
+        # Previous system -> index
+        indexes = {id(p): i for i, p in enumerate(self.previous)}
+
+        # Build candidate pairs (current index, previous index)
+        pairs = [(i, indexes[id(p)]) for i, sys in enumerate(current) for p in sys.relationships]
+        if not pairs:
+            return
+        pairs = np.array(pairs, dtype=np.int64)
+
+        # Number of current systems related only to each previous system (SPLIT candidates),
+        # i.e. as OverlapAreaTracker.classify, current systems classified as MERGE are not counted
+        single = [indexes[id(sys.relationships[0])] for sys in current if len(sys.relationships) == 1]
+        nsplits = np.bincount(np.array(single, dtype=np.int64), minlength=len(self.previous))
+
+        # Compute cost of each candidate pair
+        costs = np.array([self.__computeCost(current[i], self.previous[j]) for i, j in pairs])
+
+        # Find connected components of the bipartite graph (current nodes first)
+        n = len(current) + len(self.previous)
+        graph = sparse.coo_matrix((np.ones(len(pairs)), (pairs[:,0], pairs[:,1] + len(current))), shape=(n, n))
+        ncomponents, components = connected_components(graph, directed=False)
+
+        # Group pairs by component
+        order = np.argsort(components[pairs[:,0]], kind='stable')
+        bounds = np.cumsum(np.bincount(components[pairs[:,0]], minlength=ncomponents))
+
+        # Solve the assignment of each component
+        assigned = {}
+        start = 0
+        for end in bounds:
+            group = order[start:end]
+            start = end
+            if len(group) == 0:
+                continue
+            assigned.update(self.__solve(pairs[group], costs[group]))
+
+        # Classify life-cycle event and assign identifiers
+        for i, sys in enumerate(current):
+            if not sys.relationships:
+                continue # It is SPONTANEOUS_GENERATION
+            if len(sys.relationships) >= 2:
+                sys.event = LifeCycleEvent.MERGE
+            elif nsplits[indexes[id(sys.relationships[0])]] >= 2 or i not in assigned:
+                # Note: not assigned, i.e. the previous identity continues on other system
+                sys.event = LifeCycleEvent.SPLIT
+            else:
+                sys.event = LifeCycleEvent.CONTINUITY
+            # Baptized!
+            if i in assigned:
+                sys.name = self.previous[assigned[i]].name
+
+    def __solve(self, pairs, costs):
+        # Local indexes
+        rows, rowIndexes = np.unique(pairs[:,0], return_inverse=True)
+        cols, colIndexes = np.unique(pairs[:,1], return_inverse=True)
+
+        # Dense cost matrix of the component (non-candidate pairs are forbidden)
+        forbidden = costs.max() * len(pairs) + 1.0
+        matrix = np.full((len(rows), len(cols)), forbidden)
+        matrix[rowIndexes, colIndexes] = costs
+
+        # Solve
+        r, c = linear_sum_assignment(matrix)
+        valid = matrix[r, c] < forbidden
+
+        return dict(zip(rows[r[valid]], cols[c[valid]]))
+
+    def __computeCost(self, current_system, previous_system):
+        currentArea, previousArea = current_system.getArea(), previous_system.getArea()
+
+        # Overlap cost (TITAN-like fraction)
+        overlap = self.getOverlapArea(current_system, previous_system)
+        overlapCost = 1.0 - 0.5 * (overlap / currentArea + overlap / previousArea)
+
+        # Distance cost (normalized by systems length scale)
+        c1, c2 = current_system.getCentroid(), previous_system.getCentroid()
+        distance = np.hypot(c1[0] - c2[0], c1[1] - c2[1])
+        distanceCost = distance / (np.sqrt(currentArea) + np.sqrt(previousArea))
+
+        # Area ratio cost
+        areaCost = 1.0 - min(currentArea, previousArea) / max(currentArea, previousArea)
+
+        wo, wd, wa = self.weights
+        return wo * overlapCost + wd * distanceCost + wa * areaCost
+
+class CentroidHistory(object):
+    '''
+    This class keeps the timestamp and centroid of the systems of the last
+    tracked frame, by name. It must be shared by the trackers of consecutive
+    frames (see AdvectedOverlapTracker), i.e. the positions are available even
+    if the relationships are only names (e.g. after a resume) or released.
+    '''
+    def __init__(self):
+        self.positions = {} # Name -> (timestamp, (x, y)).
+
+    def get(self, system):
+        # Note: relationships can be systems or names
+        return self.positions.get(str(getattr(system, 'name', system)))
+
+    def update(self, systems):
+        self.positions = {str(sys.name): (sys.timestamp, sys.getCentroid()) for sys in systems}
+
+class AdvectedOverlapTracker(LabelOverlapTracker):
+    '''
+    This class implements a motion-compensated overlap area tracker. Before matching,
+    each previous system is advected to the current time: by its median optical flow,
+    if a flow field (previous -> current, e.g. from OpticalFlowCache) is given; or by
+    its centroid velocity (see forecasters.Conservative), otherwise. It allows to
+    track fast-moving systems and to use longer sampling intervals. The last positions
+    used by centroid velocities are given by history (CentroidHistory), if any, or by
+    the relationships of previous systems.
+    '''
+    def __init__(self, previous, strategy, flow=None, geotransform=None, interval=None, picker=pick_system_by_max_area,
+        history=None):
+        super(AdvectedOverlapTracker, self).__init__(previous, strategy, picker)
+        self.flow = flow                 # Optical flow field (pixel units).
+        self.geotransform = geotransform # Geo-transform of the flow grid (required for non-labeled systems).
+        self.interval = interval         # Minutes between previous and current times.
+        self.history = history           # Last positions (CentroidHistory), shared along the tracking.
+
+    def findRelationships(self, current):
+        # Advect previous systems
+        originals = self.previous
+        self.previous = self.__advect(originals, current)
+
+        # Find relationships using advected systems
+        try:
+            super(AdvectedOverlapTracker, self).findRelationships(current)
+        finally:
+            self.previous = originals
+
+        # Advected system -> original system
+        lookup = {id(a): o for a, o in zip(self.__advected, originals)}
+        for sys in current:
+            sys.relationships = [lookup[id(r)] for r in sys.relationships]
+
+        # Keep positions of previous systems (i.e. last positions for the next frame)
+        if self.history is not None:
+            self.history.update(originals)
+
+    def __advect(self, systems, current):
+        if not systems:
+            self.__advected = []
+            return self.__advected
+
+        # Compute displacement of each system (map units)
+        displacements = self.__computeDisplacements(systems, current)
+
+        # Labeled systems: shift the pixels of each label
+        image = getLabeledImage(systems)
+        if image is not None:
+            self.__advected = self.__advectLabels(image, systems, displacements)
+        else:
+            self.__advected = []
+            for sys, (dx, dy) in zip(systems, displacements):
+                advected = ConvectiveSystem(transform.translate(sys.geom, dx, dy))
+                advected.name = sys.name
+                self.__advected.append(advected)
+
+        return self.__advected
+
+    def __advectLabels(self, image, systems, displacements):
+        gt = image.geotransform
+        labels = np.zeros_like(image.labels)
+        nlines, ncols = labels.shape
+        for sys, (dx, dy) in zip(systems, displacements):
+            # Pixel offsets
+            di, dj = int(round(dy / gt[5])), int(round(dx / gt[1]))
+            rows, cols = sys.getSlice()
+            i, j = np.nonzero(sys.getMask())
+            i, j = i + rows.start + di, j + cols.start + dj
+            # Clip to grid
+            valid = (i >= 0) & (i < nlines) & (j >= 0) & (j < ncols)
+            labels[i[valid], j[valid]] = sys.label
+
+        advected = LabeledImage(labels, image.nobjects, gt, image.srs)
+        return [LabeledConvectiveSystem(advected, sys.label) for sys in systems]
+
+    def __computeDisplacements(self, systems, current):
+        # Optical flow: median flow of each system (pixels -> map units)
+        if self.flow is not None:
+            gt = self.geotransform
+            if gt is None:
+                image = getLabeledImage(systems)
+                if image is None:
+                    raise ValueError('AdvectedOverlapTracker: geotransform of the flow grid is required for non-labeled systems.')
+                gt = image.geotransform
+            flow = computeMedianFlow(self.flow, gt, systems)
+            return np.column_stack((flow[:,0] * gt[1], flow[:,1] * gt[5]))
+
+        # Centroid velocity: based on the last position of previous systems
+        displacements = np.zeros((len(systems), 2))
+        interval = self.__getInterval(systems, current)
+        for k, sys in enumerate(systems):
+            last = self.__getLastPosition(sys)
+            if last is None or sys.timestamp is None or last[0] is None:
+                continue
+            elapsedtime = abs((sys.timestamp - last[0]).total_seconds() / 60)
+            if elapsedtime == 0.0:
+                continue
+            # Note: getCentroid() does not polygonize labeled systems
+            x, y = sys.getCentroid()
+            dx, dy = (x - last[1][0]) / elapsedtime, (y - last[1][1]) / elapsedtime
+            displacements[k] = (dx * interval, dy * interval)
+
+        return displacements
+
+    def __getLastPosition(self, sys):
+        # Position (timestamp, centroid) of each relationship: from history or from the related system
+        positions = []
+        for r in sys.relationships:
+            position = self.history.get(r) if self.history is not None else None
+            if position is None and hasattr(r, 'getCentroid'):
+                position = (r.timestamp, r.getCentroid())
+            if position is not None:
+                positions.append(position)
+
+        if not positions:
+            return None
+
+        if len(positions) == 1:
+            return positions[0]
+
+        # Mean centroid (see forecasters.compute_last_centroid)
+        x, y = sys.getCentroid()
+        for timestamp, (rx, ry) in positions:
+            x, y = (x + rx) * 0.5, (y + ry) * 0.5
+
+        return positions[0][0], (x, y)
+
+    def __getInterval(self, systems, current):
+        if self.interval is not None:
+            return self.interval
+        if not systems or not current or systems[0].timestamp is None or current[0].timestamp is None:
+            return 0.0
+        return (current[0].timestamp - systems[0].timestamp).total_seconds() / 60
@@ -6,7 +6,9 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 #
 
+import numpy as np
 from osgeo import gdal, ogr
+from scipy import ndimage
 
 from tathu.constants import KM_PER_DEGREE
 
@@ -39,5 +41,143 @@ def polygonize(image, minArea=None, progress=None):
 
     return polygons
 
+def addPolygons(mgeom, geom):
+    '''
+    This function adds the given polygon to the multi-polygon mgeom. If geom is
+    a multi-polygon (e.g. polygon fixed by Buffer(0)), each part is added.
+    '''
+    if geom.GetGeometryName() == 'MULTIPOLYGON':
+        for i in range(geom.GetGeometryCount()):
+            mgeom.AddGeometry(geom.GetGeometryRef(i))
+    else:
+        mgeom.AddGeometry(geom)
+    return mgeom
+
+class LabeledImage(object):
+    '''
+    This class encapsulates the result of a connected components labeling
+    operation (e.g. ndimage.label) and its geospatial information. It allows
+    to access each labeled object directly on pixel domain, i.e. without
+    the need of vector (polygonize) operations.
+    '''
+    def __init__(self, labels, nobjects, geotransform, srs=None):
+        self.labels = labels             # Labeled array (0 = background).
+        self.nobjects = nobjects         # Number of labeled objects.
+        self.geotransform = geotransform # GDAL geo-transform parameters.
+        self.srs = srs                   # Spatial reference system (WKT).
+        self.slices = ndimage.find_objects(labels, nobjects)
+        self.counts = np.bincount(labels.ravel(), minlength=nobjects + 1)
+
+    def __deepcopy__(self, memo):
+        # Labeled image is shared by all systems. Do not copy it.
+        return self
+
+    def getPixelArea(self):
+        return abs(self.geotransform[1] * self.geotransform[5])
+
+    def getSlice(self, label):
+        return self.slices[label - 1]
+
+    def getCount(self, label):
+        return int(self.counts[label])
+
+    def getArea(self, label):
+        return self.getCount(label) * self.getPixelArea()
+
+    def getMask(self, label):
+        '''
+        This method returns the boolean mask of the given label,
+        limited to its bounding box (see getSlice() method).
+        '''
+        return self.labels[self.getSlice(label)] == label
+
+    def getGeoTransform(self, label):
+        '''
+        This method returns the geo-transform of the given label bounding box.
+        '''
+        rows, cols = self.getSlice(label)
+        gt = self.geotransform
+        return (gt[0] + cols.start * gt[1], gt[1], 0.0,
+                gt[3] + rows.start * gt[5], 0.0, gt[5])
+
+    def getEnvelope(self, label):
+        '''
+        This method returns the extent [llx, lly, urx, ury] of the given label.
+        '''
+        rows, cols = self.getSlice(label)
+        gt = self.geotransform
+        x = (gt[0] + cols.start * gt[1], gt[0] + cols.stop * gt[1])
+        y = (gt[3] + rows.start * gt[5], gt[3] + rows.stop * gt[5])
+        return (min(x), min(y), max(x), max(y))
+
+    def getCentroid(self, label):
+        '''
+        This method returns the centroid of the given label. Note: it is equal
+        to the centroid of polygon built from the label pixels.
+        '''
+        rows, cols = self.getSlice(label)
+        i, j = np.nonzero(self.getMask(label))
+        gt = self.geotransform
+        x = gt[0] + (cols.start + j.mean() + 0.5) * gt[1]
+        y = gt[3] + (rows.start + i.mean() + 0.5) * gt[5]
+        return (x, y)
+
+    def polygonize(self, label):
+        '''
+        This method builds the polygon (OGR Geometry) of the given label.
+        '''
+        mask = self.getMask(label).astype(np.uint8)
+
+        # Create Gdal dataset with label bounding box
+        driver = gdal.GetDriverByName('MEM')
+        image = driver.Create('label', mask.shape[1], mask.shape[0], 1, gdal.GDT_Byte)
+        image.SetGeoTransform(self.getGeoTransform(label))
+        image.GetRasterBand(1).SetNoDataValue(0)
+        image.GetRasterBand(1).WriteArray(mask)
+        image.FlushCache()
+
+        polygons = polygonize(image)
+
+        if len(polygons) == 1:
+            return polygons[0]
+
+        # Unexpected, but keep all parts
+        geom = ogr.Geometry(ogr.wkbMultiPolygon)
+        for p in polygons:
+            addPolygons(geom, p)
+
+        return geom.UnionCascaded()
+
+    def crop(self, labels):
+        '''
+        This method returns a new labeled image, limited to the bounding box of the
+        given labels, that are renumbered as 1, 2, ..., n (other labels are removed).
+        It allows to release the full labeled array when only a few objects are needed.
+        '''
+        # Compute union bounding box
+        slices = [self.getSlice(label) for label in labels]
+        rows = slice(min(s[0].start for s in slices), max(s[0].stop for s in slices))
+        cols = slice(min(s[1].start for s in slices), max(s[1].stop for s in slices))
+
+        # Renumber labels
+        lookup = np.zeros(self.nobjects + 1, dtype=self.labels.dtype)
+        lookup[labels] = np.arange(1, len(labels) + 1)
+        cropped = lookup[self.labels[rows, cols]]
+
+        gt = self.geotransform
+        geotransform = (gt[0] + cols.start * gt[1], gt[1], 0.0,
+                        gt[3] + rows.start * gt[5], 0.0, gt[5])
+
+        return LabeledImage(cropped, len(labels), geotransform, self.srs)
+
+    def polygonizeLabels(self, labels):
+        '''
+        This method builds the multi-polygon (OGR Geometry) of the given labels.
+        '''
+        geom = ogr.Geometry(ogr.wkbMultiPolygon)
+        for label in labels:
+            addPolygons(geom, self.polygonize(label))
+        return geom
+
 def area2degrees(km2):
     return km2/(KM_PER_DEGREE * KM_PER_DEGREE)
@@ -60,6 +60,31 @@ def getExtent(gt, shape):
     ury = gt[3]
     return (llx, lly, urx, ury)
 
+def getWindow(geoT, shape, extent, margin=1):
+    '''
+    This function returns the window (first line, last line + 1, first column, last column + 1)
+    of a regular (non-rotated) grid that covers the given extent, including the given margin (pixels).
+    It returns None if the extent does not intersect the grid.
+    '''
+    cols = np.floor((np.array([extent[0], extent[2]]) - geoT[0]) / geoT[1])
+    lines = np.floor((np.array([extent[3], extent[1]]) - geoT[3]) / geoT[5])
+    line0 = max(int(lines.min()) - margin, 0)
+    line1 = min(int(lines.max()) + margin + 1, shape[0])
+    col0 = max(int(cols.min()) - margin, 0)
+    col1 = min(int(cols.max()) + margin + 1, shape[1])
+    if line0 >= line1 or col0 >= col1:
+        return None
+    return line0, line1, col0, col1
+
+def getWindowGeoT(geoT, window):
+    '''
+    This function returns the geo-transform of the given window
+    (first line, last line + 1, first column, last column + 1).
+    '''
+    line0, line1, col0, col1 = window
+    return [geoT[0] + col0 * geoT[1] + line0 * geoT[2], geoT[1], geoT[2],
+            geoT[3] + col0 * geoT[4] + line0 * geoT[5], geoT[4], geoT[5]]
+
 def generateListOfDays(start, end):
     '''This function returns all-days between given two dates.'''
     delta = end - start
@@ -78,13 +103,13 @@ def extractPeriods(files, timeout, regex='\d{12}', format='%Y%m%d%H%M'):
         # Compute elapsed time
         elapsed_time = current_time - previous_time
 
-        if elapsed_time.seconds > timeout * 60:
+        # Gap: close current period. Current file starts the next one.
+        if elapsed_time.total_seconds() > timeout * 60:
             result.append(period)
             period = []
-            previous_time = None
-        else:
-            period.append(path)
-            previous_time = current_time
+
+        period.append(path)
+        previous_time = current_time
 
     result.append(period)
 
@@ -135,6 +160,81 @@ def array2raster(array, extent, srs=LAT_LON_WGS84, nodata=None, output='', drive
 
     return raster
 
+def array2dataset(array, geoT, srs=LAT_LON_WGS84, nodata=None):
+    '''
+    This function wraps the given array as a GDAL Dataset, without copy (see gdal_array.OpenArray),
+    i.e. the dataset reads from (and writes to) the array memory.
+    '''
+    raster = gdal_array.OpenArray(np.ascontiguousarray(array))
+    raster.SetGeoTransform(geoT)
+    if nodata is not None:
+        raster.GetRasterBand(1).SetNoDataValue(float(nodata))
+    if srs is not None:
+        raster.SetProjection(srs.ExportToWkt())
+    return raster
+
+def applyScaleOffset(array, scale, offset, nodata=None, out=None):
+    '''
+    This function applies scale and offset (array * scale + offset) without temporary arrays,
+    writing to out (default: array itself, in-place). Values equal to nodata are not scaled
+    and are kept as nodata on out. out (or array, if out is None) must be a floating point array,
+    i.e. integer results would be silently truncated.
+    '''
+    if out is None:
+        out = array
+
+    if not np.issubdtype(out.dtype, np.floating):
+        raise TypeError('applyScaleOffset requires a floating point output array, got ' + str(out.dtype))
+
+    # Valid values
+    valid = True
+    if nodata is not None:
+        valid = np.not_equal(array, nodata)
+
+    # Apply scale and offset
+    np.multiply(array, scale, out=out, where=valid, casting='unsafe')
+    np.add(out, offset, out=out, where=valid, casting='unsafe')
+
+    # Keep no-data
+    if nodata is not None and out is not array:
+        np.copyto(out, nodata, where=np.logical_not(valid, out=valid), casting='unsafe')
+
+    return out
+
+class BufferPool(object):
+    '''
+    This class keeps rings of preallocated arrays (one ring for each shape and data type)
+    that are reused across frames, i.e. an array returned by get() is overwritten after
+    size calls with the same shape and data type. The default size (2) keeps the previous
+    frame valid (e.g. optical flow, advection).
+    '''
+    def __init__(self, size=2):
+        self.size = size  # Number of buffers of each ring.
+        self.buffers = {} # (shape, dtype) -> [preallocated arrays, index of next array].
+
+    def __getstate__(self):
+        # Do not pickle buffers (e.g. pool sent to other processes)
+        state = self.__dict__.copy()
+        state['buffers'] = {}
+        return state
+
+    def get(self, shape, dtype=np.float32):
+        key = (tuple(shape), np.dtype(dtype))
+        ring = self.buffers.setdefault(key, [[], 0])
+        arrays, index = ring
+        if index == len(arrays):
+            arrays.append(np.empty(*key))
+        ring[1] = (index + 1) % self.size
+        return arrays[index]
+
+def getBuffer(buffers, shape, dtype=np.float32):
+    '''
+    This function returns an array from the given BufferPool or a new array, if buffers is None.
+    '''
+    if buffers is None:
+        return np.empty(shape, dtype)
+    return buffers.get(shape, dtype)
+
 def getGeoInfoFromCTL(path):
     '''
     This function try extract grid geospatial information from a CTL file.
@@ -0,0 +1,97 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.binary."""
+
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+from tathu.binary import GZipCache, binary2raster, read, readGZ
+from tathu.utils import BufferPool, getGeoT, getWindowGeoT
+
+NLINES, NCOLS = 6, 8
+
+def create_array(value=0):
+    """Create a test array (int16)."""
+    return np.arange(NLINES * NCOLS, dtype=np.int16).reshape(NLINES, NCOLS) + value
+
+def write_binary(path, array, compress=False):
+    """Write the given array as a raw binary file (optionally, gzip compressed)."""
+    open_ = gzip.open if compress else open
+    with open_(str(path), 'wb') as f:
+        f.write(array.tobytes())
+    return str(path)
+
+def test_read_raw_window(tmp_path):
+    """Raw files must be memory-mapped and the window must select lines and columns."""
+    array = create_array()
+    path = write_binary(tmp_path / 'image.bin', array)
+
+    result = read(path, NLINES, NCOLS, np.int16)
+    assert isinstance(result, np.memmap)
+    assert not result.flags.writeable
+    np.testing.assert_array_equal(result, array)
+
+    window = (1, 4, 2, 7)
+    np.testing.assert_array_equal(read(path, NLINES, NCOLS, np.int16, window), array[1:4, 2:7])
+
+def test_read_gzip(tmp_path):
+    """Compressed files must be decompressed into the given preallocated array."""
+    array = create_array()
+    path = write_binary(tmp_path / 'image.bin.gz', array, compress=True)
+
+    out = np.empty((NLINES, NCOLS), dtype=np.int16)
+    result = readGZ(path, NLINES, NCOLS, np.int16, out)
+    assert result is out
+    np.testing.assert_array_equal(result, array)
+
+    window = (2, 5, 0, 3)
+    np.testing.assert_array_equal(read(path, NLINES, NCOLS, np.int16, window), array[2:5, 0:3])
+
+def test_read_gzip_truncated(tmp_path):
+    """Truncated compressed files must be rejected."""
+    path = write_binary(tmp_path / 'image.bin.gz', create_array()[:-1], compress=True)
+
+    with pytest.raises(ValueError):
+        read(path, NLINES, NCOLS, np.int16)
+
+def test_gzip_cache(tmp_path):
+    """Files with the same name on different directories must not collide on cache."""
+    cache = GZipCache(str(tmp_path / 'cache'))
+
+    paths = []
+    for i, directory in enumerate(['a', 'b']):
+        os.makedirs(str(tmp_path / directory))
+        paths.append(write_binary(tmp_path / directory / 'image.bin.gz', create_array(i * 100), compress=True))
+
+    for i, path in enumerate(paths):
+        np.testing.assert_array_equal(read(path, NLINES, NCOLS, np.int16, cache=cache), create_array(i * 100))
+
+    # Decompressed only once
+    cached = cache.get(paths[0])
+    mtime = os.path.getmtime(cached)
+    assert cache.get(paths[0]) == cached
+    assert os.path.getmtime(cached) == mtime
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 2
+
+def test_binary2raster_roi(tmp_path):
+    """Only the window that covers the region of interest must be read and scaled."""
+    array = create_array()
+    path = write_binary(tmp_path / 'image.bin', array)
+    extent = [0.0, 0.0, float(NCOLS), float(NLINES)]
+
+    buffers = BufferPool()
+    raster = binary2raster(path, extent, NLINES, NCOLS, np.int16, np.float32, scale=0.5, offset=1.0,
+                           buffers=buffers, roi=[2.5, 2.5, 4.5, 3.5])
+
+    window = (1, 5, 1, 6) # Including margin of one pixel
+    np.testing.assert_allclose(raster.ReadAsArray(), array[1:5, 1:6] * 0.5 + 1.0)
+    np.testing.assert_allclose(raster.GetGeoTransform(), getWindowGeoT(getGeoT(extent, NLINES, NCOLS), window))
@@ -0,0 +1,119 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.tracking.descriptors."""
+
+import os
+
+import numpy as np
+import pytest
+from affine import Affine
+from rasterstats import zonal_stats
+
+from tathu.tracking.descriptors import (StatisticalDescriptor,
+                                        StatisticalDescriptorMT,
+                                        labeled_zonal_stats)
+from tathu.tracking.detectors import LessThan
+from tathu.tracking.system import ConvectiveSystem
+from tathu.utils import array2raster
+
+NODATA = -1.0
+
+STATS = ['count', 'min', 'max', 'mean', 'sum', 'std', 'median', 'range',
+         'majority', 'minority', 'unique', 'percentile_90', 'nodata']
+
+def create_image():
+    """Create a test image (float32) with three systems (one of them with a no-data pixel)."""
+    rng = np.random.default_rng(0)
+    data = np.full((20, 24), 280.0, dtype=np.float32)
+    data[2:6, 3:9] = rng.integers(200, 230, (4, 6))
+    data[9:16, 4:7] = rng.integers(200, 230, (7, 3))
+    data[13:16, 7:12] = rng.integers(200, 230, (3, 5)) # L-shaped system
+    data[5:12, 15:22] = rng.integers(200, 230, (7, 7))
+    data[8, 18] = NODATA
+    extent = [-50.0, -20.0, -50.0 + 24 * 0.04, -20.0 + 20 * 0.04]
+    return data, array2raster(data, extent, nodata=NODATA)
+
+def mini2grid(raster, geotransform, image):
+    """Place the valid pixels of the given mini-raster on the full image grid (NaN elsewhere)."""
+    gt = image.GetGeoTransform()
+    i0 = int(round((geotransform[3] - gt[3]) / gt[5]))
+    j0 = int(round((geotransform[0] - gt[0]) / gt[1]))
+    grid = np.full((image.RasterYSize, image.RasterXSize), np.nan)
+    window = grid[i0:i0 + raster.shape[0], j0:j0 + raster.shape[1]]
+    window[~np.ma.getmaskarray(raster)] = raster.compressed()
+    return grid
+
+def test_labeled_zonal_stats_equals_rasterstats():
+    """Stats computed from labels must be equal to rasterstats on the polygons built from labels."""
+    data, image = create_image()
+    systems = LessThan(235, lazy=True).detect(image)
+    assert len(systems) == 3
+
+    labels = systems[0].image
+    result = labeled_zonal_stats(labels, [s.label for s in systems], data, STATS, NODATA)
+
+    expected = zonal_stats([s.geom.ExportToWkt() for s in systems], data, stats=STATS,
+                           affine=Affine.from_gdal(*image.GetGeoTransform()), nodata=NODATA)
+
+    assert len(result) == len(expected)
+    for r, e in zip(result, expected):
+        assert r.keys() == e.keys()
+        for stat in STATS:
+            assert r[stat] == pytest.approx(e[stat]), stat
+
+def test_statistical_descriptor_labeled_and_polygons():
+    """StatisticalDescriptor must give the same attributes for labeled systems and for polygons."""
+    data, image = create_image()
+    stats = ['min', 'max', 'mean', 'std', 'count']
+
+    labeled = LessThan(235, lazy=True).detect(image)
+    polygons = [ConvectiveSystem(s.geom) for s in labeled]
+
+    StatisticalDescriptor(stats, rasterOut=True).describe(image, labeled)
+    StatisticalDescriptor(stats, rasterOut=True).describe(image, polygons)
+
+    for l, p in zip(labeled, polygons):
+        for stat in stats:
+            assert l.attrs[stat] == pytest.approx(p.attrs[stat]), stat
+        # Note: rasterstats window may include an extra (masked) line or column
+        np.testing.assert_array_equal(mini2grid(l.raster, l.geotransform, image),
+                                      mini2grid(p.raster, p.geotransform, image))
+
+def list_shared_memory():
+    """List the POSIX shared memory segments created by multiprocessing (Linux only)."""
+    if not os.path.isdir('/dev/shm'):
+        pytest.skip('/dev/shm is not available')
+    return set(f for f in os.listdir('/dev/shm') if f.startswith('psm_'))
+
+def test_statistical_descriptor_mt():
+    """StatisticalDescriptorMT must give the same results of StatisticalDescriptor and release shared memory."""
+    data, image = create_image()
+    stats = ['min', 'max', 'mean', 'std', 'count']
+
+    systems = LessThan(235).detect(image)
+    expected = [ConvectiveSystem(s.geom) for s in systems]
+    assert len(systems) == 3
+
+    segments = list_shared_memory()
+
+    descriptor = StatisticalDescriptorMT(stats, rasterOut=True, processes=2)
+    try:
+        descriptor.describe(image, systems)
+    finally:
+        descriptor.close()
+    StatisticalDescriptor(stats, rasterOut=True).describe(image, expected)
+
+    assert descriptor.pool is None
+    assert list_shared_memory() == segments
+
+    for s, e in zip(systems, expected):
+        for stat in stats:
+            assert s.attrs[stat] == pytest.approx(e.attrs[stat]), stat
+        np.testing.assert_array_equal(mini2grid(s.raster, s.geotransform, image),
+                                      mini2grid(e.raster, e.geotransform, image))
@@ -0,0 +1,83 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.tracking.detectors."""
+
+import numpy as np
+import pytest
+from osgeo import ogr
+
+from tathu.tracking.detectors import (MultiThresholdDetector,
+                                      ThresholdDetector, ThresholdOp)
+from tathu.tracking.system import ConvectiveSystemManager
+from tathu.tracking.utils import addPolygons
+from tathu.utils import array2raster
+
+THRESHOLDS = [235, 210]
+
+def create_image():
+    """Create a test image with nested thresholds. Systems A and B touch diagonally (i.e. they are not connected)."""
+    data = np.full((20, 24), 280.0, dtype=np.float32)
+    data[2:8, 2:8] = 220.0     # A
+    data[3:4, 3:4] = 200.0     # A layer
+    data[5:8, 5:8] = 200.0     # A layer, touching B diagonally
+    data[8:14, 8:14] = 220.0   # B
+    data[10:13, 10:13] = 200.0 # B layer
+    data[15:19, 14:23] = 220.0 # C
+    data[16:18, 15:17] = 200.0 # C layer (part 1)
+    data[16:18, 19:22] = 200.0 # C layer (part 2)
+    return array2raster(data, [-50.0, -20.0, -50.0 + 24 * 0.04, -20.0 + 20 * 0.04])
+
+def polygon_layers(image):
+    """Layers of each system built by the polygon method, i.e. layer polygons that intersect the system polygon."""
+    systems = ThresholdDetector(THRESHOLDS[0], ThresholdOp.LESS_THAN).detect(image)
+    manager = ConvectiveSystemManager(ThresholdDetector(THRESHOLDS[1], ThresholdOp.LESS_THAN).detect(image))
+    return [(s, manager.getSystemsFromSystem(s)) for s in systems]
+
+def key(geom):
+    """Identify a polygon by its rounded centroid."""
+    c = geom.Centroid()
+    return (round(c.GetX(), 6), round(c.GetY(), 6))
+
+def get_parts(layer):
+    """Return the parts of a multi-polygon layer: centroid -> area."""
+    return {key(layer.GetGeometryRef(i)): layer.GetGeometryRef(i).GetArea() for i in range(layer.GetGeometryCount())}
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_multi_threshold_layers_equal_polygons(lazy):
+    """Layers assigned by labels must be equal to the polygon method, except for layers that only touch a system."""
+    image = create_image()
+    systems = MultiThresholdDetector(THRESHOLDS, ThresholdOp.LESS_THAN, lazy=lazy).detect(image)
+    expected = polygon_layers(image)
+    assert len(systems) == len(expected) == 3
+
+    systems = {key(s.geom): s for s in systems}
+    touching = 0
+    for s, layers in expected:
+        # Polygon method: touching layers (i.e. intersection without area) are assigned too
+        parts = {key(l.geom): l.getArea() for l in layers if s.geom.Intersection(l.geom).GetArea() > 0.0}
+        touching += len(layers) - len(parts)
+
+        result = systems[key(s.geom)].layers.get(str(THRESHOLDS[1]))
+        assert get_parts(result) == pytest.approx(parts)
+
+    # Layer of A touches B
+    assert touching == 1
+
+def test_add_polygons_multipolygon():
+    """Each part of a multi-polygon (e.g. polygon fixed by Buffer(0)) must be added as a polygon."""
+    parts = ogr.CreateGeometryFromWkt('MULTIPOLYGON(((0 0,1 0,1 1,0 1,0 0)),((2 2,3 2,3 3,2 3,2 2)))')
+    polygon = ogr.CreateGeometryFromWkt('POLYGON((5 5,6 5,6 6,5 6,5 5))')
+
+    geom = ogr.Geometry(ogr.wkbMultiPolygon)
+    addPolygons(geom, parts)
+    addPolygons(geom, polygon)
+
+    assert geom.GetGeometryCount() == 3
+    assert [geom.GetGeometryRef(i).GetGeometryName() for i in range(3)] == ['POLYGON'] * 3
+    assert geom.GetArea() == pytest.approx(3.0)
@@ -0,0 +1,111 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.tracking.forecasters."""
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+import shapely
+from osgeo import ogr
+
+from tathu.geometry import transform
+from tathu.tracking.forecasters import (Conservative, Extrapolation,
+                                        compute_elapsed_time,
+                                        compute_last_centroid,
+                                        compute_scale_factor, delta)
+from tathu.tracking.system import ConvectiveSystem, LifeCycleEvent
+from tathu.utils import array2raster
+
+NODATA = -1.0
+
+def create_image(nlines=6, ncols=6):
+    """Create a test image (float32) with a no-data pixel."""
+    data = np.arange(nlines * ncols, dtype=np.float32).reshape(nlines, ncols) + 200.0
+    data[2, 3] = NODATA
+    return data, array2raster(data, [0.0, 0.0, float(ncols), float(nlines)], nodata=NODATA)
+
+def test_extrapolation_zero_flow_is_identity():
+    """A zero flow must return the field unchanged, for any lead time."""
+    data, image = create_image()
+    flow = np.zeros(data.shape + (2,), dtype=np.float32)
+
+    forecaster = Extrapolation(flow, interval=10)
+    for leadtime, forecast in forecaster.forecast(image, [10, 20, 30]):
+        result = forecast.ReadAsArray()
+        assert forecast.GetRasterBand(1).GetNoDataValue() == NODATA
+        np.testing.assert_array_equal(result, data)
+
+def test_extrapolation_constant_shift():
+    """A constant flow of one column per interval must shift the field one column per step."""
+    data, image = create_image()
+    flow = np.zeros(data.shape + (2,), dtype=np.float32)
+    flow[:,:,0] = 1.0
+
+    forecaster = Extrapolation(flow, interval=10)
+    for leadtime, forecast in forecaster.forecast(image, [10, 20]):
+        shift = leadtime // 10
+        result = forecast.ReadAsArray()
+        # Shifted values (including no-data pixel)
+        np.testing.assert_array_equal(result[:,shift:], data[:,:-shift])
+        # Values coming from outside the grid replicate the border
+        np.testing.assert_array_equal(result[:,:shift], np.repeat(data[:,:1], shift, axis=1))
+
+def test_extrapolation_nodata_does_not_spread():
+    """No-data pixels must not grow with lead time."""
+    data, image = create_image()
+    flow = np.zeros(data.shape + (2,), dtype=np.float32)
+
+    forecaster = Extrapolation(flow, interval=10, timestep=5)
+    for leadtime, forecast in forecaster.forecast(image, [5, 10, 15]):
+        assert np.count_nonzero(forecast.ReadAsArray() == NODATA) == 1
+
+def create_system(wkt, minutes, event=LifeCycleEvent.SPONTANEOUS_GENERATION, relationships=[]):
+    """Create a convective system at the given time (minutes after 12:00)."""
+    s = ConvectiveSystem(ogr.CreateGeometryFromWkt(wkt))
+    s.timestamp = datetime(2020, 1, 1, 12, 0) + timedelta(minutes=minutes)
+    s.event = event
+    s.relationships = relationships
+    return s
+
+def baseline_forecast(sys, t, applyScale):
+    """Forecast one system using the polygon method (translation of centroid and scale, one system at time)."""
+    elapsedtime = compute_elapsed_time(sys)
+    dx, dy = delta(sys.geom.Centroid(), compute_last_centroid(sys), elapsedtime)
+    geom = transform.translate(sys.geom, dx * t, dy * t)
+    if applyScale:
+        scale = compute_scale_factor(sys, elapsedtime)
+        geom = transform.scale(geom, 1 + scale * t, 1 + scale * t)
+    return geom
+
+@pytest.mark.parametrize('applyScale', [False, True])
+def test_conservative_equals_baseline(applyScale):
+    """Conservative forecast (batch) must be equal to the polygon method for continuity and merge systems."""
+    # L-shaped systems, i.e. centroid is not the center of bounding box
+    previous = [create_system('POLYGON((0 0,4 0,4 1,1 1,1 3,0 3,0 0))', 0),
+                create_system('POLYGON((10 0,12 0,12 2,10 2,10 0))', 0),
+                create_system('POLYGON((13 0,15 0,15 3,13 3,13 0))', 0),
+                create_system('POLYGON((20 0,26 0,26 4,20 4,20 0))', 0)]
+    current = [create_system('POLYGON((1 1,6 1,6 2,2 2,2 5,1 5,1 1))', 10, LifeCycleEvent.CONTINUITY, previous[:1]),
+               create_system('POLYGON((11 0,15 0,15 3,13 3,13 1,11 1,11 0))', 10, LifeCycleEvent.MERGE, previous[1:3]),
+               create_system('POLYGON((20 0,22 0,22 4,20 4,20 0))', 10, LifeCycleEvent.SPLIT, previous[3:]),
+               create_system('POLYGON((23 0,26 0,26 4,23 4,23 0))', 10, LifeCycleEvent.SPLIT, previous[3:]),
+               create_system('POLYGON((40 0,41 0,41 1,40 1,40 0))', 10)]
+
+    intervals = [10, 30]
+    forecasts = Conservative(previous, intervals, applyScale).forecast(current)
+
+    for t in intervals:
+        # No forecast of split and new systems
+        assert [f.source for f in forecasts[t]] == current[:2]
+        for f in forecasts[t]:
+            assert f.name == f.source.name and f.interval == t
+            expected = shapely.from_wkb(bytes(baseline_forecast(f.source, t, applyScale).ExportToWkb()))
+            assert shapely.equals_exact(f.shape, expected, tolerance=1e-9)
+            assert f.getArea() == pytest.approx(expected.area)
@@ -0,0 +1,139 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.io.pgis."""
+
+import csv
+import io
+import struct
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pytest
+from osgeo import ogr
+
+pgis = pytest.importorskip('tathu.io.pgis')
+
+from tathu.tracking.system import ConvectiveSystem, LifeCycleEvent
+
+ATTRS = ['max', 'count']
+
+class Cursor(object):
+    """Cursor that keeps the executed commands and the COPY data."""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, cmd, params=None):
+        self.conn.commands.append(cmd)
+
+    def copy_expert(self, cmd, data):
+        self.conn.copies.append((cmd, data.read()))
+
+    def close(self):
+        pass
+
+class Connection(object):
+    """Connection (without server) that keeps the commands of its cursors."""
+    def __init__(self):
+        self.commands = []
+        self.copies = []
+
+    def cursor(self, cursor_factory=None):
+        return Cursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+class Pool(object):
+    """Pool with a single connection."""
+    def __init__(self):
+        self.conn = Connection()
+
+    def getconn(self):
+        return self.conn
+
+    def putconn(self, conn):
+        assert conn is self.conn
+
+def create_system(x, relationships=[]):
+    """Create a convective system with attributes and raster."""
+    wkt = 'POLYGON(({0} 0,{1} 0,{1} 1,{0} 1,{0} 0))'.format(x, x + 1)
+    s = ConvectiveSystem(ogr.CreateGeometryFromWkt(wkt))
+    s.timestamp = datetime(2020, 1, 1, 12, 30)
+    s.event = LifeCycleEvent.MERGE if relationships else LifeCycleEvent.SPONTANEOUS_GENERATION
+    s.relationships = relationships
+    s.attrs = {'max': 230.5, 'count': 4.0}
+    s.nodata = -1.0
+    s.raster = np.ma.masked_equal(np.array([[200.25, -1.0], [210.5, 220.0]], dtype=np.float32), -1.0)
+    s.geotransform = (x, 0.5, 0.0, 1.0, 0.0, -0.5)
+    return s
+
+def test_copy_rows():
+    """COPY rows must have hex EWKB geometry (SRID 4326), raw bytea raster (\\x) and relations array."""
+    pool = Pool()
+    outputter = pgis.Outputter(None, None, None, None, 'systems', ATTRS, copy=True, batchSize=3, pool=pool)
+
+    previous = [create_system(0.0), create_system(2.0)]
+    systems = [create_system(1.0, previous)]
+    outputter.output(previous)
+    assert pool.conn.copies == [] # Buffered
+
+    outputter.output(systems)
+    assert outputter.buffer == []
+    assert len(pool.conn.copies) == 1
+
+    cmd, data = pool.conn.copies[0]
+    assert cmd == ('COPY systems (name, date_time, max, count, event, relations, raster, nodata, geotransform, geom) '
+                   'FROM STDIN WITH (FORMAT csv)')
+
+    rows = list(csv.reader(io.StringIO(data)))
+    assert len(rows) == 3
+
+    row, s = rows[2], systems[0]
+    name, timestamp, vmax, count, event, relations, raster, nodata, geotransform, geom = row
+    assert uuid.UUID(name) == s.name
+    assert datetime.fromisoformat(timestamp) == s.timestamp
+    assert (float(vmax), float(count)) == (230.5, 4.0)
+    assert event == 'MERGE'
+    assert relations == '{' + ','.join(str(p.name) for p in previous) + '}'
+    assert rows[0][5] == '{}'
+
+    # Raster (int16, scaled by 100)
+    assert raster.startswith('\\x')
+    array = np.load(io.BytesIO(bytes.fromhex(raster[2:])))
+    assert array.dtype == np.int16
+    np.testing.assert_array_equal(array, [[20025, np.iinfo(np.int16).min], [21050, 22000]])
+    assert int(nodata) == np.iinfo(np.int16).min
+    assert [float(v) for v in geotransform.strip('{}').split(',')] == list(s.geotransform)
+
+    # Geometry (EWKB)
+    ewkb = bytes.fromhex(geom)
+    wkb = bytes(s.geom.ExportToWkb())
+    endian = '<' if ewkb[0] == 1 else '>'
+    gtype, srid = struct.unpack(endian + 'II', ewkb[1:9])
+    assert gtype == struct.unpack(endian + 'I', wkb[1:5])[0] | 0x20000000
+    assert srid == 4326
+    assert ewkb[:1] + ewkb[9:] == wkb[:1] + wkb[5:]
+
+def test_copy_flush():
+    """Remaining buffered systems must be written on flush."""
+    pool = Pool()
+    outputter = pgis.Outputter(None, None, None, None, 'systems', ATTRS, outputRaster=False, copy=True, pool=pool)
+
+    outputter.output([create_system(0.0)])
+    outputter.flush()
+    outputter.flush() # Nothing to do
+
+    assert len(pool.conn.copies) == 1
+    row = next(csv.reader(io.StringIO(pool.conn.copies[0][1])))
+    assert np.load(io.BytesIO(bytes.fromhex(row[6][2:]))).shape == (1, 1)
+    assert int(row[7]) == 0
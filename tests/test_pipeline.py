@@ -0,0 +1,265 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.tracking.pipeline."""
+
+import gc
+import os
+import uuid
+import weakref
+from functools import partial
+
+import numpy as np
+import pytest
+from osgeo import ogr
+
+from tathu.tracking.detectors import LessThan
+from tathu.tracking.pipeline import (Checkpoint, FrameProcessor,
+                                     PeriodScheduler, TrackingPipeline,
+                                     runPeriod)
+from tathu.tracking.system import ConvectiveSystem, LabeledConvectiveSystem
+from tathu.tracking.trackers import (LabelOverlapTracker, OverlapAreaTracker,
+                                     RelativeOverlapAreaStrategy)
+from tathu.utils import array2raster
+
+FILES = ['/data/S11635384_2020010112{:02d}.nc'.format(10 * i) for i in range(6)]
+
+class Reader(object):
+    """Reader of test frames: a cold rectangle that moves one column on each frame."""
+    def __init__(self):
+        self.paths = [] # Read paths.
+
+    def __call__(self, path):
+        self.paths.append(path)
+        k = FILES.index(path)
+        data = np.full((20, 24), 280.0, dtype=np.float32)
+        data[5:10, 2 + k:8 + k] = 200.0
+        data[14:17, 2 + 2 * k:4 + 2 * k] = 210.0 # Small system, not related with its previous position
+        return array2raster(data, [-50.0, -20.0, -50.0 + 24 * 0.04, -20.0 + 20 * 0.04])
+
+class Outputter(object):
+    """In-memory outputter: it keeps (timestamp, name, event, relationship names, WKT) of each system."""
+    def __init__(self):
+        self.rows = []
+        self.images = [] # Weak references to the labeled images of each frame.
+        self.alive = []  # Number of labeled images alive on each output.
+
+    def output(self, systems):
+        for s in systems:
+            self.rows.append((s.timestamp, str(s.name), str(s.event), s.getRelationshipNames(), s.geom.ExportToWkt()))
+        # Note: systems of the same frame share the labeled image
+        if systems and isinstance(systems[0], LabeledConvectiveSystem):
+            self.images.append(weakref.ref(systems[0].image))
+        gc.collect()
+        self.alive.append(sum(1 for r in self.images if r() is not None))
+
+class Loader(object):
+    """In-memory loader of the last systems written on the given outputter (optionally, ignoring the last frames)."""
+    def __init__(self, outputter, ignore=0):
+        self.outputter = outputter
+        self.ignore = ignore
+
+    def loadLastSystems(self, attrs):
+        timestamps = sorted(set(row[0] for row in self.outputter.rows))
+        if len(timestamps) <= self.ignore:
+            return []
+        last = timestamps[-1 - self.ignore]
+        systems = []
+        for timestamp, name, event, relationships, wkt in self.outputter.rows:
+            if timestamp == last:
+                s = ConvectiveSystem(ogr.CreateGeometryFromWkt(wkt))
+                s.name, s.timestamp, s.event = uuid.UUID(name), timestamp, event
+                s.relationships = [uuid.UUID(r) for r in relationships]
+                systems.append(s)
+        return systems
+
+def create_pipeline(outputter, tmp_path, ignore=0, lazy=False):
+    """Create a tracking pipeline that reads the test frames."""
+    reader = Reader()
+    tracker = LabelOverlapTracker if lazy else OverlapAreaTracker
+    return TrackingPipeline(FrameProcessor(reader, LessThan(235, lazy=lazy)),
+                            partial(tracker, strategy=RelativeOverlapAreaStrategy(0.1)),
+                            outputter, loader=Loader(outputter, ignore),
+                            checkpoint=Checkpoint(str(tmp_path / 'checkpoint.json'))), reader
+
+def get_families(outputter):
+    """Return the (name, event) of the systems of each frame (large system first)."""
+    frames = {}
+    for timestamp, name, event, relationships, wkt in outputter.rows:
+        frames.setdefault(timestamp, []).append((ogr.CreateGeometryFromWkt(wkt).GetArea(), name, event))
+    return [[(name, event) for area, name, event in sorted(frames[t], reverse=True)] for t in sorted(frames)]
+
+def test_labeled_images_released(tmp_path):
+    """Labeled images of previous frames must be garbage-collected along the run."""
+    outputter = Outputter()
+    pipeline, reader = create_pipeline(outputter, tmp_path, lazy=True)
+
+    pipeline.run([FILES])
+
+    assert len(outputter.images) == len(FILES)
+    assert outputter.alive == [1] * len(FILES)
+
+    # One family for the moving system
+    frames = get_families(outputter)
+    assert len(set(frame[0][0] for frame in frames)) == 1
+
+def test_resume_at_checkpoint(tmp_path):
+    """A restarted run must skip processed frames and continue the families from the output."""
+    outputter = Outputter()
+    pipeline, reader = create_pipeline(outputter, tmp_path)
+    pipeline.run([FILES[:3]])
+    assert reader.paths == FILES[:3]
+
+    pipeline, reader = create_pipeline(outputter, tmp_path)
+    pipeline.run([FILES])
+    assert reader.paths == FILES[3:]
+
+    frames = get_families(outputter)
+    assert len(frames) == len(FILES)
+    assert len(set(frame[0][0] for frame in frames)) == 1
+    assert [frame[0][1] for frame in frames] == ['SPONTANEOUS_GENERATION'] + ['CONTINUITY'] * 5
+    assert len(set(frame[1][0] for frame in frames)) == len(FILES)
+
+def test_resume_output_behind_checkpoint(tmp_path):
+    """If the output is behind the checkpoint, frames must be re-processed from the last output."""
+    outputter = Outputter()
+    pipeline, reader = create_pipeline(outputter, tmp_path)
+    pipeline.run([FILES[:3]])
+
+    # Output lost the last frame (e.g. output failed after checkpoint)
+    last = outputter.rows[-1][0]
+    outputter.rows = [row for row in outputter.rows if row[0] != last]
+
+    pipeline, reader = create_pipeline(outputter, tmp_path)
+    pipeline.run([FILES])
+    assert reader.paths == FILES[2:]
+
+    frames = get_families(outputter)
+    assert len(frames) == len(FILES)
+    assert len(set(frame[0][0] for frame in frames)) == 1
+
+def test_resume_between_frames(tmp_path, capsys):
+    """If no file matches the resume timestamp, resumed systems must be tracked on the next frame of the same period."""
+    outputter = Outputter()
+    pipeline, reader = create_pipeline(outputter, tmp_path)
+    pipeline.run([FILES[:3]])
+
+    # File at resume timestamp is not available anymore
+    pipeline, reader = create_pipeline(outputter, tmp_path)
+    pipeline.run([FILES[:2] + FILES[3:]])
+    assert reader.paths == FILES[3:]
+    assert 'no file at resume timestamp' in capsys.readouterr().out
+
+    frames = get_families(outputter)
+    assert len(frames) == len(FILES)
+    assert len(set(frame[0][0] for frame in frames)) == 1
+    assert frames[3][0][1] == 'CONTINUITY'
+
+def test_resume_new_period(tmp_path):
+    """Resumed systems must not be tracked on a period that starts after the resume timestamp."""
+    outputter = Outputter()
+    pipeline, reader = create_pipeline(outputter, tmp_path)
+    pipeline.run([FILES[:3]])
+
+    pipeline, reader = create_pipeline(outputter, tmp_path)
+    pipeline.run([FILES[:3], FILES[4:]])
+    assert reader.paths == FILES[4:]
+
+    frames = get_families(outputter)
+    assert [frame[0][1] for frame in frames] == ['SPONTANEOUS_GENERATION', 'CONTINUITY', 'CONTINUITY',
+                                                 'SPONTANEOUS_GENERATION', 'CONTINUITY']
+
+def test_checkpoint(tmp_path):
+    """Checkpoint must keep the last timestamp, path and number of systems."""
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    assert checkpoint.load() is None
+
+    pipeline, reader = create_pipeline(Outputter(), tmp_path)
+    pipeline.run([FILES[:2]])
+
+    state = checkpoint.load()
+    assert state['timestamp'] == pipeline.processor.getTimestamp(FILES[1])
+    assert (state['path'], state['nsystems']) == (FILES[1], 2)
+
+class ShardWriter(object):
+    """Pipeline stub: it writes the period files on its shard."""
+    def __init__(self, shard):
+        self.shard = shard
+
+    def run(self, periods):
+        with open(self.shard, 'w') as f:
+            f.write(' '.join(path for period in periods for path in period))
+
+class ShardMerger(object):
+    """Merger stub: it keeps the merged shards (and fails on the given ones)."""
+    def __init__(self, invalid=[]):
+        self.invalid = invalid
+        self.shards = []
+
+    def __call__(self, shards):
+        if set(shards) & set(self.invalid):
+            return False
+        self.shards.extend(shards)
+
+def test_run_period(tmp_path):
+    """A period shard must be marked as done after its pipeline runs."""
+    shard = str(tmp_path / 'period-000000.sqlite')
+    assert runPeriod(ShardWriter, shard, FILES[:2]) == shard
+    assert os.path.exists(shard + '.done')
+    with open(shard) as f:
+        assert f.read() == ' '.join(FILES[:2])
+
+def test_scheduler_run_nodes(tmp_path):
+    """Each node must process its own periods (i % nnodes == node), skipping empty periods."""
+    periods = [FILES[:2], [], FILES[2:4], FILES[4:]]
+    scheduler = PeriodScheduler(ShardWriter, str(tmp_path / 'shards'), workers=2)
+
+    scheduler.run(periods, node=0, nnodes=2)
+    assert sorted(os.listdir(str(tmp_path / 'shards'))) == ['period-000000.sqlite', 'period-000000.sqlite.done',
+                                                            'period-000002.sqlite', 'period-000002.sqlite.done']
+
+    scheduler.run(periods, node=1, nnodes=2)
+    assert os.path.exists(scheduler.getShard(3) + '.done')
+    assert not os.path.exists(scheduler.getShard(1))
+
+def test_scheduler_merge_order(tmp_path):
+    """Merge must follow period order, stop at an unfinished shard and never merge a shard twice."""
+    periods = [FILES[:2], [], FILES[2:4], FILES[4:]]
+    scheduler = PeriodScheduler(ShardWriter, str(tmp_path))
+    for i in [0, 3]:
+        runPeriod(ShardWriter, scheduler.getShard(i), periods[i])
+
+    # Period 2 is not finished (e.g. other node): period 3 must wait
+    merger = ShardMerger()
+    assert scheduler.merge(periods, merger) is False
+    assert merger.shards == [scheduler.getShard(0)]
+    assert os.path.exists(scheduler.getShard(0) + '.merged')
+    assert not os.path.exists(scheduler.getShard(3) + '.merged')
+
+    runPeriod(ShardWriter, scheduler.getShard(2), periods[2])
+    merger = ShardMerger()
+    assert scheduler.merge(periods, merger) is True
+    assert merger.shards == [scheduler.getShard(2), scheduler.getShard(3)]
+
+    # Nothing left
+    merger = ShardMerger()
+    assert scheduler.merge(periods, merger) is True
+    assert merger.shards == []
+
+def test_scheduler_merge_error(tmp_path):
+    """A failed merge must raise an error and keep the shard not merged."""
+    periods = [FILES[:3], FILES[3:]]
+    scheduler = PeriodScheduler(ShardWriter, str(tmp_path))
+    for i, period in enumerate(periods):
+        runPeriod(ShardWriter, scheduler.getShard(i), period)
+
+    merger = ShardMerger(invalid=[scheduler.getShard(1)])
+    with pytest.raises(RuntimeError):
+        scheduler.merge(periods, merger)
+    assert merger.shards == [scheduler.getShard(0)]
+    assert not os.path.exists(scheduler.getShard(1) + '.merged')
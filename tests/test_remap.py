@@ -0,0 +1,96 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.satellite.remap."""
+
+import os
+
+import numpy as np
+from osgeo import osr
+
+from tathu.satellite.remap import (Remapper, computeRemapIndexes,
+                                   computeSourceWindow)
+from tathu.utils import getGeoT
+
+def create_srs(proj4):
+    """Create a spatial reference system from the given proj4 string."""
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4(proj4)
+    return srs
+
+LATLON = create_srs('+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs')
+GEOS = create_srs('+proj=geos +h=35786023.0 +a=6378137.0 +b=6356752.31414 +lon_0=-75.0 +sweep=x +no_defs')
+
+# GEOS source grid (approx. 10 km), that covers part of South America
+GEOS_SHAPE = (300, 400)
+GEOS_GEOT = [-1000000.0, 10000.0, 0.0, 0.0, 0.0, -10000.0]
+
+def test_remap_indexes_same_grid():
+    """Remapping a grid to itself must be the identity."""
+    geoT = getGeoT([-50.0, -20.0, -40.0, -10.0], 10, 10)
+
+    indexes = computeRemapIndexes(LATLON, geoT, (10, 10), LATLON, geoT, (10, 10))
+
+    np.testing.assert_array_equal(indexes, np.arange(100).reshape(10, 10))
+
+def test_remap_indexes_subgrid():
+    """Target pixels must point to source pixels or be -1 outside of source grid."""
+    sourceGeoT = getGeoT([-50.0, -20.0, -40.0, -10.0], 10, 10)
+    targetGeoT = getGeoT([-45.0, -25.0, -35.0, -15.0], 10, 10)
+
+    indexes = computeRemapIndexes(LATLON, sourceGeoT, (10, 10), LATLON, targetGeoT, (10, 10))
+
+    source = np.arange(100).reshape(10, 10)
+    np.testing.assert_array_equal(indexes[:5, :5], source[5:, 5:])
+    assert (indexes[5:, :] == -1).all()
+    assert (indexes[:, 5:] == -1).all()
+
+def test_source_window_covers_remap():
+    """The source window must cover all source pixels used by the full remapping."""
+    targetShape = (120, 150)
+    targetGeoT = getGeoT([-60.0, -25.0, -45.0, -13.0], *targetShape)
+
+    indexes = computeRemapIndexes(GEOS, GEOS_GEOT, GEOS_SHAPE, LATLON, targetGeoT, targetShape)
+    valid = indexes[indexes >= 0]
+    lines, cols = valid // GEOS_SHAPE[1], valid % GEOS_SHAPE[1]
+
+    line0, line1, col0, col1 = computeSourceWindow(GEOS, GEOS_GEOT, GEOS_SHAPE, LATLON, targetGeoT, targetShape)
+
+    assert line0 <= lines.min() and lines.max() < line1
+    assert col0 <= cols.min() and cols.max() < col1
+
+    # Window is much smaller than source grid
+    assert (line1 - line0) * (col1 - col0) < GEOS_SHAPE[0] * GEOS_SHAPE[1] / 2
+
+def test_source_window_outside():
+    """A target grid that does not intersect the source grid must return None."""
+    targetGeoT = getGeoT([100.0, 10.0, 110.0, 20.0], 10, 10)
+
+    assert computeSourceWindow(GEOS, GEOS_GEOT, GEOS_SHAPE, LATLON, targetGeoT, (10, 10)) is None
+
+def test_remapper_disk_cache(tmp_path):
+    """Remap indexes must be stored on disk and reused by other remappers."""
+    targetShape = (40, 50)
+    targetGeoT = getGeoT([-60.0, -25.0, -45.0, -13.0], *targetShape)
+    array = np.arange(GEOS_SHAPE[0] * GEOS_SHAPE[1], dtype=np.float32).reshape(GEOS_SHAPE)
+
+    directory = str(tmp_path / 'remap')
+    expected = Remapper(directory).remap(array, GEOS, GEOS_GEOT, LATLON, targetGeoT, targetShape, -999.0)
+    assert len(os.listdir(directory)) == 1
+
+    # Reference: full remap indexes
+    indexes = computeRemapIndexes(GEOS, GEOS_GEOT, GEOS_SHAPE, LATLON, targetGeoT, targetShape)
+    np.testing.assert_array_equal(expected, np.where(indexes >= 0, array.ravel()[indexes], -999.0))
+
+    # Loaded from disk (memory-mapped), on preallocated output
+    remapper = Remapper(directory)
+    out = np.empty(targetShape, dtype=np.float32)
+    result = remapper.remap(array, GEOS, GEOS_GEOT, LATLON, targetGeoT, targetShape, -999.0, out=out)
+    assert result is out
+    assert isinstance(next(iter(remapper.indexes.values())), np.memmap)
+    np.testing.assert_array_equal(result, expected)
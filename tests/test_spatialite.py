@@ -0,0 +1,164 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.io.spatialite."""
+
+import sqlite3
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from osgeo import ogr
+
+from tathu.io import spatialite
+from tathu.tracking.pipeline import mergeShards
+from tathu.tracking.system import ConvectiveSystem, LifeCycleEvent
+
+def has_spatialite():
+    """Verify if SpatiaLite extension (mod_spatialite) can be loaded."""
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.enable_load_extension(True)
+        conn.execute('SELECT load_extension("mod_spatialite")')
+        return True
+    except (AttributeError, sqlite3.Error):
+        return False
+    finally:
+        conn.close()
+
+pytestmark = pytest.mark.skipif(not has_spatialite(), reason='SpatiaLite (mod_spatialite) is not available')
+
+ATTRS = ['max', 'count']
+
+def create_family(name, start, n, x=0.0):
+    """Create a system family with n systems (10 minutes each), growing by one unit of area on each step."""
+    systems = []
+    for i in range(n):
+        wkt = 'POLYGON(({0} 0,{1} 0,{1} 1,{0} 1,{0} 0))'.format(x, x + i + 1)
+        s = ConvectiveSystem(ogr.CreateGeometryFromWkt(wkt))
+        s.name = name
+        s.timestamp = start + timedelta(minutes=10 * i)
+        s.event = LifeCycleEvent.SPONTANEOUS_GENERATION if i == 0 else LifeCycleEvent.CONTINUITY
+        s.attrs = {'max': 230.0 - i, 'count': float(i + 1)}
+        systems.append(s)
+    return systems
+
+def write(database, families):
+    """Write the given families (one output() call for each timestamp)."""
+    outputter = spatialite.Outputter(database, 'systems', ATTRS, outputRaster=False)
+    systems = sorted((s for f in families for s in f), key=lambda s: s.timestamp)
+    for timestamp in sorted(set(s.timestamp for s in systems)):
+        outputter.output([s for s in systems if s.timestamp == timestamp])
+    outputter.flush()
+    del outputter
+
+def test_round_trip(tmp_path):
+    """Loaded systems must be equal to the written ones."""
+    database = str(tmp_path / 'systems.sqlite')
+    name = uuid.uuid4()
+    family = create_family(name, datetime(2020, 1, 1, 12, 0), 4)
+    write(database, [family])
+
+    loaded = spatialite.Loader(database, 'systems').load(name, ATTRS)
+
+    assert len(loaded.systems) == len(family)
+    for s, l in zip(family, loaded.systems):
+        assert l.name == s.name
+        assert l.timestamp == s.timestamp
+        assert l.event == str(s.event)
+        assert l.attrs == s.attrs
+        assert l.getArea() == pytest.approx(s.getArea())
+
+def test_summary(tmp_path):
+    """The summary table must keep duration and max area of each family."""
+    database = str(tmp_path / 'systems.sqlite')
+    long, short = uuid.uuid4(), uuid.uuid4()
+    write(database, [create_family(long, datetime(2020, 1, 1, 12, 0), 7),
+                     create_family(short, datetime(2020, 1, 1, 12, 30), 2, x=10.0)])
+
+    loader = spatialite.Loader(database, 'systems')
+    assert loader.loadByDuration(0.5) == [str(long)]
+    assert loader.loadByInterval(0.0, 2.0) == [str(long), str(short)]
+
+    rows = loader.query('SELECT name, duration, max_area FROM systems_summary ORDER BY duration DESC')
+    assert [(r['name'], r['duration'], r['max_area']) for r in rows] == [
+        (str(long), pytest.approx(1.0), pytest.approx(7.0)),
+        (str(short), pytest.approx(1.0 / 6.0), pytest.approx(2.0))]
+
+def test_merge(tmp_path):
+    """Merge must copy shard systems in order and combine the families summary."""
+    name, other = uuid.uuid4(), uuid.uuid4()
+    family = create_family(name, datetime(2020, 1, 1, 12, 0), 6)
+
+    # Family split across two shards (e.g. two periods)
+    shards = [str(tmp_path / 'shard-0.sqlite'), str(tmp_path / 'shard-1.sqlite')]
+    write(shards[0], [family[:3]])
+    write(shards[1], [family[3:], create_family(other, datetime(2020, 1, 1, 13, 0), 2, x=10.0)])
+
+    database = str(tmp_path / 'systems.sqlite')
+    write(database, [])
+
+    assert spatialite.merge(database, 'systems', shards)
+
+    loader = spatialite.Loader(database, 'systems')
+    assert [s.timestamp for s in loader.load(name, ATTRS).systems] == [s.timestamp for s in family]
+    assert loader.loadByDuration(0.5) == [str(name)]
+
+    rows = loader.query("SELECT start_time, end_time, max_area FROM systems_summary WHERE name = '" + str(name) + "'")
+    assert (rows[0]['start_time'], rows[0]['end_time']) == (family[0].timestamp, family[-1].timestamp)
+    assert rows[0]['max_area'] == pytest.approx(6.0)
+
+    # No shard left attached
+    assert [row[1] for row in loader.query('PRAGMA database_list')] == ['main']
+
+def test_merge_error(tmp_path):
+    """Merge must stop at an invalid shard, keeping the previous shards and detaching it."""
+    database = str(tmp_path / 'systems.sqlite')
+    write(database, [])
+
+    shard = str(tmp_path / 'shard.sqlite')
+    write(shard, [create_family(uuid.uuid4(), datetime(2020, 1, 1, 12, 0), 2)])
+    invalid = str(tmp_path / 'invalid.sqlite')
+    sqlite3.connect(invalid).close()
+
+    assert not spatialite.merge(database, 'systems', [shard, invalid])
+
+    loader = spatialite.Loader(database, 'systems')
+    assert len(loader.query('SELECT * FROM systems')) == 2
+    assert [row[1] for row in loader.query('PRAGMA database_list')] == ['main']
+
+class ListOutputter(object):
+    """Outputter that keeps the systems of each output() call and the number of flush() calls."""
+    def __init__(self):
+        self.chunks = []
+        self.flushes = 0
+
+    def output(self, systems):
+        self.chunks.append(systems)
+
+    def flush(self):
+        self.flushes += 1
+
+def test_merge_shards(tmp_path):
+    """Shard systems must be copied to the outputter in shard order, in chunks, keeping names."""
+    family = create_family(uuid.uuid4(), datetime(2020, 1, 1, 12, 0), 5)
+    shards = [str(tmp_path / 'shard-0.sqlite'), str(tmp_path / 'shard-1.sqlite')]
+    write(shards[0], [family[:3]])
+    write(shards[1], [family[3:]])
+
+    outputter = ListOutputter()
+    mergeShards(shards, 'systems', outputter, ATTRS, chunksize=2)
+
+    assert [len(chunk) for chunk in outputter.chunks] == [2, 1, 2]
+    assert outputter.flushes == 2
+
+    systems = [s for chunk in outputter.chunks for s in chunk]
+    assert [s.timestamp for s in systems] == [s.timestamp for s in family]
+    assert all(str(s.name) == str(family[0].name) for s in systems)
+    assert [s.attrs for s in systems] == [s.attrs for s in family]
+    assert systems[-1].getArea() == pytest.approx(family[-1].getArea())
@@ -0,0 +1,144 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.tracking.system."""
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from osgeo import ogr
+
+from tathu.tracking.detectors import MultiThresholdDetector, ThresholdOp
+from tathu.tracking.system import (ConvectiveSystem, LifeCycleEvent,
+                                   RollingConvectiveSystemManager, SystemTable,
+                                   SystemView)
+from tathu.utils import array2raster
+
+def create_image(boxes):
+    """Create a test image with rectangles (first line, last line + 1, first column, last column + 1, value)."""
+    data = np.full((20, 24), 280.0, dtype=np.float32)
+    for i0, i1, j0, j1, value in boxes:
+        data[i0:i1, j0:j1] = value
+    return array2raster(data, [-50.0, -20.0, -50.0 + 24 * 0.04, -20.0 + 20 * 0.04])
+
+def assert_same_geometry(a, b):
+    """Verify that the given geometries cover the same area (up to float precision)."""
+    assert a.Intersection(b).GetArea() == pytest.approx(a.GetArea())
+    assert a.GetArea() == pytest.approx(b.GetArea())
+
+def test_release_keeps_system():
+    """Released systems must keep area, extent, centroid, geometry and layers on a cropped labeled image."""
+    image = create_image([(2, 8, 2, 8, 220.0), (3, 5, 3, 5, 200.0), (10, 16, 12, 20, 220.0),
+                          (11, 13, 13, 15, 200.0), (13, 15, 17, 19, 200.0)])
+    detector = MultiThresholdDetector([230, 210], ThresholdOp.LESS_THAN, lazy=True)
+    expected = detector.detect(image)
+    systems = detector.detect(image)
+
+    for s in systems:
+        s.release()
+
+    for s, e in zip(systems, expected):
+        assert s.image is not e.image
+        assert s.image.labels.shape == e.getMask().shape
+        assert s.getArea() == pytest.approx(e.getArea())
+        assert s.getCentroid() == pytest.approx(e.getCentroid())
+        assert s.getMBR() == pytest.approx(e.getMBR())
+        assert_same_geometry(s.geom, e.geom)
+        assert s.layers.keys() == e.layers.keys()
+        for key in e.layers:
+            assert_same_geometry(s.layers[key], e.layers[key])
+
+    assert systems[1].layers['210'].GetGeometryCount() == 2
+
+def create_system(x0, y0, x1, y1):
+    """Create a rectangular convective system."""
+    wkt = 'POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))'.format(x0, y0, x1, y1)
+    return ConvectiveSystem(ogr.CreateGeometryFromWkt(wkt))
+
+def test_rolling_manager_expiry():
+    """Rolling manager must keep only the last frames indexed and search on the requested frame."""
+    frames = [[create_system(i, 0, i + 2, 2), create_system(i, 10, i + 2, 12)] for i in range(3)]
+
+    manager = RollingConvectiveSystemManager(size=2, systems=frames[0])
+    manager.push(frames[1])
+    assert manager.getFrame(0) == frames[0] and manager.getFrame(-1) == frames[1]
+    assert manager.getSystemsFromExtent((0.0, 0.0, 4.0, 4.0)) == [frames[0][0], frames[1][0]]
+
+    # First frame expires
+    manager.push(frames[2])
+    assert len(manager.frames) == 2
+    assert manager.getFrame(0) == frames[1] and manager.getFrame(-1) == frames[2]
+    assert len(manager.systems) == len(manager.envelopes) == 4
+    assert manager.getSystemsFromExtent((0.0, 0.0, 4.0, 4.0)) == [frames[1][0], frames[2][0]]
+    assert manager.rtree.count((-100.0, -100.0, 100.0, 100.0)) == 4
+
+    # Search restricted to the latest frame
+    assert manager.getSystemsFromSystem(create_system(0, 10, 5, 12), -1) == [frames[2][1]]
+
+    # Empty frames expire too
+    manager.push([])
+    manager.push([])
+    assert manager.getFrame(-1) == [] and not manager.systems
+    assert manager.getSystemsFromExtent((-100.0, -100.0, 100.0, 100.0)) == []
+
+def create_systems():
+    """Create systems of two frames: a merge (two relationships), a continuity and a new system."""
+    previous = [create_system(0, 0, 2, 2), create_system(3, 0, 5, 2)]
+    current = [create_system(1, 0, 4, 2), create_system(10, 10, 11, 13)]
+    current[0].relationships = previous
+    current[0].event = LifeCycleEvent.MERGE
+    current[0].name = previous[0].name
+    for i, s in enumerate(previous + current):
+        s.timestamp = datetime(2020, 1, 1, 12, 0) + timedelta(minutes=10 * (i // 2))
+        s.attrs = {'max': 230.0 - i, 'count': float(i)}
+    return previous + current
+
+def test_system_table_round_trip():
+    """Systems converted to table and back must keep names, timestamps, events, attributes, geometries and relationships."""
+    systems = create_systems()
+    table = SystemTable.fromSystems(systems, ['max', 'count'])
+    assert len(table) == len(systems)
+    assert table.getNames() == [s.name for s in systems]
+
+    for s, r in zip(systems, table.toSystems()):
+        assert r.name == s.name
+        assert r.timestamp == s.timestamp
+        assert r.event == s.event
+        assert r.attrs == s.attrs
+        assert r.relationships == [p.name for p in s.relationships if p.name != s.name]
+        assert r.getRelationshipNames() == s.getRelationshipNames()
+        assert r.geom.Equals(s.geom)
+
+    # Views
+    view = table[-2]
+    assert isinstance(view, SystemView)
+    assert view.event == LifeCycleEvent.MERGE
+    assert view.getRelationshipNames() == [str(systems[1].name)]
+    assert bytes(table.getWKB(2)) == bytes(systems[2].geom.ExportToWkb())
+    assert view.getArea() == pytest.approx(systems[2].getArea())
+    with pytest.raises(IndexError):
+        table[len(systems)]
+
+def test_system_table_select():
+    """Selection must keep the geometries and relationships of the selected rows."""
+    systems = create_systems()
+    table = SystemTable.fromSystems(systems, ['max'])
+
+    selected = table.select(np.array([False, True, True, False]))
+    assert selected.getNames() == [systems[1].name, systems[2].name]
+    assert [v.attrs for v in selected] == [{'max': 229.0}, {'max': 228.0}]
+    assert [v.relationships for v in selected] == [[], [systems[1].name]]
+    assert bytes(selected.getWKB(1)) == bytes(systems[2].geom.ExportToWkb())
+
+    selected = table.select([3, 0])
+    assert selected.getNames() == [systems[3].name, systems[0].name]
+    assert bytes(selected.getWKB(0)) == bytes(systems[3].geom.ExportToWkb())
+
+    empty = table.select([])
+    assert len(empty) == 0 and empty.toSystems() == []
@@ -0,0 +1,152 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.tracking.trackers."""
+
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+from osgeo import ogr
+
+from tathu.tracking.detectors import LessThan
+from tathu.tracking.system import ConvectiveSystem, LifeCycleEvent
+from tathu.tracking.trackers import (AdvectedOverlapTracker,
+                                     AssignmentTracker, CentroidHistory,
+                                     LabelOverlapTracker, OverlapAreaTracker,
+                                     RelativeOverlapAreaStrategy)
+from tathu.utils import array2raster
+
+def create_system(x0, y0, x1, y1):
+    """Create a rectangular convective system."""
+    wkt = 'POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))'.format(x0, y0, x1, y1)
+    return ConvectiveSystem(ogr.CreateGeometryFromWkt(wkt))
+
+def create_merge_split_scene():
+    """Create previous and current systems with a merge, a split and a spontaneous generation."""
+    previous = [create_system(0, 0, 4, 4),   # A: merges with B
+                create_system(5, 0, 8, 3),   # B: merges with A, continues on its own
+                create_system(20, 0, 26, 4)] # C: splits
+    current = [create_system(2, 0, 7, 3),    # A + B
+               create_system(7, 0, 9, 3),    # B only
+               create_system(20, 0, 22.5, 4),  # C (part 1)
+               create_system(23.5, 0, 26, 4),  # C (part 2)
+               create_system(40, 0, 41, 1)]  # New system
+    return previous, current
+
+def track(tracker, strategy):
+    """Track the merge-split scene and return the events of current systems."""
+    previous, current = create_merge_split_scene()
+    tracker(previous, strategy).track(current)
+    return [sys.event for sys in current]
+
+def test_assignment_merge_and_split_events():
+    """AssignmentTracker must classify events like OverlapAreaTracker on a merge plus split scene."""
+    strategy = RelativeOverlapAreaStrategy(0.1)
+
+    expected = [LifeCycleEvent.MERGE, LifeCycleEvent.CONTINUITY,
+                LifeCycleEvent.SPLIT, LifeCycleEvent.SPLIT,
+                LifeCycleEvent.SPONTANEOUS_GENERATION]
+
+    assert track(OverlapAreaTracker, strategy) == expected
+    assert track(AssignmentTracker, strategy) == expected
+
+def test_assignment_event_follows_identity():
+    """A system that is not assigned to its only previous system (taken by a merge) must be a SPLIT with a new name."""
+    previous = [create_system(0, 0, 10, 4),  # P
+                create_system(12, 0, 20, 4)] # Q
+    current = [create_system(0, 0, 1, 4),    # A: P only
+               create_system(1, 0, 14, 4),   # B: P + Q
+               create_system(14, 0, 20, 4)]  # C: Q only
+
+    AssignmentTracker(previous, RelativeOverlapAreaStrategy(0.1)).track(current)
+
+    a, b, c = current
+    assert [len(s.relationships) for s in current] == [1, 2, 1]
+    assert [s.event for s in current] == [LifeCycleEvent.SPLIT, LifeCycleEvent.MERGE, LifeCycleEvent.CONTINUITY]
+    assert (b.name, c.name) == (previous[0].name, previous[1].name)
+    assert a.name not in (previous[0].name, previous[1].name)
+
+def create_image(boxes):
+    """Create a test image with cold rectangles (first line, last line + 1, first column, last column + 1)."""
+    data = np.full((20, 24), 280.0, dtype=np.float32)
+    for i0, i1, j0, j1 in boxes:
+        data[i0:i1, j0:j1] = 200.0
+    return array2raster(data, [-50.0, -20.0, -50.0 + 24 * 0.04, -20.0 + 20 * 0.04])
+
+def summarize(systems):
+    """Map the centroid of each system to its event and to the centroids of its relationships."""
+    key = lambda s: tuple(np.round(s.getCentroid(), 6))
+    return {key(s): (s.event, sorted(key(r) for r in s.relationships)) for s in systems}
+
+def test_label_tracker_events_equal_polygon_tracker():
+    """LabelOverlapTracker (pixel domain) must emit the same events and relationships as OverlapAreaTracker."""
+    previous = create_image([(2, 8, 2, 8), (2, 8, 10, 14), (12, 18, 2, 12)])
+    current = create_image([(3, 8, 4, 12), (12, 18, 2, 6), (12, 18, 8, 12), (14, 18, 16, 20)])
+
+    strategy = RelativeOverlapAreaStrategy(0.1)
+    results = []
+    for lazy, tracker in [(False, OverlapAreaTracker), (True, LabelOverlapTracker)]:
+        detector = LessThan(235, lazy=lazy)
+        systems = detector.detect(current)
+        tracker(detector.detect(previous), strategy).track(systems)
+        results.append(summarize(systems))
+
+    assert results[0] == results[1]
+    events = sorted(str(event) for event, _ in results[0].values())
+    assert events == ['MERGE', 'SPLIT', 'SPLIT', 'SPONTANEOUS_GENERATION']
+
+def create_moving_system(x, minutes):
+    """Create a 4 x 4 system at the given x position and time (minutes after 12:00)."""
+    s = create_system(x, 0, x + 4, 4)
+    s.timestamp = datetime(2020, 1, 1, 12, 0) + timedelta(minutes=minutes)
+    return s
+
+def test_advected_tracker_centroid_velocity():
+    """Fast systems must be tracked by centroid velocity, using the shared history or the relationships."""
+    strategy = RelativeOverlapAreaStrategy(0.1)
+
+    # Moving 3, then 6 units each 10 minutes
+    for history in [None, CentroidHistory()]:
+        frames = [[create_moving_system(x, 10 * i)] for i, x in enumerate([0, 3, 9])]
+        for previous, current in zip(frames[:-1], frames[1:]):
+            AdvectedOverlapTracker(previous, strategy, interval=10, history=history).track(current)
+
+        assert [s[0].event for s in frames] == [LifeCycleEvent.SPONTANEOUS_GENERATION,
+                                                LifeCycleEvent.CONTINUITY, LifeCycleEvent.CONTINUITY]
+        assert frames[2][0].name == frames[0][0].name
+
+        # Without advection, systems are not related
+        current = [create_moving_system(9, 20)]
+        OverlapAreaTracker(frames[1], strategy).track(current)
+        assert current[0].event == LifeCycleEvent.SPONTANEOUS_GENERATION
+
+def test_advected_tracker_resumed_relationships():
+    """Previous systems with names as relationships (e.g. after a resume) must use the history positions."""
+    strategy = RelativeOverlapAreaStrategy(0.1)
+
+    # Loaded systems keep only the names of their relationships
+    name = uuid.uuid4()
+    first, previous = create_moving_system(0, 0), create_moving_system(5, 10)
+    first.name = previous.name = name
+    previous.relationships = [name]
+
+    # No history: no displacement
+    current = [create_moving_system(10, 20)]
+    AdvectedOverlapTracker([previous], strategy).track(current)
+    assert current[0].event == LifeCycleEvent.SPONTANEOUS_GENERATION
+
+    history = CentroidHistory()
+    history.update([first])
+    current = [create_moving_system(10, 20)]
+    AdvectedOverlapTracker([previous], strategy, history=history).track(current)
+    assert current[0].event == LifeCycleEvent.CONTINUITY
+    assert current[0].name == name
+
+    # History keeps the last tracked frame
+    assert history.get(name) == (previous.timestamp, previous.getCentroid())
@@ -0,0 +1,103 @@
+#
+# This file is part of TATHU - Tracking and Analysis of Thunderstorms.
+# Copyright (C) 2022 INPE.
+#
+# TATHU - Tracking and Analysis of Thunderstorms is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Unit-test for tathu.utils."""
+
+import numpy as np
+import pytest
+
+from tathu.utils import (BufferPool, applyScaleOffset, extractPeriods,
+                         getBuffer, getGeoT, getWindow, getWindowGeoT)
+
+def test_extract_periods_gaps():
+    """A gap greater than timeout must close the current period."""
+    files = ['/data/S11635384_202001010000.nc',
+             '/data/S11635384_202001010010.nc',
+             '/data/S11635384_202001010020.nc',
+             '/data/S11635384_202001010100.nc', # Gap of 40 minutes
+             '/data/S11635384_202001010110.nc',
+             '/data/S11635384_202001010200.nc'] # Gap of 50 minutes
+
+    periods = extractPeriods(files, 15)
+
+    assert periods == [files[0:3], files[3:5], files[5:]]
+
+def test_extract_periods_timeout_limit():
+    """An elapsed time equal to timeout must not close the current period."""
+    files = ['S11635384_202001010000.nc', 'S11635384_202001010015.nc']
+
+    assert extractPeriods(files, 15) == [files]
+    assert extractPeriods(files[:1], 15) == [files[:1]]
+
+def test_extract_periods_long_gap():
+    """Gaps longer than one day must be detected (i.e. not only the seconds part)."""
+    files = ['S11635384_202001010000.nc', 'S11635384_202001020005.nc']
+
+    assert extractPeriods(files, 15) == [files[:1], files[1:]]
+
+def test_apply_scale_offset_in_place():
+    """Scale and offset must be applied in-place, except on no-data values."""
+    array = np.array([[1.0, 2.0], [-1.0, 4.0]], dtype=np.float32)
+
+    result = applyScaleOffset(array, 0.5, 10.0, nodata=-1.0)
+
+    assert result is array
+    np.testing.assert_array_equal(result, [[10.5, 11.0], [-1.0, 12.0]])
+
+def test_apply_scale_offset_out():
+    """Scale and offset must be written on out, keeping no-data values."""
+    array = np.array([1, 2, 65535, 4], dtype=np.uint16)
+    out = np.empty(array.shape, dtype=np.float32)
+
+    result = applyScaleOffset(array, 0.5, 10.0, nodata=65535, out=out)
+
+    assert result is out
+    np.testing.assert_array_equal(array, [1, 2, 65535, 4])
+    np.testing.assert_array_equal(out, [10.5, 11.0, 65535, 12.0])
+
+def test_apply_scale_offset_integer_output():
+    """Integer outputs must be rejected (i.e. no silent truncation)."""
+    array = np.array([1, 2, 3], dtype=np.int16)
+
+    with pytest.raises(TypeError):
+        applyScaleOffset(array, 0.5, 10.0)
+
+    with pytest.raises(TypeError):
+        applyScaleOffset(array.astype(np.float32), 0.5, 10.0, out=np.empty(3, dtype=np.int32))
+
+def test_buffer_pool():
+    """Buffers must be reused after size calls with the same shape and data type."""
+    pool = BufferPool(size=2)
+
+    a = pool.get((4, 5), np.float32)
+    b = pool.get((4, 5), np.float32)
+    c = pool.get((4, 5), np.int16)
+
+    assert a is not b
+    assert c.dtype == np.int16 and c.shape == (4, 5)
+    assert pool.get((4, 5), np.float32) is a
+    assert pool.get((4, 5), np.float32) is b
+
+    assert getBuffer(pool, (4, 5), np.int16) is not c
+    assert getBuffer(pool, (4, 5), np.int16) is c
+    assert getBuffer(None, (2, 3), np.uint8).shape == (2, 3)
+
+def test_get_window():
+    """The window must cover the given extent (including margin) and be clipped to grid."""
+    geoT = getGeoT([0.0, 0.0, 10.0, 10.0], 10, 10)
+
+    assert getWindow(geoT, (10, 10), [2.5, 3.5, 4.5, 5.5], margin=0) == (4, 7, 2, 5)
+    assert getWindow(geoT, (10, 10), [2.5, 3.5, 4.5, 5.5], margin=1) == (3, 8, 1, 6)
+    assert getWindow(geoT, (10, 10), [-5.0, -5.0, 20.0, 20.0]) == (0, 10, 0, 10)
+    assert getWindow(geoT, (10, 10), [20.0, 20.0, 30.0, 30.0]) is None
+
+def test_get_window_geot():
+    """The window geo-transform must start on the window upper-left corner."""
+    geoT = getGeoT([0.0, 0.0, 10.0, 10.0], 20, 10)
+
+    assert getWindowGeoT(geoT, (4, 7, 2, 5)) == [2.0, 1.0, 0, 8.0, 0, -0.5]
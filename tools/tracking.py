@@ -7,17 +7,17 @@
 #
 
 import configparser
+import functools
 import glob
 import os
-import sys
 
 import click
 
 from tathu.constants import KM_PER_DEGREE, LAT_LON_WGS84
 from tathu.io import spatialite
-from tathu.satellite import goes16
-from tathu.tracking import descriptors, detectors, trackers
-from tathu.utils import Timer, extractPeriods, file2timestamp
+from tathu.satellite import goes16, remap
+from tathu.tracking import descriptors, detectors, pipeline, trackers
+from tathu.utils import BufferPool, extractPeriods, file2timestamp
 
 def getFiles(basedir):
     search = os.path.join(basedir, '**/*.nc')
@@ -25,90 +25,69 @@ def getFiles(basedir):
     files = sorted(glob.glob(search, recursive=True))
     return files
 
-def detect(path, date_regex, date_format, extent, resolution, threshold,
-    minarea, stats, threshold_cc, minarea_cc):
-    with Timer():
-        # Extract file timestamp
-        timestamp = file2timestamp(path, date_regex, date_format)
-        
-        print('Searching for systems at:', timestamp)
+class Reader(object):
+    '''Remap GOES-16 channel to regular grid.'''
+    def __init__(self, extent, resolution, remapper=None):
+        self.extent = extent
+        self.resolution = resolution
+        self.remapper = remapper
+        self.buffers = BufferPool() # Grid arrays reused across frames.
 
-        # Remap channel to 2km
-        grid = goes16.sat2grid(path, extent, resolution, LAT_LON_WGS84, 'HDF5', progress=None)
+    def __call__(self, path):
+        return goes16.sat2grid(path, self.extent, self.resolution, LAT_LON_WGS84, 'HDF5', progress=None,
+                               remapper=self.remapper, buffers=self.buffers)
 
-        # Create detector
-        detector = detectors.LessThan(threshold, minarea)
+class DefaultAttributesDescriptor(object):
+    '''Add default values of attributes computed by tracking (e.g. normalized area expansion).'''
+    def __init__(self, attrs):
+        self.attrs = attrs
 
-        # Searching for systems
-        systems = detector.detect(grid)
-
-        # Adjust timestamp
-        for s in systems:
-            s.timestamp = timestamp
-            
-        # Create statistical descriptor
-        descriptor = descriptors.StatisticalDescriptor(stats=stats, rasterOut=True)
-        
-        # Describe systems (stats)
-        systems = descriptor.describe(grid, systems)
-
-        # Create convective cell descriptor
-        descriptor = descriptors.ConvectiveCellsDescriptor(threshold_cc, minarea_cc)
-
-        # Describe systems (convective cell)
-        descriptor.describe(grid, systems)
-
-        # Add normalized area expansion attribute
+    def describe(self, image, systems):
         for s in systems:
-            s.attrs['nae'] = 0
-
-        grid = None
+            s.attrs.update(self.attrs)
+
+def createPipeline(date_regex, date_format, extent, resolution, threshold, minarea,
+    stats, threshold_cc, minarea_cc, areaoverlap, lazy, remap_cache, outputter, loader, columns, checkpoint, workers):
+    # Cached remapping, if requested
+    remapper = remap.Remapper(remap_cache) if remap_cache else None
+
+    # Per-frame stages: read -> detect -> describe
+    processor = pipeline.FrameProcessor(Reader(extent, resolution, remapper),
+        detectors.LessThan(threshold, minarea, lazy=lazy),
+        [descriptors.StatisticalDescriptor(stats=stats, rasterOut=True),
+         descriptors.ConvectiveCellsDescriptor(threshold_cc, minarea_cc),
+         DefaultAttributesDescriptor({'nae' : 0})],
+        date_regex, date_format)
+
+    # Create overlap area strategy
+    strategy = trackers.RelativeOverlapAreaStrategy(areaoverlap)
+
+    # Labeled systems: overlap areas computed on pixel domain
+    tracker = trackers.LabelOverlapTracker if lazy else trackers.OverlapAreaTracker
+
+    return pipeline.TrackingPipeline(processor,
+        functools.partial(tracker, strategy=strategy),
+        outputter, [descriptors.NormalizedAreaExpansionDescriptor()],
+        loader, columns, pipeline.Checkpoint(checkpoint), workers)
+
+class PipelineFactory(object):
+    '''Create the tracking pipeline of one output shard (used by PeriodScheduler).'''
+    def __init__(self, *args):
+        self.args = args
+
+    def __call__(self, shard):
+        columns, workers = self.args[-2:]
+        db = spatialite.Outputter(shard, 'systems', columns)
+        loader = spatialite.Loader(shard, 'systems')
+        return createPipeline(*self.args[:-2], db, loader, columns, shard + '.checkpoint', workers)
 
-        return systems
-
-def track(files, date_regex, date_format, extent, resolution, threshold, minarea,
-    stats, threshold_cc, minarea_cc, areaoverlap, outputter):
-    try:
-        img = 0
-        # Detect first systems
-        current = detect(files[img], date_regex, date_format, extent, resolution, threshold,
-            minarea, stats, threshold_cc, minarea_cc)
-
-        # Save to output
-        outputter.output(current)
-        img = img + 1
-
-        # Prepare tracking...
-        previous = current
-
-        # Create overlap area strategy
-        strategy = trackers.RelativeOverlapAreaStrategy(areaoverlap)
-
-        # for each image file
-        for i in range(img, len(files)):
-            # Detect current systems
-            current = detect(files[i], date_regex, date_format, extent, resolution,
-                threshold, minarea, stats, threshold_cc, minarea_cc)
-            
-            # Let's track!
-            t = trackers.OverlapAreaTracker(previous, strategy=strategy)
-            t.track(current)
-            
-            # Compute normalized area expansion attribute, if requested
-            descriptor = descriptors.NormalizedAreaExpansionDescriptor()
-            descriptor.describe(previous, current)
-
-            # Save to output
-            outputter.output(current)
-            
-            # Prepare next iteration
-            previous = current
-    except Exception as e:
-        print('Unexpected error:', e, sys.exc_info()[0])
-        
 @click.command()
 @click.option('--config', type=click.Path(exists=True), help='Path to config tracking file.', required=True)
-def main(config):
+@click.option('--workers', type=int, default=0, show_default=True, help='Number of processes used to detect and describe the next frames (0 = sequential).')
+@click.option('--period-workers', type=int, default=0, show_default=True, help='Number of independent periods tracked concurrently, each one on its own output shard (0 = sequential).')
+@click.option('--node', default='0/1', show_default=True, help='Process only the periods of this node (K/N), i.e. period index %% N == K.')
+@click.option('--merge', is_flag=True, help='Merge the output shards of all nodes into the output database.')
+def main(config, workers, period_workers, node, merge):
     # Read config file and extract infos
     params = configparser.ConfigParser(interpolation=None)
     params.read(config)
@@ -119,6 +98,9 @@ def main(config):
     # Get resolution
     resolution = float(params.get('grid', 'resolution'))
 
+    # Get remap cache directory (optional)
+    remap_cache = params.get('grid', 'remap_cache', fallback=None)
+
     # Get input-data parameters
     repository = params.get('input', 'repository')
     date_regex = params.get('input', 'date_regex')
@@ -130,6 +112,7 @@ def main(config):
     minarea = float(params.get('tracking_parameters', 'minarea'))
     areaoverlap = float(params.get('tracking_parameters', 'areaoverlap'))
     stats = [i.strip() for i in params.get('tracking_parameters', 'stats').split(',')]
+    lazy = params.getboolean('tracking_parameters', 'lazy', fallback=False)
 
     # Get tracking parameters related with convective cells
     threshold_cc = float(params.get('tracking_parameters', 'threshold_cc'))
@@ -137,6 +120,7 @@ def main(config):
 
     # Output
     database = params.get('output', 'database')
+    checkpoint = params.get('output', 'checkpoint', fallback=database + '.checkpoint')
 
     # Columns
     columns = stats.copy()
@@ -162,6 +146,7 @@ def main(config):
     print(':: Config tracking file location:', config)
     print(':: Extent:', extent)
     print(':: Grid Resolution:', resolution, 'km')
+    print(':: Remap cache:', remap_cache)
     print(':: Repository of images:', repository)
     print(':: Date Regex:', date_regex)
     print(':: Date Format:', date_format)
@@ -170,8 +155,11 @@ def main(config):
     print(':: Minimum area of systems:', minarea, 'km2')
     print(':: Area Overlap:', areaoverlap * 100, '%')
     print(':: Stats:', stats)
+    print(':: Labeled systems (lazy polygons):', lazy)
     print(':: CC temperature threshold:', threshold_cc, 'K')
     print(':: Minimum area of CC:', minarea_cc, 'km2')
+    print(':: Checkpoint file:', checkpoint)
+    print(':: Workers:', workers)
 
     # Convert to degrees^2
     minarea = minarea/(KM_PER_DEGREE * KM_PER_DEGREE)
@@ -180,13 +168,43 @@ def main(config):
     # Extracting periods
     periods = extractPeriods(files, timeout, date_regex, date_format)
 
-    # Create database connection
+    # Parse node
+    k, n = [int(i) for i in node.split('/')]
+
+    # Independent periods on output shards
+    if period_workers > 0 or n > 1 or merge:
+        # Create output database
+        db = spatialite.Outputter(database, 'systems', columns)
+
+        factory = PipelineFactory(date_regex, date_format, extent, resolution, threshold, minarea,
+            stats, threshold_cc, minarea_cc, areaoverlap, lazy, remap_cache, columns, workers)
+        scheduler = pipeline.PeriodScheduler(factory, database + '.shards', max(period_workers, 1))
+
+        if not merge:
+            print(':: Node:', node)
+            scheduler.run(periods, k, n)
+
+        # Merge shards (multiple nodes: after all nodes, using --merge)
+        if merge or n == 1:
+            scheduler.merge(periods, functools.partial(spatialite.merge, database, 'systems'))
+        else:
+            print('* Node finished. Run with --merge after all nodes to build', database)
+        return
+
+    # Create database connection (loader is used to resume)
     db = spatialite.Outputter(database, 'systems', columns)
+    loader = spatialite.Loader(database, 'systems')
+
+    # Create pipeline
+    p = createPipeline(date_regex, date_format, extent, resolution, threshold, minarea,
+        stats, threshold_cc, minarea_cc, areaoverlap, lazy, remap_cache, db, loader, columns, checkpoint, workers)
 
     # Tracking
-    for period in periods:
-        track(period, date_regex, date_format, extent, resolution,
-            threshold, minarea, stats, threshold_cc, minarea_cc, areaoverlap, db)
+    try:
+        p.run(periods)
+    except Exception:
+        print('* Tracking stopped. Run again with the same config to resume from', checkpoint)
+        raise
 
 if __name__ == '__main__':
     main()